@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+离线生成和B站服务器格式一样的WebSocket消息，给基准测试用
+"""
+import base64
+import json
+import random
+import zlib
+from typing import *
+
+import brotli
+
+from blivedm.clients import ws_base
+from blivedm.models import pb
+
+__all__ = (
+    'make_packet',
+    'COMMAND_MAKERS',
+    'CMD_MIXES',
+    'make_commands',
+    'make_frames',
+)
+
+FACE_URL = 'https://i0.hdslb.com/bfs/face/member/noface.jpg'
+
+
+def make_packet(
+    data: Union[dict, bytes],
+    operation: int = ws_base.Operation.SEND_MSG_REPLY,
+    ver: int = ws_base.ProtoVer.NORMAL,
+    seq_id=1,
+) -> bytes:
+    """
+    创建一个服务器发给客户端的包
+    """
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8') if isinstance(data, dict) else data
+    header = ws_base.HEADER_STRUCT.pack(*ws_base.HeaderTuple(
+        pack_len=ws_base.HEADER_STRUCT.size + len(body),
+        raw_header_size=ws_base.HEADER_STRUCT.size,
+        ver=ver,
+        operation=operation,
+        seq_id=seq_id,
+    ))
+    return header + body
+
+
+#
+# 业务消息
+#
+
+def make_danmaku_command(index: int) -> dict:
+    return {
+        'cmd': 'DANMU_MSG',
+        'info': [
+            [0, 1, 25, 16777215, 1700000000000 + index, index, 0, f'{index:08x}', 0, 0, 0, '', 0, '{}', '{}',
+             {'mode': 0, 'show_player_type': 0, 'extra': '{"send_from_me":false,"mode":0,"color":16777215}',
+              'user': {'uid': index, 'base': {'name': f'用户{index}', 'face': FACE_URL, 'name_color': 0}}}],
+            f'弹幕内容{index}',
+            [index, f'用户{index}', 0, 0, 0, 10000, 1, ''],
+            [21, '勋章', '主播', 1, 1725515, '', 0, 6809855, 1725515, 5414290, 0, 0, 1],
+            [30, 0, 9868950, '>50000', 0],
+            ['', ''],
+            0, 0, None, {'ts': 1700000000, 'ct': '00000000'}, 0, 0, None, None, 0, 105, [15], None,
+        ],
+        'dm_v2': '',
+    }
+
+
+def make_gift_command(index: int) -> dict:
+    return {
+        'cmd': 'SEND_GIFT',
+        'data': {
+            'giftName': '辣条',
+            'num': 1 + index % 10,
+            'uname': f'用户{index}',
+            'face': FACE_URL,
+            'guard_level': 0,
+            'uid': index,
+            'timestamp': 1700000000 + index,
+            'giftId': 1,
+            'giftType': 0,
+            'gift_info': {'img_basic': 'https://s1.hdslb.com/bfs/live/d57afb7c5596359970eb430655c6aef501a268ab.png'},
+            'action': '投喂',
+            'price': 100,
+            'rnd': str(1700000000 + index),
+            'coin_type': 'silver',
+            'total_coin': 100 * (1 + index % 10),
+            'tid': str(1700000000000000 + index),
+            'medal_info': {'medal_level': 21, 'medal_name': '勋章', 'anchor_roomid': 1, 'target_id': 1725515},
+            'blind_gift': None,
+        },
+    }
+
+
+def make_gift_v2_command(index: int) -> dict:
+    proto = pb.SendGiftBroadcast(
+        uid=index,
+        uname=f'用户{index}',
+        face=FACE_URL,
+        medal_info=pb.SendGiftV2MedalInfo(target_id=1725515, anchor_roomid=1, medal_level=21, medal_name='勋章'),
+        gift_list=[pb.SendGiftV2GiftItem(
+            gift_id=31036,
+            gift_name='小花花',
+            num=1 + index % 10,
+            price=100,
+            total_coin=100 * (1 + index % 10),
+            coin_type='gold',
+            tid=str(1700000000000000 + index),
+            timestamp=1700000000 + index,
+            rnd=str(1700000000 + index),
+            action='投喂',
+            gift_info=pb.SendGiftV2GiftMaterialSnapShot(
+                img_basic='https://s1.hdslb.com/bfs/live/8b40d0470890e7d573995383af8a8ae074d485d9.png'
+            ),
+        )],
+    )
+    return {'cmd': 'SEND_GIFT_V2', 'data': {'pb': base64.b64encode(bytes(proto)).decode('ascii')}}
+
+
+def make_interact_word_v2_command(index: int) -> dict:
+    proto = pb.InteractWordV2(
+        uid=index,
+        uname=f'用户{index}',
+        msg_type=pb.InteractWordV2MsgType.EnterRoom,
+        timestamp=1700000000 + index,
+        uinfo=pb.InteractWordV2UserInfo(base=pb.InteractWordV2UserBaseInfo(face=FACE_URL)),
+    )
+    return {'cmd': 'INTERACT_WORD_V2', 'data': {'pb': base64.b64encode(bytes(proto)).decode('ascii')}}
+
+
+def make_super_chat_command(index: int) -> dict:
+    return {
+        'cmd': 'SUPER_CHAT_MESSAGE',
+        'data': {
+            'price': 30,
+            'message': f'醒目留言内容{index}' * 3,
+            'message_trans': '',
+            'start_time': 1700000000 + index,
+            'end_time': 1700000060 + index,
+            'time': 60,
+            'id': index,
+            'gift': {'gift_id': 12000, 'gift_name': '醒目留言', 'num': 1},
+            'uid': index,
+            'user_info': {'uname': f'用户{index}', 'face': FACE_URL, 'guard_level': 0, 'user_level': 20},
+            'background_bottom_color': '#2A60B2',
+            'background_color': '#EDF5FF',
+            'background_icon': '',
+            'background_image': '',
+            'background_price_color': '#7497CD',
+        },
+    }
+
+
+def make_open_live_danmaku_command(index: int) -> dict:
+    return {
+        'cmd': 'LIVE_OPEN_PLATFORM_DM',
+        'data': {
+            'uname': f'用户{index}',
+            'open_id': f'{index:032x}',
+            'union_id': f'U_{index:032x}',
+            'uface': FACE_URL,
+            'timestamp': 1700000000 + index,
+            'room_id': 1,
+            'msg': f'弹幕内容{index}',
+            'msg_id': f'{index:08x}-0000-0000-0000-000000000000',
+            'guard_level': 0,
+            'fans_medal_wearing_status': True,
+            'fans_medal_name': '勋章',
+            'fans_medal_level': 21,
+            'emoji_img_url': '',
+            'dm_type': 0,
+            'glory_level': 10,
+            'reply_open_id': '',
+            'reply_uname': '',
+            'is_admin': 0,
+        },
+    }
+
+
+COMMAND_MAKERS: Dict[str, Callable[[int], dict]] = {
+    'DANMU_MSG': make_danmaku_command,
+    'SEND_GIFT': make_gift_command,
+    'SEND_GIFT_V2': make_gift_v2_command,
+    'INTERACT_WORD_V2': make_interact_word_v2_command,
+    'SUPER_CHAT_MESSAGE': make_super_chat_command,
+    'LIVE_OPEN_PLATFORM_DM': make_open_live_danmaku_command,
+}
+"""cmd -> 生成业务消息的函数，参数是消息序号"""
+
+CMD_MIXES: Dict[str, Dict[str, float]] = {
+    # 只有弹幕
+    'danmaku': {'DANMU_MSG': 1},
+    # 大概是一个热门直播间的比例
+    'typical': {
+        'DANMU_MSG': 50,
+        'INTERACT_WORD_V2': 35,
+        'SEND_GIFT_V2': 8,
+        'SEND_GIFT': 5,
+        'SUPER_CHAT_MESSAGE': 2,
+    },
+    # 送礼高峰
+    'gifts': {'SEND_GIFT_V2': 60, 'SEND_GIFT': 30, 'DANMU_MSG': 10},
+    # 开放平台
+    'open_live': {'LIVE_OPEN_PLATFORM_DM': 1},
+}
+"""名字 -> {cmd: 权重}"""
+
+
+def make_commands(mix: Dict[str, float], count: int, seed=0) -> List[dict]:
+    """
+    按权重随机生成业务消息，同样的参数生成的消息相同
+
+    :param mix: {cmd: 权重}
+    :param count: 消息数
+    :param seed: 随机数种子
+    """
+    rng = random.Random(seed)
+    cmds = rng.choices(list(mix.keys()), list(mix.values()), k=count)
+    return [COMMAND_MAKERS[cmd](index) for index, cmd in enumerate(cmds)]
+
+
+def make_frames(commands: List[dict], messages_per_frame: int, ver: int = ws_base.ProtoVer.BROTLI) -> List[bytes]:
+    """
+    把业务消息打包成WebSocket消息
+
+    :param commands: 业务消息
+    :param messages_per_frame: 每个WebSocket消息包含几条业务消息
+    :param ver: 协议版本，BROTLI、DEFLATE是把多条业务消息压缩成一个包，NORMAL是直接拼起来
+    """
+    frames = []
+    for start in range(0, len(commands), messages_per_frame):
+        body = b''.join(make_packet(command) for command in commands[start:start + messages_per_frame])
+        if ver == ws_base.ProtoVer.BROTLI:
+            frames.append(make_packet(brotli.compress(body), ver=ver))
+        elif ver == ws_base.ProtoVer.DEFLATE:
+            frames.append(make_packet(zlib.compress(body), ver=ver))
+        elif ver == ws_base.ProtoVer.NORMAL:
+            frames.append(body)
+        else:
+            raise ValueError(f'unsupported ver={ver}')
+    return frames
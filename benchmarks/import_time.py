@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+import耗时基准测试：在子进程里用 `python -X importtime` 测量各种用法的import耗时，取中位数和目标对比，
+同时检查不该加载的重量级依赖（aiohttp、brotli、pure_protobuf）有没有被加载::
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --runs 20 --check
+
+耗时包括typing、dataclasses等标准库模块，所以目标留了余量，主要靠检查依赖防止退化
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import *
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('aiohttp', 'brotli', 'pure_protobuf')
+
+
+class Case(NamedTuple):
+    name: str
+    """用例名"""
+    code: str
+    """在子进程执行的代码"""
+    target_ms: Optional[float]
+    """耗时目标（毫秒），None表示只报告"""
+    forbidden_modules: Tuple[str, ...]
+    """不该加载的顶层模块"""
+
+
+CASES = [
+    Case('import blivedm', 'import blivedm', 50, HEAVY_MODULES),
+    Case('recording reader', 'import blivedm.recording.reader', 80, HEAVY_MODULES),
+    Case('web models', 'import blivedm.models.web', 120, HEAVY_MODULES),
+    # aiohttp自己会尝试导入brotli，所以用到客户端时不检查brotli
+    Case('handlers', 'from blivedm import BaseHandler', None, ('pure_protobuf',)),
+    Case('web client', 'from blivedm import BLiveClient', None, ('pure_protobuf',)),
+]
+
+
+def measure_once(code: str) -> Tuple[float, Set[str]]:
+    """
+    在子进程里import一次
+
+    :return: (总耗时（毫秒）, 加载的所有模块名)
+    """
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True,
+    )
+    total_us = 0
+    modules = set()
+    for line in res.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            # 表头
+            continue
+        module_name = parts[2].strip()
+        modules.add(module_name)
+        # 只统计顶层的import，缩进的是被它们导入的模块
+        if parts[2][1:2] != ' ':
+            total_us += int(parts[1])
+    return total_us / 1000, modules
+
+
+def run_case(case: Case, runs: int) -> dict:
+    durations = []
+    modules: Set[str] = set()
+    for _ in range(runs):
+        duration, modules = measure_once(case.code)
+        durations.append(duration)
+    loaded_forbidden = sorted(
+        module_name for module_name in case.forbidden_modules
+        if any(name == module_name or name.startswith(module_name + '.') for name in modules)
+    )
+    median = statistics.median(durations)
+    return {
+        'median_ms': median,
+        'min_ms': min(durations),
+        'module_count': len(modules),
+        'loaded_forbidden': loaded_forbidden,
+        'ok': not loaded_forbidden and (case.target_ms is None or median <= case.target_ms),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='每个用例运行的次数')
+    parser.add_argument('--check', action='store_true', help='有用例超过目标或者加载了不该加载的模块时返回非0')
+    args = parser.parse_args()
+
+    all_ok = True
+    print(f'{"case":<20} {"median":>10} {"min":>10} {"target":>10} {"modules":>8}  result')
+    for case in CASES:
+        result = run_case(case, args.runs)
+        all_ok = all_ok and result['ok']
+        target = f'{case.target_ms:.0f}ms' if case.target_ms is not None else '-'
+        status = 'ok' if result['ok'] else 'FAIL'
+        if result['loaded_forbidden']:
+            status += f' (loaded {", ".join(result["loaded_forbidden"])})'
+        print(f'{case.name:<20} {result["median_ms"]:>8.1f}ms {result["min_ms"]:>8.1f}ms {target:>10} '
+              f'{result["module_count"]:>8}  {status}')
+
+    if args.check and not all_ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+用模拟服务器做压力测试：同时运行很多个真实的客户端，测量全部连上的时间、收消息速度、每个连接的内存、重连风暴的恢复时间
+
+服务器在子进程运行，所以测到的内存只包括客户端::
+
+    python -m benchmarks.load_test --clients 1000
+    python -m benchmarks.load_test --clients 1000 --kind open_live --storm
+    python -m benchmarks.load_test --clients 1000 --kind open_live --manager --game-session-file /tmp/games.json
+    python -m benchmarks.load_test --clients 1000 --ws-transport asyncio
+    python -m benchmarks.load_test --clients 200 --duration 600 --drop-rate 0.01 --bad-token-rate 0.1
+
+也可以连接已经在运行的模拟服务器，这时服务器的故障注入参数要在启动服务器时指定::
+
+    python -m benchmarks.load_test --clients 1000 --server http://127.0.0.1:18100
+"""
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import time
+import tracemalloc
+from typing import *
+
+import aiohttp
+
+import blivedm
+import blivedm.metrics
+from blivedm.clients import net, ws_base
+from . import mock_server
+
+HOST = '127.0.0.1'
+MANAGER_REQUEST_CONCURRENCY = 5
+"""--manager时开启、关闭项目的并发数限制"""
+GAME_END_DELAY = 0.05
+"""--manager时关闭项目接口的延迟（秒），让关闭请求重叠，检查并发数限制"""
+
+
+async def get_server_stats(session: aiohttp.ClientSession, server_url: str) -> dict:
+    async with session.get(f'{server_url}/mock/stats') as res:
+        return await res.json()
+
+
+async def wait_for_server(server_url: str, timeout: float):
+    """
+    等待模拟服务器启动，生成消息池需要一点时间
+    """
+    start_time = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                await get_server_stats(session, server_url)
+                return
+            except aiohttp.ClientConnectionError:
+                if time.perf_counter() - start_time >= timeout:
+                    raise
+            await asyncio.sleep(0.2)
+
+
+async def wait_for_connections(
+    session: aiohttp.ClientSession, server_url: str, count: int, timeout: float, min_auth_count=0
+) -> Optional[float]:
+    """
+    等待服务器上已认证的连接数达到count
+
+    :param min_auth_count: 服务器的总认证次数也要达到这个数，用来确认是重连后的连接
+    :return: 等待的时间（秒），超时则返回None
+    """
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < timeout:
+        stats = await get_server_stats(session, server_url)
+        if stats['authed_connection_count'] >= count and stats['auth_count'] >= min_auth_count:
+            return time.perf_counter() - start_time
+        await asyncio.sleep(0.1)
+    return None
+
+
+def create_client(
+    kind: str, index: int, session: aiohttp.ClientSession,
+    ws_transport: ws_base.TransportType = ws_base.TransportType.AIOHTTP,
+) -> ws_base.WebSocketClientBase:
+    if kind == 'web':
+        return mock_server.MockBLiveClient(index + 1, session=session, ws_transport=ws_transport)
+    return blivedm.OpenLiveClient(
+        access_key_id='mock',
+        access_key_secret='mock',
+        app_id=1,
+        room_owner_auth_code=f'mock-auth-code-{index}',
+        session=session,
+        ws_transport=ws_transport,
+    )
+
+
+async def run_clients(args, server_url: str):
+    await wait_for_server(server_url, 30)
+    mock_server.patch_urls(server_url)
+    registry = blivedm.metrics.MetricsRegistry()
+
+    tracemalloc.start()
+    # 模拟服务器是IP地址，默认的cookie jar不接受IP地址的cookie
+    session = aiohttp.ClientSession(
+        connector=net.get_shared_connector(),
+        connector_owner=False,
+        cookie_jar=aiohttp.CookieJar(unsafe=True),
+        timeout=aiohttp.ClientTimeout(total=30),
+    )
+    control_session = aiohttp.ClientSession()
+    ws_transport = ws_base.TransportType[args.ws_transport.upper()]
+    clients = [create_client(args.kind, index, session, ws_transport) for index in range(args.clients)]
+    manager = None
+    if args.manager:
+        manager = blivedm.OpenLiveManager(
+            'mock', 'mock', 1, session=session, request_concurrency=MANAGER_REQUEST_CONCURRENCY
+        )
+        for client in clients:
+            manager.add_client(client)
+        manager.start()
+    if args.game_session_file is not None:
+        store = blivedm.FileGameSessionStore(args.game_session_file)
+        for client in clients:
+            client.set_game_session_store(store)
+    handler = blivedm.BaseHandler()
+    for client in clients:
+        client.set_handler(handler)
+        client.enable_metrics(registry)
+
+    base_stats = await get_server_stats(control_session, server_url)
+    start_time = time.perf_counter()
+    for client in clients:
+        client.start()
+
+    try:
+        ready_time = await wait_for_connections(control_session, server_url, args.clients, args.timeout)
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        print(f'kind={args.kind} clients={args.clients} ws_transport={args.ws_transport}')
+        print(f'  all connected:        {"timeout" if ready_time is None else f"{ready_time:.2f}s"}')
+        print(f'  client memory:        {current_memory / 1024 / 1024:.1f} MiB '
+              f'(peak {peak_memory / 1024 / 1024:.1f} MiB)')
+        print(f'  memory per client:    {current_memory / args.clients / 1024:.1f} KiB')
+
+        if args.duration > 0:
+            total_before = registry.get_total_metrics()
+            await asyncio.sleep(args.duration)
+            total_after = registry.get_total_metrics()
+            command_count = sum(total_after.command_counts.values()) - sum(total_before.command_counts.values())
+            print(f'  soak {args.duration:.0f}s:             {command_count / args.duration:.0f} msg/s, '
+                  f'{(total_after.byte_count - total_before.byte_count) / args.duration / 1024:.0f} KiB/s, '
+                  f'{total_after.reconnect_count - total_before.reconnect_count} reconnects')
+
+        if args.storm:
+            stats = await get_server_stats(control_session, server_url)
+            async with control_session.post(f'{server_url}/mock/drop_all') as res:
+                dropped = (await res.json())['dropped']
+            recover_time = await wait_for_connections(
+                control_session, server_url, args.clients, args.timeout, stats['auth_count'] + dropped
+            )
+            print(f'  reconnect storm:      {dropped} dropped, recovered in '
+                  f'{"timeout" if recover_time is None else f"{recover_time:.2f}s"}')
+
+        total = registry.get_total_metrics()
+        stats = await get_server_stats(control_session, server_url)
+        net_stats = net.get_stats()
+        print(f'  total run time:       {time.perf_counter() - start_time:.1f}s')
+        print(f'  received:             {total.frame_count} frames, {sum(total.command_counts.values())} messages')
+        print(f'  client reconnects:    {total.reconnect_count}')
+        print(f'  server auths:         {stats["auth_count"] - base_stats["auth_count"]} ok, '
+              f'{stats["auth_rejected_count"] - base_stats["auth_rejected_count"]} rejected')
+        connect_ok_count = net_stats['connect_count'] - net_stats['connect_failed_count']
+        print(f'  connect time:         avg {net_stats["connect_time_total"] / max(connect_ok_count, 1) * 1000:.1f}ms, '
+              f'max {net_stats["connect_time_max"] * 1000:.1f}ms, {net_stats["connect_failed_count"]} failed')
+    finally:
+        game_end_max_in_flight_count = None
+        if manager is not None:
+            # 管理器并行关闭所有客户端，关闭项目的请求也要受并发数限制
+            async with control_session.post(f'{server_url}/mock/config', json={'game_end_delay': GAME_END_DELAY}):
+                pass
+            await manager.stop_and_close()
+            stats = await get_server_stats(control_session, server_url)
+            game_end_max_in_flight_count = stats['game_end_max_in_flight_count']
+        else:
+            await asyncio.gather(*(client.stop_and_close() for client in clients))
+        await session.close()
+        await control_session.close()
+        await net.close_shared_connectors()
+        tracemalloc.stop()
+
+    # close后不能再有定时器发项目心跳包，否则项目永远不会超时关闭
+    leaked_count = sum(
+        1 for client in clients if getattr(client, '_game_heartbeat_timer_handle', None) is not None
+    )
+    if leaked_count != 0:
+        raise RuntimeError(f'{leaked_count} closed clients still have game heartbeat timers')
+    if game_end_max_in_flight_count is not None:
+        print(f'  game end in flight:   max {game_end_max_in_flight_count}, limit {MANAGER_REQUEST_CONCURRENCY}')
+        if game_end_max_in_flight_count > MANAGER_REQUEST_CONCURRENCY:
+            raise RuntimeError(f'{game_end_max_in_flight_count} game end requests were in flight at once, '
+                               f'limit is {MANAGER_REQUEST_CONCURRENCY}')
+
+
+def raise_fd_limit():
+    """
+    每个连接占用一个文件描述符，默认的限制一般是1024
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--kind', choices=('web', 'open_live'), default='web')
+    parser.add_argument('--ws-transport', choices=('aiohttp', 'asyncio'), default='aiohttp',
+                        help='连接弹幕服务器用的WebSocket实现')
+    parser.add_argument('--server', help='已经在运行的模拟服务器的URL，不传则在子进程启动')
+    parser.add_argument('--port', type=int, default=18100)
+    parser.add_argument('--timeout', type=float, default=120, help='等待全部连上的超时时间（秒）')
+    parser.add_argument('--duration', type=float, default=10, help='全部连上后持续收消息的时间（秒）')
+    parser.add_argument('--manager', action='store_true', help='开放平台客户端用OpenLiveManager批量发项目心跳包')
+    parser.add_argument('--game-session-file', help='开放平台客户端保存项目场次的文件，close时不关闭项目')
+    parser.add_argument('--storm', action='store_true', help='最后断开所有连接，测量重连风暴的恢复时间')
+    parser.add_argument('--rate', type=float, default=10, help='每个连接每秒推送的业务消息数')
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--auth-delay', type=float, default=0)
+    parser.add_argument('--bad-token-rate', type=float, default=0)
+    parser.add_argument('--game-heartbeat-7003-rate', type=float, default=0)
+    args = parser.parse_args()
+    if (args.manager or args.game_session_file is not None) and args.kind != 'open_live':
+        parser.error('--manager and --game-session-file require --kind open_live')
+
+    raise_fd_limit()
+    server = None
+    if args.server is not None:
+        server_url = args.server.rstrip('/')
+    else:
+        config = mock_server.MockConfig(
+            message_rate=args.rate,
+            drop_rate=args.drop_rate,
+            auth_delay=args.auth_delay,
+            bad_token_rate=args.bad_token_rate,
+            game_heartbeat_7003_rate=args.game_heartbeat_7003_rate,
+        )
+        server = multiprocessing.Process(
+            target=mock_server.run_server, args=(config, HOST, args.port), daemon=True
+        )
+        server.start()
+        server_url = f'http://{HOST}:{args.port}'
+
+    try:
+        asyncio.run(run_clients(args, server_url))
+    finally:
+        if server is not None:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
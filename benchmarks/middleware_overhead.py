@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+测量中间件管道的开销：同样的去重、屏蔽、采样步骤，用一层层包装的消息处理器实现和用MiddlewareHandler实现，
+直接调用handle处理同一批业务消息，不经过网络和解析::
+
+    python -m benchmarks.middleware_overhead
+    python -m benchmarks.middleware_overhead --mix danmaku --messages 20000
+    python -m benchmarks.middleware_overhead --no-models
+
+默认的消息处理器重载了_on_xxx，要构造消息模型。--no-models时消息处理器只实现handle，只测分发和步骤的开销
+"""
+import argparse
+import asyncio
+import gc
+import time
+from typing import *
+
+import blivedm
+import blivedm.middleware as middleware
+import blivedm.models.web as web_models
+from blivedm.clients import ws_base
+from . import frames
+
+BLOCKED_UIDS = frozenset(range(0, 1000, 7))
+
+
+class CountingHandler(blivedm.BaseHandler):
+    def __init__(self):
+        self.count = 0
+
+    def _on_danmaku(self, client: ws_base.WebSocketClientBase, message: web_models.DanmakuMessage):
+        self.count += 1
+
+    def _on_gift(self, client: ws_base.WebSocketClientBase, message: web_models.GiftMessage):
+        self.count += 1
+
+    def _on_super_chat(self, client: ws_base.WebSocketClientBase, message: web_models.SuperChatMessage):
+        self.count += 1
+
+    def _on_interact_word_v2(self, client: ws_base.WebSocketClientBase, message: web_models.InteractWordV2Message):
+        self.count += 1
+
+
+class CountingCommandHandler(blivedm.HandlerInterface):
+    """
+    直接处理业务消息，不构造消息模型
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        self.count += 1
+
+
+class StepWrapperHandler(blivedm.HandlerInterface):
+    """
+    以前的做法：每个步骤包装一层消息处理器，所有cmd都要经过每一层
+    """
+
+    def __init__(self, handler: blivedm.HandlerInterface, step: middleware.StepInterface):
+        self._handler = handler
+        self._step = step
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        cmd = command.get('cmd', '')
+        if self._step.cmds is None or cmd in self._step.cmds:
+            command = self._step.process(client, command)
+            if command is None:
+                return
+        self._handler.handle(client, command)
+
+
+def is_danmaku_allowed(command: dict) -> bool:
+    return command['info'][2][0] not in BLOCKED_UIDS
+
+
+def make_steps() -> List[middleware.StepInterface]:
+    """
+    都处理业务消息的步骤，两种实现做的事情相同，差别只在分发的开销
+    """
+    return [
+        middleware.DedupStep(),
+        middleware.FilterStep(is_danmaku_allowed, cmds=['DANMU_MSG']),
+        middleware.SampleStep(0.5, cmds=['INTERACT_WORD_V2']),
+    ]
+
+
+def make_configs(
+    handler_factory: Callable[[], Union[CountingHandler, CountingCommandHandler]]
+) -> List[Tuple[str, Union[CountingHandler, CountingCommandHandler], blivedm.HandlerInterface]]:
+    configs = []
+
+    handler = handler_factory()
+    configs.append(('no steps', handler, handler))
+
+    handler = handler_factory()
+    wrapped = handler
+    for step in reversed(make_steps()):
+        wrapped = StepWrapperHandler(wrapped, step)
+    configs.append(('wrapper handlers', handler, wrapped))
+
+    handler = handler_factory()
+    configs.append(('middleware', handler, middleware.MiddlewareHandler(handler, make_steps())))
+
+    if handler_factory is CountingHandler:
+        # 屏蔽用户改成处理消息模型，需要先构造消息模型。处理消息模型的步骤要求消息处理器是BaseHandler
+        handler = handler_factory()
+        steps = make_steps()
+        steps[1] = middleware.FilterStep(
+            lambda message: message.uid not in BLOCKED_UIDS, model_type=web_models.DanmakuMessage
+        )
+        configs.append(('middleware (model)', handler, middleware.MiddlewareHandler(handler, steps)))
+
+    # 步骤都不处理这批消息的cmd时应该和没有步骤一样
+    handler = handler_factory()
+    if handler_factory is CountingHandler:
+        unrelated_step = middleware.FilterStep(lambda message: True, model_type=web_models.SuperChatDeleteMessage)
+    else:
+        unrelated_step = middleware.FilterStep(lambda command: True, cmds=['SUPER_CHAT_MESSAGE_DELETE'])
+    configs.append(('unrelated steps', handler, middleware.MiddlewareHandler(handler, [
+        middleware.SampleStep(0.5, cmds=['GUARD_BUY']),
+        unrelated_step,
+    ])))
+    return configs
+
+
+def measure_once(handler: blivedm.HandlerInterface, client: ws_base.WebSocketClientBase, commands: List[dict]) -> float:
+    start_time = time.perf_counter()
+    for command in commands:
+        handler.handle(client, command)
+    return time.perf_counter() - start_time
+
+
+async def run(args):
+    commands = frames.make_commands(frames.CMD_MIXES[args.mix], args.messages)
+    client = blivedm.BLiveClient(1)
+    client._room_id = 1  # noqa
+    handler_factory = CountingCommandHandler if args.no_models else CountingHandler
+    configs = make_configs(handler_factory)
+    best_times = [float('inf')] * len(configs)
+    gc.disable()
+    try:
+        # 每轮交替测各个配置，取最短耗时。去重步骤第一轮之后会丢弃所有带ID的消息，所以每轮重新创建
+        for _ in range(args.rounds):
+            configs = make_configs(handler_factory)
+            for index, (name, counter, handler) in enumerate(configs):
+                best_times[index] = min(best_times[index], measure_once(handler, client, commands))
+    finally:
+        gc.enable()
+        await client.close()
+
+    baseline = best_times[0]
+    print(f'{args.messages} commands, mix={args.mix}, best of {args.rounds} rounds, '
+          f'handler={handler_factory.__name__}')
+    for (name, counter, _), elapsed in zip(configs, best_times):
+        print(f'  {name:<18} {elapsed / args.messages * 1e9:8.0f} ns/msg  {elapsed / baseline * 100 - 100:+6.1f}%  '
+              f'delivered={counter.count}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--mix', default='typical', choices=list(frames.CMD_MIXES.keys()))
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--no-models', action='store_true', help='消息处理器只实现handle，不构造消息模型')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""
+本地模拟的B站弹幕服务器，用来离线做压力测试和长时间稳定性测试
+
+实现了web端初始化房间的HTTP接口、开放平台的开启/心跳/关闭项目接口、弹幕服务器的AUTH、HEARTBEAT和按速率推送的消息流，
+还可以注入断线、认证慢、token无效、项目心跳返回7003等故障::
+
+    python -m benchmarks.mock_server --port 18100 --rate 20 --drop-rate 0.01
+
+运行时可以通过HTTP接口修改配置或者触发故障::
+
+    curl http://127.0.0.1:18100/mock/stats
+    curl -X POST http://127.0.0.1:18100/mock/config -d '{"bad_token_rate": 0.5}'
+    curl -X POST http://127.0.0.1:18100/mock/drop_all
+    curl -X POST http://127.0.0.1:18100/mock/expire_tokens
+    curl -X POST http://127.0.0.1:18100/mock/end_games
+
+客户端要用patch_urls把初始化房间的URL指到本服务器，web端客户端要用MockBLiveClient，因为真实的客户端只会用wss连接
+"""
+import argparse
+import asyncio
+import dataclasses
+import itertools
+import json
+import logging
+import random
+import uuid
+from typing import *
+
+import aiohttp
+import aiohttp.web
+
+import blivedm
+from blivedm.clients import open_live, web, ws_base
+from . import frames
+
+__all__ = (
+    'MockConfig',
+    'MockServer',
+    'MockBLiveClient',
+    'patch_urls',
+)
+
+logger = logging.getLogger('blivedm.mock_server')
+
+WBI_IMG_URL = 'https://i0.hdslb.com/bfs/wbi/7cd084941338484aae1ad9425b84077c.png'
+WBI_SUB_URL = 'https://i0.hdslb.com/bfs/wbi/4932caff0ff746eab6f01bf08b70ac45.png'
+FRAME_POOL_MESSAGE_COUNT = 2000
+"""预先生成多少条业务消息，推送时循环使用，这样推送不用实时压缩"""
+
+
+@dataclasses.dataclass
+class MockConfig:
+    """
+    模拟服务器的配置，运行时可以通过POST /mock/config修改
+    """
+
+    message_rate: float = 10.0
+    """每个连接每秒推送的业务消息数，0表示不推送"""
+    messages_per_frame: int = 10
+    """每个WebSocket消息包含的业务消息数"""
+    cmd_mix: str = 'typical'
+    """web端连接推送的消息组合，见frames.CMD_MIXES，开放平台连接固定推送开放平台弹幕"""
+    popularity: int = 1
+    """心跳回复里的人气值"""
+
+    drop_rate: float = 0.0
+    """故障注入：每个连接每秒被直接断开的概率"""
+    auth_delay: float = 0.0
+    """故障注入：回复认证包之前等待的时间（秒）"""
+    bad_token_rate: float = 0.0
+    """故障注入：认证时即使token有效也回复token错误的概率"""
+    game_heartbeat_7003_rate: float = 0.0
+    """故障注入：开放平台项目心跳返回7003（项目已关闭）的概率"""
+    game_end_delay: float = 0.0
+    """故障注入：开放平台关闭项目接口回复之前等待的时间（秒），用来检查客户端的并发数限制"""
+
+
+class _Connection:
+    def __init__(self, websocket: aiohttp.web.WebSocketResponse, request: aiohttp.web.Request):
+        self.websocket = websocket
+        self.request = request
+        self.room_id: Optional[int] = None
+        self.game_id: Optional[str] = None
+        """开放平台连接的项目场次ID，web端连接是None"""
+        self.push_future: Optional[asyncio.Future] = None
+
+    @property
+    def is_open_live(self):
+        return self.game_id is not None
+
+    def abort(self):
+        """
+        直接断开TCP连接，不发送关闭帧，模拟网络故障
+        """
+        transport = self.request.transport
+        if transport is not None:
+            transport.abort()
+
+
+class MockServer:
+    """
+    模拟的B站弹幕服务器
+
+    :param config: 配置
+    :param host: 返回给客户端的弹幕服务器地址
+    :param port: 返回给客户端的弹幕服务器端口
+    """
+
+    def __init__(self, config: MockConfig, host='127.0.0.1', port=18100):
+        self._config = config
+        self._host = host
+        self._port = port
+
+        self._valid_tokens: Set[str] = set()
+        """web端发出去的有效token"""
+        self._auth_code_to_room_id: Dict[str, int] = {}
+        """主播身份码 -> 房间ID"""
+        self._games: Dict[str, int] = {}
+        """开放平台进行中的项目场次ID -> 房间ID"""
+        self._connections: Set[_Connection] = set()
+        """已认证的连接"""
+        self._frame_pools: Dict[bool, List[bytes]] = {}
+        """是否开放平台 -> 循环推送的WebSocket消息"""
+        self._game_end_in_flight_count = 0
+        """正在处理的关闭项目请求数"""
+
+        self._stats = {
+            'connection_count': 0,
+            'auth_count': 0,
+            'auth_rejected_count': 0,
+            'dropped_count': 0,
+            'frame_count': 0,
+            'room_init_count': 0,
+            'danmaku_server_conf_count': 0,
+            'game_start_count': 0,
+            'game_heartbeat_count': 0,
+            'game_heartbeat_7003_count': 0,
+            'game_end_count': 0,
+            'game_end_max_in_flight_count': 0,
+        }
+        self._build_frame_pools()
+
+    def _build_frame_pools(self):
+        web_commands = frames.make_commands(frames.CMD_MIXES[self._config.cmd_mix], FRAME_POOL_MESSAGE_COUNT)
+        open_live_commands = frames.make_commands(frames.CMD_MIXES['open_live'], FRAME_POOL_MESSAGE_COUNT)
+        messages_per_frame = max(self._config.messages_per_frame, 1)
+        self._frame_pools = {
+            # web端用brotli，开放平台用zlib
+            False: frames.make_frames(web_commands, messages_per_frame, ws_base.ProtoVer.BROTLI),
+            True: frames.make_frames(open_live_commands, messages_per_frame, ws_base.ProtoVer.DEFLATE),
+        }
+
+    def make_app(self) -> aiohttp.web.Application:
+        app = aiohttp.web.Application()
+        app.router.add_get('/', self._on_buvid_init)
+        app.router.add_get('/x/web-interface/nav', self._on_nav)
+        app.router.add_get('/room/v1/Room/get_info', self._on_room_init)
+        app.router.add_get('/xlive/web-room/v1/index/getDanmuInfo', self._on_danmaku_server_conf)
+        app.router.add_post('/v2/app/start', self._on_game_start)
+        app.router.add_post('/v2/app/heartbeat', self._on_game_heartbeat)
+        app.router.add_post('/v2/app/end', self._on_game_end)
+        app.router.add_get('/sub', self._on_websocket)
+
+        app.router.add_get('/mock/stats', self._on_stats)
+        app.router.add_post('/mock/config', self._on_config)
+        app.router.add_post('/mock/drop_all', self._on_drop_all)
+        app.router.add_post('/mock/expire_tokens', self._on_expire_tokens)
+        app.router.add_post('/mock/end_games', self._on_end_games)
+        return app
+
+    #
+    # web端HTTP接口
+    #
+
+    async def _on_buvid_init(self, _request):
+        res = aiohttp.web.Response(text='')
+        res.set_cookie('buvid3', f'{uuid.uuid4()}infoc')
+        return res
+
+    async def _on_nav(self, _request):
+        return aiohttp.web.json_response({
+            'code': -101,
+            'message': '账号未登录',
+            'data': {'isLogin': False, 'wbi_img': {'img_url': WBI_IMG_URL, 'sub_url': WBI_SUB_URL}},
+        })
+
+    async def _on_room_init(self, request: aiohttp.web.Request):
+        self._stats['room_init_count'] += 1
+        room_id = int(request.query['room_id'])
+        return aiohttp.web.json_response({'code': 0, 'message': 'ok', 'data': {'room_id': room_id, 'uid': room_id}})
+
+    async def _on_danmaku_server_conf(self, request: aiohttp.web.Request):
+        self._stats['danmaku_server_conf_count'] += 1
+        if 'w_rid' not in request.query:
+            return aiohttp.web.json_response({'code': -352, 'message': '-352', 'data': None})
+        token = uuid.uuid4().hex
+        self._valid_tokens.add(token)
+        return aiohttp.web.json_response({'code': 0, 'message': '0', 'data': {
+            'token': token,
+            'host_list': [{'host': self._host, 'port': self._port, 'wss_port': self._port, 'ws_port': self._port}],
+        }})
+
+    #
+    # 开放平台HTTP接口
+    #
+
+    @staticmethod
+    def _open_live_response(code=0, message='0', data=None):
+        return aiohttp.web.json_response({
+            'code': code, 'message': message, 'request_id': uuid.uuid4().hex, 'data': data or {}
+        })
+
+    async def _on_game_start(self, request: aiohttp.web.Request):
+        self._stats['game_start_count'] += 1
+        body = await request.json()
+        auth_code = body['code']
+        room_id = self._auth_code_to_room_id.get(auth_code, None)
+        if room_id is None:
+            room_id = self._auth_code_to_room_id[auth_code] = 100000 + len(self._auth_code_to_room_id)
+
+        game_id = str(uuid.uuid4())
+        self._games[game_id] = room_id
+        token = uuid.uuid4().hex
+        self._valid_tokens.add(token)
+        return self._open_live_response(data={
+            'game_info': {'game_id': game_id},
+            'websocket_info': {
+                'auth_body': json.dumps({'roomid': room_id, 'key': token, 'game_id': game_id}),
+                'wss_link': [f'ws://{self._host}:{self._port}/sub'],
+            },
+            'anchor_info': {
+                'room_id': room_id,
+                'uname': f'主播{room_id}',
+                'uface': frames.FACE_URL,
+                'uid': room_id,
+                'open_id': f'{room_id:032x}',
+            },
+        })
+
+    async def _on_game_heartbeat(self, request: aiohttp.web.Request):
+        self._stats['game_heartbeat_count'] += 1
+        body = await request.json()
+        game_id = body['game_id']
+        if game_id in self._games and random.random() < self._config.game_heartbeat_7003_rate:
+            self._end_game(game_id)
+        if game_id not in self._games:
+            self._stats['game_heartbeat_7003_count'] += 1
+            return self._open_live_response(7003, '心跳过期或GameId错误')
+        return self._open_live_response()
+
+    async def _on_game_end(self, request: aiohttp.web.Request):
+        self._stats['game_end_count'] += 1
+        self._game_end_in_flight_count += 1
+        self._stats['game_end_max_in_flight_count'] = max(
+            self._stats['game_end_max_in_flight_count'], self._game_end_in_flight_count
+        )
+        try:
+            body = await request.json()
+            if self._config.game_end_delay > 0:
+                await asyncio.sleep(self._config.game_end_delay)
+        finally:
+            self._game_end_in_flight_count -= 1
+        if self._games.pop(body['game_id'], None) is None:
+            return self._open_live_response(7000, '项目未开启')
+        return self._open_live_response()
+
+    def _end_game(self, game_id: str):
+        """
+        服务器关闭项目，推送LIVE_OPEN_PLATFORM_INTERACTION_END
+        """
+        self._games.pop(game_id, None)
+        packet = frames.make_packet({'cmd': 'LIVE_OPEN_PLATFORM_INTERACTION_END', 'data': {'game_id': game_id}})
+        for connection in list(self._connections):
+            if connection.game_id == game_id:
+                asyncio.create_task(self._send(connection, packet))
+
+    #
+    # 弹幕服务器
+    #
+
+    async def _on_websocket(self, request: aiohttp.web.Request):
+        websocket = aiohttp.web.WebSocketResponse()
+        await websocket.prepare(request)
+        self._stats['connection_count'] += 1
+        connection = _Connection(websocket, request)
+        try:
+            async for message in websocket:
+                if message.type != aiohttp.WSMsgType.BINARY:
+                    continue
+                header = ws_base.HeaderTuple(*ws_base.HEADER_STRUCT.unpack_from(message.data))
+                body = message.data[header.raw_header_size:header.pack_len]
+                if header.operation == ws_base.Operation.AUTH:
+                    await self._on_auth(connection, body)
+                elif header.operation == ws_base.Operation.HEARTBEAT:
+                    await self._send(connection, frames.make_packet(
+                        self._config.popularity.to_bytes(4, 'big'),
+                        ws_base.Operation.HEARTBEAT_REPLY,
+                        ws_base.ProtoVer.HEARTBEAT,
+                    ))
+        finally:
+            self._connections.discard(connection)
+            if connection.push_future is not None:
+                connection.push_future.cancel()
+        return websocket
+
+    async def _on_auth(self, connection: _Connection, body: bytes):
+        if self._config.auth_delay > 0:
+            await asyncio.sleep(self._config.auth_delay)
+
+        auth_params = json.loads(body)
+        token = auth_params.get('key', None)
+        game_id = auth_params.get('game_id', None)
+        is_valid = (
+            token in self._valid_tokens
+            and (game_id is None or game_id in self._games)
+            and random.random() >= self._config.bad_token_rate
+        )
+        if not is_valid:
+            self._stats['auth_rejected_count'] += 1
+            await self._send(connection, frames.make_packet({'code': ws_base.AuthReplyCode.TOKEN_ERROR},
+                                                            ws_base.Operation.AUTH_REPLY))
+            return
+
+        self._stats['auth_count'] += 1
+        connection.room_id = auth_params['roomid']
+        connection.game_id = game_id
+        self._connections.add(connection)
+        await self._send(connection, frames.make_packet({'code': ws_base.AuthReplyCode.OK},
+                                                        ws_base.Operation.AUTH_REPLY))
+        connection.push_future = asyncio.create_task(self._push_coroutine(connection))
+
+    async def _push_coroutine(self, connection: _Connection):
+        frame_pool = self._frame_pools[connection.is_open_live]
+        # 每个连接从随机位置开始，避免所有连接同时发一样的消息
+        frame_iter = itertools.islice(itertools.cycle(frame_pool), random.randrange(len(frame_pool)), None)
+        while not connection.websocket.closed:
+            config = self._config
+            if config.message_rate <= 0:
+                await asyncio.sleep(1)
+                continue
+            interval = config.messages_per_frame / config.message_rate
+            # 加点抖动，避免所有连接同时发
+            await asyncio.sleep(interval * random.uniform(0.5, 1.5))
+
+            if config.drop_rate > 0 and random.random() < config.drop_rate * interval:
+                self._stats['dropped_count'] += 1
+                connection.abort()
+                return
+            await self._send(connection, next(frame_iter))
+            self._stats['frame_count'] += 1
+
+    @staticmethod
+    async def _send(connection: _Connection, data: bytes):
+        try:
+            await connection.websocket.send_bytes(data)
+        except (ConnectionResetError, RuntimeError):
+            # 已经断开了
+            pass
+
+    #
+    # 控制接口
+    #
+
+    async def _on_stats(self, _request):
+        return aiohttp.web.json_response({
+            **self._stats,
+            'authed_connection_count': len(self._connections),
+            'valid_token_count': len(self._valid_tokens),
+            'game_count': len(self._games),
+            'config': dataclasses.asdict(self._config),
+        })
+
+    async def _on_config(self, request: aiohttp.web.Request):
+        updates = await request.json()
+        fields = {field.name for field in dataclasses.fields(MockConfig)}
+        unknown_fields = set(updates) - fields
+        if unknown_fields:
+            return aiohttp.web.json_response({'error': f'unknown fields: {sorted(unknown_fields)}'}, status=400)
+        self._config = dataclasses.replace(self._config, **updates)
+        if 'cmd_mix' in updates or 'messages_per_frame' in updates:
+            self._build_frame_pools()
+        return aiohttp.web.json_response(dataclasses.asdict(self._config))
+
+    async def _on_drop_all(self, _request):
+        """
+        断开所有连接，模拟服务器故障引起的重连风暴
+        """
+        count = len(self._connections)
+        for connection in list(self._connections):
+            self._connections.discard(connection)
+            connection.abort()
+        self._stats['dropped_count'] += count
+        return aiohttp.web.json_response({'dropped': count})
+
+    async def _on_expire_tokens(self, _request):
+        """
+        让所有token失效，已连接的不受影响，重连时认证失败
+        """
+        count = len(self._valid_tokens)
+        self._valid_tokens.clear()
+        return aiohttp.web.json_response({'expired': count})
+
+    async def _on_end_games(self, _request):
+        """
+        关闭所有开放平台项目，客户端会收到LIVE_OPEN_PLATFORM_INTERACTION_END，项目心跳会返回7003
+        """
+        game_ids = list(self._games)
+        for game_id in game_ids:
+            self._end_game(game_id)
+        return aiohttp.web.json_response({'ended': len(game_ids)})
+
+
+#
+# 客户端
+#
+
+class MockBLiveClient(blivedm.BLiveClient):
+    """
+    连接到模拟服务器的web端客户端，真实的客户端只会用wss连接，这里改成ws
+    """
+
+    def _get_ws_url(self, retry_count) -> str:
+        host_server = self._host_server_list[retry_count % len(self._host_server_list)]
+        return f"ws://{host_server['host']}:{host_server['ws_port']}/sub"
+
+
+def patch_urls(base_url: str):
+    """
+    把web端和开放平台初始化房间用的URL指到模拟服务器，影响本进程所有客户端
+
+    :param base_url: 模拟服务器的URL，例如http://127.0.0.1:18100
+    """
+    base_url = base_url.rstrip('/')
+    web.UID_INIT_URL = f'{base_url}/x/web-interface/nav'
+    web.WBI_INIT_URL = web.UID_INIT_URL
+    web.BUVID_INIT_URL = f'{base_url}/'
+    web.ROOM_INIT_URL = f'{base_url}/room/v1/Room/get_info'
+    web.DANMAKU_SERVER_CONF_URL = f'{base_url}/xlive/web-room/v1/index/getDanmuInfo'
+    open_live.START_URL = f'{base_url}/v2/app/start'
+    open_live.HEARTBEAT_URL = f'{base_url}/v2/app/heartbeat'
+    open_live.END_URL = f'{base_url}/v2/app/end'
+
+
+def run_server(config: MockConfig, host: str, port: int):
+    server = MockServer(config, host, port)
+    aiohttp.web.run_app(server.make_app(), host=host, port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18100)
+    parser.add_argument('--rate', type=float, default=10, help='每个连接每秒推送的业务消息数')
+    parser.add_argument('--messages-per-frame', type=int, default=10)
+    parser.add_argument('--cmd-mix', default='typical', choices=list(frames.CMD_MIXES.keys()))
+    parser.add_argument('--drop-rate', type=float, default=0, help='每个连接每秒被断开的概率')
+    parser.add_argument('--auth-delay', type=float, default=0, help='回复认证包之前等待的时间（秒）')
+    parser.add_argument('--bad-token-rate', type=float, default=0, help='认证时回复token错误的概率')
+    parser.add_argument('--game-heartbeat-7003-rate', type=float, default=0, help='项目心跳返回7003的概率')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = MockConfig(
+        message_rate=args.rate,
+        messages_per_frame=args.messages_per_frame,
+        cmd_mix=args.cmd_mix,
+        drop_rate=args.drop_rate,
+        auth_delay=args.auth_delay,
+        bad_token_rate=args.bad_token_rate,
+        game_heartbeat_7003_rate=args.game_heartbeat_7003_rate,
+    )
+    logger.info('mock server listening on http://%s:%d', args.host, args.port)
+    run_server(config, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+对比每个房间一个连接和多房间共用一个连接（MultiplexClient）时的连接数和内存占用
+
+服务器是本地的协议替身，在子进程运行，所以测到的内存只包括客户端::
+
+    python -m benchmarks.multiplex_rooms --rooms 1000
+    python -m benchmarks.multiplex_rooms --rooms 1000 --reject-register
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+import tracemalloc
+from typing import *
+
+import aiohttp
+import aiohttp.web
+
+import blivedm
+from blivedm.clients import ws_base
+
+HOST = '127.0.0.1'
+
+
+def make_packet(data: Union[dict, bytes], operation: int, seq_id=1) -> bytes:
+    body = json.dumps(data).encode('utf-8') if isinstance(data, dict) else data
+    ver = ws_base.ProtoVer.HEARTBEAT if operation == ws_base.Operation.HEARTBEAT_REPLY else ws_base.ProtoVer.NORMAL
+    header = ws_base.HEADER_STRUCT.pack(*ws_base.HeaderTuple(
+        pack_len=ws_base.HEADER_STRUCT.size + len(body),
+        raw_header_size=ws_base.HEADER_STRUCT.size,
+        ver=ver,
+        operation=operation,
+        seq_id=seq_id,
+    ))
+    return header + body
+
+
+#
+# 协议替身
+#
+
+class StandInServer:
+    """
+    只实现了AUTH、REGISTER、HEARTBEAT的协议替身。认证或者注册成功后给这个房间推一条消息，包头带上注册时的seq_id
+    """
+
+    def __init__(self, reject_register: bool):
+        self._reject_register = reject_register
+        self._connection_count = 0
+
+    def make_app(self):
+        app = aiohttp.web.Application()
+        app.router.add_get('/sub', self._on_websocket)
+        app.router.add_get('/stats', self._on_stats)
+        return app
+
+    async def _on_stats(self, _request):
+        return aiohttp.web.json_response({'connection_count': self._connection_count})
+
+    async def _on_websocket(self, request):
+        websocket = aiohttp.web.WebSocketResponse()
+        await websocket.prepare(request)
+        self._connection_count += 1
+        try:
+            async for message in websocket:
+                if message.type != aiohttp.WSMsgType.BINARY:
+                    continue
+                header = ws_base.HeaderTuple(*ws_base.HEADER_STRUCT.unpack_from(message.data))
+                body = message.data[header.raw_header_size:header.pack_len]
+                if header.operation == ws_base.Operation.AUTH:
+                    room_id = json.loads(body)['roomid']
+                    await websocket.send_bytes(make_packet({'code': 0}, ws_base.Operation.AUTH_REPLY))
+                    await self._push_room_message(websocket, room_id, 1)
+                elif header.operation == ws_base.Operation.REGISTER:
+                    room_id = json.loads(body)['roomid']
+                    code = -1 if self._reject_register else 0
+                    await websocket.send_bytes(make_packet({'code': code}, ws_base.Operation.REGISTER_REPLY,
+                                                           header.seq_id))
+                    if code == 0:
+                        await self._push_room_message(websocket, room_id, header.seq_id)
+                elif header.operation == ws_base.Operation.HEARTBEAT:
+                    await websocket.send_bytes(make_packet(b'\x00\x00\x00\x01', ws_base.Operation.HEARTBEAT_REPLY))
+        finally:
+            self._connection_count -= 1
+        return websocket
+
+    @staticmethod
+    async def _push_room_message(websocket, room_id, seq_id):
+        command = {'cmd': 'BENCHMARK_ROOM_MESSAGE', 'data': {'roomid': room_id}}
+        await websocket.send_bytes(make_packet(command, ws_base.Operation.SEND_MSG_REPLY, seq_id))
+
+
+def run_server(port, reject_register):
+    aiohttp.web.run_app(StandInServer(reject_register).make_app(), host=HOST, port=port, print=None)
+
+
+#
+# 客户端
+#
+
+class StandInBLiveClient(blivedm.BLiveClient):
+    """
+    不访问B站接口，直接连接协议替身的客户端
+    """
+
+    def __init__(self, room_id: int, port: int, **kwargs):
+        super().__init__(room_id, uid=0, **kwargs)
+        self._port = port
+
+    async def init_room(self):
+        self._room_id = self._tmp_room_id
+        self._room_owner_uid = 0
+        self._host_server_list = [{'host': HOST, 'port': self._port, 'wss_port': self._port, 'ws_port': self._port}]
+        self._host_server_token = 'benchmark'
+        return True
+
+    def _get_buvid(self):
+        return ''
+
+    def _get_ws_url(self, retry_count) -> str:
+        return f'ws://{HOST}:{self._port}/sub'
+
+
+class CountingHandler(blivedm.BaseHandler):
+    def __init__(self):
+        self.received_room_ids: Set[int] = set()
+        self.misattributed_count = 0
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        if command.get('cmd', '') != 'BENCHMARK_ROOM_MESSAGE':
+            return
+        room_id = command['data']['roomid']
+        if room_id != client.room_id:
+            self.misattributed_count += 1
+        self.received_room_ids.add(room_id)
+
+
+async def run_clients(mode: str, room_count: int, port: int, timeout: float):
+    room_ids = list(range(1, room_count + 1))
+    handler = CountingHandler()
+
+    tracemalloc.start()
+    # 默认的连接池最多100个连接，每个WebSocket连接都会占用一个
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+    clients = [StandInBLiveClient(room_id, port, session=session) for room_id in room_ids]
+    if mode == 'multiplex':
+        running_clients = [blivedm.MultiplexClient(clients)]
+    else:
+        running_clients = clients
+    start_time = time.perf_counter()
+    for client in running_clients:
+        client.set_handler(handler)
+        client.start()
+
+    try:
+        while len(handler.received_room_ids) < room_count and time.perf_counter() - start_time < timeout:
+            await asyncio.sleep(0.05)
+        ready_time = time.perf_counter() - start_time
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+
+        async with session.get(f'http://{HOST}:{port}/stats') as res:
+            stats = await res.json()
+    finally:
+        await asyncio.gather(*(client.stop_and_close() for client in running_clients))
+        await session.close()
+        tracemalloc.stop()
+
+    print(f'mode={mode}')
+    print(f'  rooms ready:          {len(handler.received_room_ids)}/{room_count} in {ready_time:.2f}s')
+    print(f'  misattributed:        {handler.misattributed_count}')
+    print(f'  server connections:   {stats["connection_count"]}')
+    print(f'  client memory:        {current_memory / 1024 / 1024:.1f} MiB (peak {peak_memory / 1024 / 1024:.1f} MiB)')
+    print(f'  memory per room:      {current_memory / room_count / 1024:.1f} KiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--reject-register', action='store_true', help='协议替身拒绝REGISTER，测试退回到单独连接')
+    parser.add_argument('--mode', choices=('per-room', 'multiplex', 'both'), default='both')
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=run_server, args=(args.port, args.reject_register), daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        modes = ('per-room', 'multiplex') if args.mode == 'both' else (args.mode,)
+        for mode in modes:
+            asyncio.run(run_clients(mode, args.rooms, args.port, args.timeout))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+sans-IO协议解析基准测试：不用事件循环，直接在循环里调用Protocol.receive_message，和客户端的
+_parse_ws_message对比（客户端不设置消息处理器，解压在线程池执行）。两边都只解析到业务消息dict为止::
+
+    python -m benchmarks.protocol_parse
+    python -m benchmarks.protocol_parse --messages 20000 --frame-sizes 10 100
+"""
+import argparse
+import asyncio
+import time
+from typing import *
+
+import blivedm
+from blivedm.clients import protocol
+from . import frames
+from .throughput import VERS
+
+
+def run_protocol(frame_list: List[bytes], repeat: int) -> Tuple[float, int]:
+    """
+    :return: (最短耗时（秒）, 业务消息数)
+    """
+    best_time = float('inf')
+    command_count = 0
+    for _ in range(repeat):
+        proto = protocol.Protocol()
+        command_count = 0
+        start_time = time.perf_counter()
+        for frame in frame_list:
+            for event in proto.receive_message(frame):
+                if isinstance(event, protocol.CommandEvent):
+                    command_count += 1
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return best_time, command_count
+
+
+async def run_client(frame_list: List[bytes], repeat: int) -> float:
+    """
+    :return: 最短耗时（秒）
+    """
+    client = blivedm.BLiveClient(1)
+    client._room_id = 1  # noqa
+    try:
+        best_time = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            for frame in frame_list:
+                await client._parse_ws_message(frame)  # noqa
+            best_time = min(best_time, time.perf_counter() - start_time)
+    finally:
+        await client.close()
+    return best_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000, help='每个场景的业务消息数')
+    parser.add_argument('--repeat', type=int, default=5, help='测几次取最好的')
+    parser.add_argument('--vers', nargs='+', default=list(VERS.keys()), choices=list(VERS.keys()))
+    parser.add_argument('--mix', default='typical', choices=list(frames.CMD_MIXES.keys()))
+    parser.add_argument('--frame-sizes', nargs='+', type=int, default=[1, 10, 100],
+                        help='每个WebSocket消息包含的业务消息数')
+    args = parser.parse_args()
+
+    commands = frames.make_commands(frames.CMD_MIXES[args.mix], args.messages)
+    print(f'{"scenario":<20} {"protocol":>14} {"client":>14}  speedup')
+    for ver_name in args.vers:
+        for messages_per_frame in args.frame_sizes:
+            frame_list = frames.make_frames(commands, messages_per_frame, VERS[ver_name])
+            protocol_time, command_count = run_protocol(frame_list, args.repeat)
+            if command_count != args.messages:
+                raise RuntimeError(f'expected {args.messages} messages, got {command_count}')
+            client_time = asyncio.run(run_client(frame_list, args.repeat))
+            print(f'{ver_name + "/" + str(messages_per_frame):<20} {args.messages / protocol_time:>10.0f} msg/s '
+                  f'{args.messages / client_time:>10.0f} msg/s  {client_time / protocol_time:>6.2f}x')
+
+
+if __name__ == '__main__':
+    main()
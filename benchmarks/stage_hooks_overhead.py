@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+测量阶段钩子的开销：没有钩子、空钩子、计时钩子时解析同一批弹幕的耗时
+
+直接调用_parse_ws_message，不经过网络和解压，这样测到的主要是解析包头、JSON反序列化、分发、构造消息模型::
+
+    python -m benchmarks.stage_hooks_overhead
+    python -m benchmarks.stage_hooks_overhead --messages 200 --rounds 500
+"""
+import argparse
+import asyncio
+import collections
+import gc
+import time
+import timeit
+from typing import *
+
+import blivedm
+import blivedm.hooks
+from blivedm.clients import ws_base
+from . import frames
+
+
+def make_batch(message_count: int) -> bytes:
+    """
+    一个解压后的WebSocket消息，包含message_count条弹幕
+    """
+    commands = frames.make_commands(frames.CMD_MIXES['danmaku'], message_count)
+    return frames.make_frames(commands, message_count, ws_base.ProtoVer.NORMAL)[0]
+
+
+class DanmakuHandler(blivedm.BaseHandler):
+    def __init__(self):
+        self.count = 0
+
+    def _on_danmaku(self, client: ws_base.WebSocketClientBase, message: blivedm.models.web.DanmakuMessage):
+        self.count += 1
+
+
+class NoopHook(blivedm.hooks.StageHookInterface):
+    pass
+
+
+class TimingHook(blivedm.hooks.StageHookInterface):
+    def __init__(self):
+        self.stage_time: DefaultDict[blivedm.hooks.Stage, float] = collections.defaultdict(float)
+        self.stage_count: DefaultDict[blivedm.hooks.Stage, int] = collections.defaultdict(int)
+
+    def on_stage_begin(self, client, stage, info):
+        return time.perf_counter()
+
+    def on_stage_end(self, client, stage, info, context, exception):
+        self.stage_time[stage] += time.perf_counter() - context
+        self.stage_count[stage] += 1
+
+
+async def measure_once(client: ws_base.WebSocketClientBase, data: bytes) -> float:
+    start_time = time.perf_counter()
+    await client._parse_ws_message(data)  # noqa
+    return time.perf_counter() - start_time
+
+
+async def run(message_count: int, rounds: int):
+    data = make_batch(message_count)
+    client = blivedm.BLiveClient(1)
+    client._room_id = 1  # noqa
+    handler = DanmakuHandler()
+    client.set_handler(handler)
+
+    timing_hook = TimingHook()
+    configs = (('no hooks', None), ('noop hook', NoopHook()), ('timing hook', timing_hook))
+    best_times = [float('inf')] * len(configs)
+    gc.disable()
+    try:
+        # 预热
+        for _ in range(10):
+            await measure_once(client, data)
+
+        # 每轮交替测各个配置，取最短耗时，减少机器负载波动的影响
+        for _ in range(rounds):
+            for index, (name, hook) in enumerate(configs):
+                if hook is not None:
+                    client.add_stage_hook(hook)
+                best_times[index] = min(best_times[index], await measure_once(client, data))
+                if hook is not None:
+                    client.remove_stage_hook(hook)
+    finally:
+        gc.enable()
+        await client.close()
+    results = [(name, elapsed) for (name, _), elapsed in zip(configs, best_times)]
+
+    baseline = results[0][1]
+    print(f'{message_count} DANMU_MSG per frame, best of {rounds} rounds')
+    for name, elapsed in results:
+        print(f'  {name:<12} {elapsed / message_count * 1e9:8.0f} ns/msg  {elapsed / baseline * 100 - 100:+6.1f}%')
+
+    print('per-stage cost with timing hook:')
+    for stage, total in timing_hook.stage_time.items():
+        print(f'  {stage.name:<16} {total / timing_hook.stage_count[stage] * 1e9:8.0f} ns/call')
+
+    # 没有钩子时每个阶段只多了一次判断None，单独测一下它的开销
+    number = 10_000_000
+    check_time = timeit.timeit('x is None', setup='x = None', number=number) / number
+    empty_time = timeit.timeit('pass', number=number) / number
+    print(f'one "is None" check: {(check_time - empty_time) * 1e9:.1f} ns, 5 stages per message')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100, help='每个WebSocket消息包含的弹幕数')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.rounds))
+
+
+if __name__ == '__main__':
+    main()
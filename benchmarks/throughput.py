@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+离线吞吐量基准测试：把生成的WebSocket消息直接交给_parse_ws_message，经过解压、JSON反序列化、分发、构造消息模型
+
+对每种协议版本、消息组合、每个WebSocket消息包含的业务消息数，报告每秒消息数、各阶段耗时、内存峰值，
+然后和baseline.json对比::
+
+    python -m benchmarks.throughput
+    python -m benchmarks.throughput --quick
+    python -m benchmarks.throughput --save-baseline
+    python -m benchmarks.throughput --check --threshold 30
+"""
+import argparse
+import asyncio
+import collections
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import *
+
+import blivedm
+import blivedm.models.open_live as open_models
+import blivedm.models.web as web_models
+from blivedm.clients import ws_base
+from . import frames
+from .stage_hooks_overhead import TimingHook
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+VERS = {
+    'normal': ws_base.ProtoVer.NORMAL,
+    'deflate': ws_base.ProtoVer.DEFLATE,
+    'brotli': ws_base.ProtoVer.BROTLI,
+}
+
+
+class CountingHandler(blivedm.BaseHandler):
+    """
+    所有消息都构造成消息模型，只计数
+    """
+
+    def __init__(self):
+        self.counts: DefaultDict[str, int] = collections.defaultdict(int)
+
+    def _on_danmaku(self, client: ws_base.WebSocketClientBase, message: web_models.DanmakuMessage):
+        self.counts['DANMU_MSG'] += 1
+
+    def _on_gift(self, client: ws_base.WebSocketClientBase, message: web_models.GiftMessage):
+        self.counts['gift'] += 1
+
+    def _on_super_chat(self, client: ws_base.WebSocketClientBase, message: web_models.SuperChatMessage):
+        self.counts['SUPER_CHAT_MESSAGE'] += 1
+
+    def _on_interact_word_v2(self, client: ws_base.WebSocketClientBase, message: web_models.InteractWordV2Message):
+        self.counts['INTERACT_WORD_V2'] += 1
+
+    def _on_open_live_danmaku(self, client: ws_base.WebSocketClientBase, message: open_models.DanmakuMessage):
+        self.counts['LIVE_OPEN_PLATFORM_DM'] += 1
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+async def parse_all(client: ws_base.WebSocketClientBase, frame_list: List[bytes]) -> float:
+    """
+    :return: 耗时（秒）
+    """
+    start_time = time.perf_counter()
+    for frame in frame_list:
+        await client._parse_ws_message(frame)  # noqa
+    return time.perf_counter() - start_time
+
+
+async def run_scenario(frame_list: List[bytes], message_count: int, repeat: int) -> dict:
+    client = blivedm.BLiveClient(1)
+    client._room_id = 1  # noqa
+    handler = CountingHandler()
+    client.set_handler(handler)
+    try:
+        # 预热，同时检查所有消息都处理了
+        await parse_all(client, frame_list)
+        if handler.total != message_count:
+            raise RuntimeError(f'expected {message_count} messages, got {handler.total}')
+
+        # 吞吐量，取最短耗时
+        gc.collect()
+        best_time = min([await parse_all(client, frame_list) for _ in range(repeat)])
+
+        # 各阶段耗时
+        timing_hook = TimingHook()
+        client.add_stage_hook(timing_hook)
+        await parse_all(client, frame_list)
+        client.remove_stage_hook(timing_hook)
+
+        # 内存峰值，tracemalloc会拖慢速度，所以单独跑一次
+        gc.collect()
+        tracemalloc.start()
+        await parse_all(client, frame_list)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        await client.close()
+
+    return {
+        'messages_per_second': message_count / best_time,
+        'bytes_per_second': sum(len(frame) for frame in frame_list) / best_time,
+        'stage_ns_per_call': {
+            stage.name: total / timing_hook.stage_count[stage] * 1e9
+            for stage, total in timing_hook.stage_time.items()
+        },
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+async def run(message_count: int, repeat: int, vers: List[str], mixes: List[str], frame_sizes: List[int]) -> dict:
+    results = {}
+    for mix_name in mixes:
+        commands = frames.make_commands(frames.CMD_MIXES[mix_name], message_count)
+        for ver_name in vers:
+            for messages_per_frame in frame_sizes:
+                name = f'{ver_name}/{mix_name}/{messages_per_frame}'
+                frame_list = frames.make_frames(commands, messages_per_frame, VERS[ver_name])
+                result = results[name] = await run_scenario(frame_list, message_count, repeat)
+                print_result(name, result)
+    return results
+
+
+def print_result(name: str, result: dict):
+    stages = '  '.join(f'{stage}={ns:.0f}ns' for stage, ns in result['stage_ns_per_call'].items())
+    print(
+        f'{name:<24} {result["messages_per_second"]:>10.0f} msg/s '
+        f'{result["bytes_per_second"] / 1024 / 1024:>7.2f} MiB/s '
+        f'peak={result["peak_memory_bytes"] / 1024:>7.0f} KiB  {stages}'
+    )
+
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    :return: 退步超过阈值的场景
+    """
+    regressions = []
+    print(f'\ncompared with baseline ({baseline.get("python", "?")}, {baseline.get("platform", "?")}):')
+    for name, result in results.items():
+        base_result = baseline['results'].get(name, None)
+        if base_result is None:
+            continue
+        speed_delta = (result['messages_per_second'] / base_result['messages_per_second'] - 1) * 100
+        memory_delta = (result['peak_memory_bytes'] / max(base_result['peak_memory_bytes'], 1) - 1) * 100
+        is_regression = speed_delta < -threshold or memory_delta > threshold
+        if is_regression:
+            regressions.append(name)
+        print(f'{name:<24} speed {speed_delta:+6.1f}%  peak memory {memory_delta:+6.1f}%'
+              f'{"  REGRESSION" if is_regression else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000, help='每个场景的业务消息数')
+    parser.add_argument('--repeat', type=int, default=5, help='吞吐量测几次取最好的')
+    parser.add_argument('--vers', nargs='+', default=list(VERS.keys()), choices=list(VERS.keys()))
+    parser.add_argument('--mixes', nargs='+', default=list(frames.CMD_MIXES.keys()),
+                        choices=list(frames.CMD_MIXES.keys()))
+    parser.add_argument('--frame-sizes', nargs='+', type=int, default=[1, 10, 100],
+                        help='每个WebSocket消息包含的业务消息数')
+    parser.add_argument('--quick', action='store_true', help='少跑一些，用来快速检查')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='把结果保存为基线')
+    parser.add_argument('--threshold', type=float, default=20, help='速度下降或内存上升超过这个百分比算退步')
+    parser.add_argument('--check', action='store_true', help='有退步时返回非0')
+    args = parser.parse_args()
+
+    if args.quick:
+        args.messages = 1000
+        args.repeat = 3
+
+    results = asyncio.run(run(args.messages, args.repeat, args.vers, args.mixes, args.frame_sizes))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'messages': args.messages,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'\nbaseline saved to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'\nno baseline at {args.baseline}, run with --save-baseline first')
+        return
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    if regressions and args.check:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
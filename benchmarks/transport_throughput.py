@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+比较两种连接弹幕服务器的WebSocket实现（aiohttp和asyncio_ws）的吞吐量：在子进程启动模拟服务器，
+用同样的客户端数和推送速率分别跑一段时间，报告每秒收到的消息数和客户端每条消息消耗的CPU时间::
+
+    python -m benchmarks.transport_throughput
+    python -m benchmarks.transport_throughput --clients 200 --rate 500 --messages-per-frame 1 --rounds 3
+
+服务器和客户端在同一台机器上抢CPU，所以主要看每条消息的CPU时间，每秒消息数受服务器推送速度限制
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+from typing import *
+
+import aiohttp
+
+import blivedm
+import blivedm.metrics
+from blivedm.clients import net, ws_base
+from . import load_test, mock_server
+
+HOST = '127.0.0.1'
+
+TRANSPORTS = {
+    'aiohttp': ws_base.TransportType.AIOHTTP,
+    'asyncio': ws_base.TransportType.ASYNCIO,
+}
+
+
+async def run_transport(args, server_url: str, ws_transport: ws_base.TransportType) -> Optional[dict]:
+    """
+    :return: 统计结果，没有全部连上则返回None
+    """
+    registry = blivedm.metrics.MetricsRegistry()
+    # 模拟服务器是IP地址，默认的cookie jar不接受IP地址的cookie
+    session = aiohttp.ClientSession(
+        connector=net.get_shared_connector(),
+        connector_owner=False,
+        cookie_jar=aiohttp.CookieJar(unsafe=True),
+        timeout=aiohttp.ClientTimeout(total=30),
+    )
+    control_session = aiohttp.ClientSession()
+    clients = [load_test.create_client(args.kind, index, session, ws_transport) for index in range(args.clients)]
+    handler = blivedm.BaseHandler()
+    for client in clients:
+        client.set_handler(handler)
+        client.enable_metrics(registry)
+
+    base_stats = await load_test.get_server_stats(control_session, server_url)
+    for client in clients:
+        client.start()
+    try:
+        ready_time = await load_test.wait_for_connections(
+            control_session, server_url, args.clients, args.timeout, base_stats['auth_count'] + args.clients
+        )
+        if ready_time is None:
+            return None
+        # 等推送稳定
+        await asyncio.sleep(1)
+
+        total_before = registry.get_total_metrics()
+        cpu_time_before = time.process_time()
+        start_time = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        duration = time.perf_counter() - start_time
+        cpu_time = time.process_time() - cpu_time_before
+        total_after = registry.get_total_metrics()
+    finally:
+        await asyncio.gather(*(client.stop_and_close() for client in clients))
+        await session.close()
+        await control_session.close()
+        await net.close_shared_connectors()
+
+    message_count = sum(total_after.command_counts.values()) - sum(total_before.command_counts.values())
+    frame_count = total_after.frame_count - total_before.frame_count
+    return {
+        'messages_per_second': message_count / duration,
+        'frames_per_second': frame_count / duration,
+        'cpu_us_per_message': cpu_time / max(message_count, 1) * 1e6,
+        'cpu_usage': cpu_time / duration,
+        'reconnect_count': total_after.reconnect_count - total_before.reconnect_count,
+    }
+
+
+async def run(args, server_url: str) -> Dict[str, List[dict]]:
+    await load_test.wait_for_server(server_url, 30)
+    mock_server.patch_urls(server_url)
+    results: Dict[str, List[dict]] = {name: [] for name in args.transports}
+    # 轮流跑，减少机器状态变化的影响
+    for round_index in range(args.rounds):
+        for name in args.transports:
+            result = await run_transport(args, server_url, TRANSPORTS[name])
+            if result is None:
+                print(f'round {round_index + 1} {name:<8} timed out waiting for connections')
+                continue
+            results[name].append(result)
+            print(f'round {round_index + 1} {name:<8} {result["messages_per_second"]:>10.0f} msg/s '
+                  f'{result["frames_per_second"]:>9.0f} frames/s {result["cpu_us_per_message"]:>8.2f} us/msg '
+                  f'cpu={result["cpu_usage"] * 100:>5.1f}% reconnects={result["reconnect_count"]}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--kind', choices=('web', 'open_live'), default='web')
+    parser.add_argument('--transports', nargs='+', default=list(TRANSPORTS.keys()), choices=list(TRANSPORTS.keys()))
+    parser.add_argument('--port', type=int, default=18101)
+    parser.add_argument('--rate', type=float, default=200, help='每个连接每秒推送的业务消息数')
+    parser.add_argument('--messages-per-frame', type=int, default=1, help='每个WebSocket消息包含的业务消息数')
+    parser.add_argument('--duration', type=float, default=10, help='每轮收消息的时间（秒）')
+    parser.add_argument('--rounds', type=int, default=2, help='每种实现跑几轮，取每条消息CPU时间最少的一轮')
+    parser.add_argument('--timeout', type=float, default=60, help='等待全部连上的超时时间（秒）')
+    args = parser.parse_args()
+
+    load_test.raise_fd_limit()
+    config = mock_server.MockConfig(message_rate=args.rate, messages_per_frame=args.messages_per_frame)
+    server = multiprocessing.Process(target=mock_server.run_server, args=(config, HOST, args.port), daemon=True)
+    server.start()
+    try:
+        results = asyncio.run(run(args, f'http://{HOST}:{args.port}'))
+    finally:
+        server.terminate()
+
+    best = {
+        name: min(result_list, key=lambda result: result['cpu_us_per_message'])
+        for name, result_list in results.items() if result_list
+    }
+    print(f'\nbest of {args.rounds} rounds, clients={args.clients} kind={args.kind} rate={args.rate} '
+          f'messages_per_frame={args.messages_per_frame}:')
+    for name, result in best.items():
+        print(f'  {name:<8} {result["messages_per_second"]:>10.0f} msg/s {result["cpu_us_per_message"]:>8.2f} us/msg')
+    if 'aiohttp' in best and 'asyncio' in best:
+        print(f'  asyncio uses {best["asyncio"]["cpu_us_per_message"] / best["aiohttp"]["cpu_us_per_message"]:.2f}x '
+              f'the CPU time per message of aiohttp')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,48 @@
 # -*- coding: utf-8 -*-
 __version__ = '1.1.7'
 
-from .handlers import *
-from .clients import *
+from typing import TYPE_CHECKING
+
+from . import utils
+
+if TYPE_CHECKING:
+    from .handlers import *
+    from .bus import *
+    from .middleware import *
+    from .clients import *
+
+# 子模块在第一次访问时才导入，这样只用到一部分功能的进程不用加载aiohttp等重量级依赖
+_LAZY_ATTRS = {
+    # handlers
+    'HandlerInterface': 'handlers',
+    'BaseHandler': 'handlers',
+    # bus
+    'EventBus': 'bus',
+    # middleware
+    'MiddlewareHandler': 'middleware',
+    # clients
+    'BLiveClient': 'clients',
+    'OpenLiveClient': 'clients',
+    'GameSession': 'clients',
+    'GameSessionStoreInterface': 'clients',
+    'FileGameSessionStore': 'clients',
+    'OpenLiveManager': 'clients',
+    'MultiplexClient': 'clients',
+    'TransportType': 'clients',
+}
+
+__all__ = tuple(_LAZY_ATTRS)
+
+__getattr__, __dir__ = utils.make_lazy_module_attrs(__name__, globals(), _LAZY_ATTRS, (
+    'bus',
+    'clients',
+    'fanout',
+    'handlers',
+    'hooks',
+    'metrics',
+    'middleware',
+    'models',
+    'monitor',
+    'recording',
+    'sinks',
+))
@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+无界面的批量采集入口::
+
+    python -m blivedm rooms.txt -o stdout -o sqlite:danmaku.db
+
+房间列表文件可以是文本，每行一个房间ID，#开头的是注释；也可以是.json文件::
+
+    {
+        "rooms": [12235923, 14327465],
+        "sessdata": "",
+        "open_live": {
+            "access_key_id": "",
+            "access_key_secret": "",
+            "app_id": 0,
+            "auth_codes": ["主播身份码"]
+        }
+    }
+
+收到SIGHUP时重新读房间列表，只启动新增的房间、停止删除的房间，其他房间的连接不受影响
+"""
+import argparse
+import asyncio
+import dataclasses
+import http.cookies
+import json
+import logging
+import signal
+import sys
+import time
+from typing import *
+
+import aiohttp
+
+from . import handlers, metrics, monitor
+from .clients import net, open_live, web, ws_base
+from .sinks import sqlite
+
+logger = logging.getLogger('blivedm')
+
+
+@dataclasses.dataclass
+class OpenLiveConfig:
+    """
+    开放平台的开发者密钥和主播身份码
+    """
+
+    access_key_id: str
+    access_key_secret: str
+    app_id: int
+    auth_codes: List[str]
+
+
+@dataclasses.dataclass
+class RoomConfig:
+    """
+    房间列表文件的内容
+    """
+
+    room_ids: List[int]
+    """web端房间ID"""
+    sessdata: str = ''
+    """已登录账号的cookie的SESSDATA字段，不填也可以连接，但是用户名会打码"""
+    open_live: Optional[OpenLiveConfig] = None
+    """开放平台的配置"""
+
+    def get_client_keys(self) -> List[Tuple[str, Union[int, str]]]:
+        """
+        返回所有客户端的键，web端是('web', 房间ID)，开放平台是('open_live', 主播身份码)
+        """
+        keys: List[Tuple[str, Union[int, str]]] = [('web', room_id) for room_id in self.room_ids]
+        if self.open_live is not None:
+            keys.extend(('open_live', auth_code) for auth_code in self.open_live.auth_codes)
+        # 去重，保持顺序
+        return list(dict.fromkeys(keys))
+
+
+def load_room_config(path: str) -> RoomConfig:
+    """
+    读房间列表文件，格式见模块的文档
+
+    :param path: 文件路径，.json结尾的按JSON解析，否则按文本解析
+    """
+    with open(path, encoding='utf-8') as f:
+        content = f.read()
+
+    if not path.endswith('.json'):
+        room_ids = []
+        for line in content.splitlines():
+            line = line.split('#', 1)[0].strip()
+            if line != '':
+                room_ids.append(int(line))
+        return RoomConfig(room_ids=room_ids)
+
+    data = json.loads(content)
+    open_live_data = data.get('open_live', None)
+    return RoomConfig(
+        room_ids=[int(room_id) for room_id in data.get('rooms', [])],
+        sessdata=data.get('sessdata', ''),
+        open_live=OpenLiveConfig(
+            access_key_id=open_live_data['access_key_id'],
+            access_key_secret=open_live_data['access_key_secret'],
+            app_id=int(open_live_data['app_id']),
+            auth_codes=[str(auth_code) for auth_code in open_live_data.get('auth_codes', [])],
+        ) if open_live_data is not None else None,
+    )
+
+
+class JsonlOutput(handlers.HandlerInterface):
+    """
+    把业务消息写成JSON Lines，每行是{"recv_time": 接收时间戳, "room_id": 房间ID, "command": 业务消息}
+
+    写到文件的缓冲区，定时flush，不会每条消息都调用一次系统调用
+
+    :param file: 文本文件对象
+    :param flush_interval: flush的间隔时间（秒）
+    :param close_file: 停止时是否关闭文件
+    """
+
+    def __init__(self, file: TextIO, *, flush_interval: float = 1, close_file: bool = True):
+        self._file = file
+        self._flush_interval = flush_interval
+        self._close_file = close_file
+        self._flush_timer_handle: Optional[asyncio.TimerHandle] = None
+        """定时flush定时器的handle"""
+        self.written_count = 0
+        """写出的消息数"""
+
+    def start(self):
+        self._flush_timer_handle = asyncio.get_running_loop().call_later(self._flush_interval, self._on_flush)
+
+    def stop(self):
+        if self._flush_timer_handle is not None:
+            self._flush_timer_handle.cancel()
+            self._flush_timer_handle = None
+        self._file.flush()
+        if self._close_file:
+            self._file.close()
+
+    async def join(self):
+        pass
+
+    def get_stats(self) -> dict:
+        return {'written_count': self.written_count}
+
+    def _on_flush(self):
+        self._flush_timer_handle = asyncio.get_running_loop().call_later(self._flush_interval, self._on_flush)
+        try:
+            self._file.flush()
+        except OSError:
+            logger.exception('failed to flush output:')
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        self._file.write(json.dumps(
+            {'recv_time': time.time(), 'room_id': client.room_id, 'command': command}, ensure_ascii=False
+        ))
+        self._file.write('\n')
+        self.written_count += 1
+
+
+class _TeeHandler(handlers.HandlerInterface):
+    """
+    把业务消息依次交给多个消息处理器，一个出错不影响其他的
+    """
+
+    def __init__(self, handler_list: List[handlers.HandlerInterface]):
+        self._handlers = handler_list
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        for handler in self._handlers:
+            try:
+                handler.handle(client, command)
+            except Exception:  # noqa
+                logger.exception('room=%s %s failed to handle command=%s', client.room_id, type(handler).__name__,
+                                 command)
+
+    def on_client_stopped(self, client: ws_base.WebSocketClientBase, exception: Optional[Exception]):
+        for handler in self._handlers:
+            handler.on_client_stopped(client, exception)
+
+
+def create_output(spec: str):
+    """
+    根据命令行参数创建输出
+
+    :param spec: stdout、jsonl:文件路径、sqlite:文件路径
+    """
+    kind, _, path = spec.partition(':')
+    if kind == 'stdout':
+        return JsonlOutput(sys.stdout, close_file=False)
+    if path == '':
+        raise ValueError(f'output {spec!r} needs a path, e.g. {kind}:PATH')
+    if kind == 'jsonl':
+        return JsonlOutput(open(path, 'a', encoding='utf-8'))
+    if kind == 'sqlite':
+        return sqlite.SqliteSink(path)
+    raise ValueError(f'unknown output {spec!r}, expected stdout, jsonl:PATH or sqlite:PATH')
+
+
+class Ingester(handlers.HandlerInterface):
+    """
+    管理所有房间的客户端，启动时限制同时初始化的房间数，避免瞬间发出大量HTTP请求被风控
+
+    客户端因为异常停止时（比如init_room失败），等待restart_interval后重新排队启动
+
+    :param handler: 所有客户端共用的消息处理器
+    :param startup_concurrency: 最多同时初始化这么多个房间
+    :param startup_timeout: 一个房间初始化超过这个时间（秒）就不再占用名额，继续启动下一个
+    :param restart_interval: 客户端异常停止后等待这个时间（秒）再重新启动
+    :param ws_transport: 客户端连接弹幕服务器用的WebSocket实现
+    """
+
+    def __init__(
+        self,
+        handler: handlers.HandlerInterface,
+        *,
+        startup_concurrency: int = 8,
+        startup_timeout: float = 30,
+        restart_interval: float = 60,
+        ws_transport: ws_base.TransportType = ws_base.TransportType.AIOHTTP,
+    ):
+        self._handler = handler
+        self._ws_transport = ws_transport
+        self._startup_semaphore = asyncio.Semaphore(startup_concurrency)
+        self._startup_timeout = startup_timeout
+        self._restart_interval = restart_interval
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        """web端客户端共用的session"""
+        self._retired_sessions: List[aiohttp.ClientSession] = []
+        """SESSDATA修改前创建的session，还有客户端在用，关闭时才关闭"""
+        self._config: Optional[RoomConfig] = None
+        self._clients: Dict[Tuple[str, Union[int, str]], ws_base.WebSocketClientBase] = {}
+        """客户端的键 -> 客户端"""
+        self._client_keys: Dict[ws_base.WebSocketClientBase, Tuple[str, Union[int, str]]] = {}
+        """客户端 -> 客户端的键"""
+        self._startup_tasks: Set[asyncio.Task] = set()
+        """正在排队或者正在初始化的启动任务"""
+        self.metrics_registry = metrics.MetricsRegistry()
+        """所有客户端的统计数据"""
+
+    @property
+    def client_count(self) -> int:
+        return len(self._clients)
+
+    @property
+    def running_count(self) -> int:
+        """
+        已经初始化完，正在运行的客户端数
+        """
+        return sum(
+            1 for client in self._clients.values()
+            if client.is_running and client.room_id is not None
+        )
+
+    def apply_config(self, config: RoomConfig):
+        """
+        应用新的房间列表，启动新增的房间，停止删除的房间
+        """
+        if self._session is None or (self._config is not None and config.sessdata != self._config.sessdata):
+            if self._config is not None:
+                logger.warning('sessdata changed, it only applies to newly added rooms')
+            self._create_session(config.sessdata)
+        old_config = self._config
+        self._config = config
+
+        new_keys = config.get_client_keys()
+        new_key_set = set(new_keys)
+        removed_keys = [key for key in self._clients if key not in new_key_set]
+        if old_config is not None and old_config.open_live is not None and config.open_live != old_config.open_live:
+            # 开发者密钥变了，开放平台的房间都要重新连接
+            removed_keys.extend(
+                key for key in self._clients if key[0] == 'open_live' and key in new_key_set
+            )
+        for key in removed_keys:
+            client = self._clients.pop(key)
+            del self._client_keys[client]
+            asyncio.create_task(self._stop_client(key, client))
+
+        added_keys = [key for key in new_keys if key not in self._clients]
+        for key in added_keys:
+            client = self._clients[key] = self._create_client(key)
+            self._client_keys[client] = key
+            self._schedule_start_client(key, client, 0)
+
+        logger.info('room list applied, added=%d, removed=%d, total=%d', len(added_keys), len(removed_keys),
+                    len(self._clients))
+
+    def _create_session(self, sessdata: str):
+        old_session = self._session
+        cookies = http.cookies.SimpleCookie()
+        cookies['SESSDATA'] = sessdata
+        cookies['SESSDATA']['domain'] = 'bilibili.com'
+        # 和不传session的客户端（开放平台）共用连接池、DNS缓存和TLS会话缓存
+        self._session = aiohttp.ClientSession(
+            connector=net.get_shared_connector(),
+            connector_owner=False,
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+        self._session.cookie_jar.update_cookies(cookies)
+        if old_session is not None:
+            self._retired_sessions.append(old_session)
+
+    def _create_client(self, key: Tuple[str, Union[int, str]]) -> ws_base.WebSocketClientBase:
+        kind, value = key
+        if kind == 'web':
+            client = web.BLiveClient(value, session=self._session, ws_transport=self._ws_transport)
+        else:
+            open_live_config = self._config.open_live
+            client = open_live.OpenLiveClient(
+                access_key_id=open_live_config.access_key_id,
+                access_key_secret=open_live_config.access_key_secret,
+                app_id=open_live_config.app_id,
+                room_owner_auth_code=value,
+                ws_transport=self._ws_transport,
+            )
+        client.set_handler(self)
+        client.enable_metrics(self.metrics_registry)
+        return client
+
+    def _schedule_start_client(self, key: Tuple[str, Union[int, str]], client: ws_base.WebSocketClientBase,
+                               delay: float):
+        task = asyncio.create_task(self._start_client(key, client, delay))
+        self._startup_tasks.add(task)
+        task.add_done_callback(self._startup_tasks.discard)
+
+    async def _start_client(self, key: Tuple[str, Union[int, str]], client: ws_base.WebSocketClientBase,
+                            delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self._startup_semaphore:
+            if self._clients.get(key, None) is not client or client.is_running:
+                # 排队时被删除了
+                return
+            client.start()
+            # init_room在网络协程里调用，初始化完会设置room_id，等到这时候再放出名额
+            deadline = time.monotonic() + self._startup_timeout
+            while client.is_running and client.room_id is None and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            if client.room_id is None:
+                logger.warning('%s=%s is not initialized in %ss', key[0], key[1], self._startup_timeout)
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        self._handler.handle(client, command)
+
+    def on_client_stopped(self, client: ws_base.WebSocketClientBase, exception: Optional[Exception]):
+        self._handler.on_client_stopped(client, exception)
+        key = self._client_keys.get(client, None)
+        if exception is None or key is None:
+            # 正常停止或者已经被删除了
+            return
+        logger.warning('%s=%s stopped with exception, restarting in %ss', key[0], key[1], self._restart_interval)
+        self._schedule_start_client(key, client, self._restart_interval)
+
+    @staticmethod
+    async def _stop_client(key: Tuple[str, Union[int, str]], client: ws_base.WebSocketClientBase):
+        logger.info('stopping %s=%s', key[0], key[1])
+        try:
+            await client.stop_and_close()
+        except Exception:  # noqa
+            logger.exception('%s=%s failed to stop:', key[0], key[1])
+
+    async def close(self):
+        """
+        停止所有客户端并释放资源
+        """
+        for task in list(self._startup_tasks):
+            task.cancel()
+        clients = self._clients
+        self._clients = {}
+        self._client_keys = {}
+        await asyncio.gather(*(self._stop_client(key, client) for key, client in clients.items()))
+        sessions = self._retired_sessions
+        self._retired_sessions = []
+        if self._session is not None:
+            sessions.append(self._session)
+            self._session = None
+        for session in sessions:
+            await session.close()
+        # 所有客户端都关闭了，共享连接池也不再需要
+        await net.close_shared_connectors()
+
+
+class _StatsReporter:
+    """
+    定时打印吞吐量、事件循环延迟、重连次数和各个输出的统计
+    """
+
+    def __init__(self, ingester: Ingester, outputs: list, interval: float):
+        self._ingester = ingester
+        self._outputs = outputs
+        self._interval = interval
+        self._stall_monitor = monitor.StallMonitor(receive_timeout_warn_ratio=None)
+        """只用来采样事件循环延迟"""
+
+    async def run(self):
+        self._stall_monitor.start()
+        try:
+            last_time = time.monotonic()
+            last_total = self._ingester.metrics_registry.get_total_metrics()
+            while True:
+                await asyncio.sleep(self._interval)
+                now = time.monotonic()
+                total = self._ingester.metrics_registry.get_total_metrics()
+                self._report(now - last_time, last_total, total)
+                last_time = now
+                last_total = total
+        finally:
+            self._stall_monitor.stop()
+
+    def _report(self, duration: float, last_total: metrics.ClientMetrics, total: metrics.ClientMetrics):
+        command_count = sum(total.command_counts.values())
+        last_command_count = sum(last_total.command_counts.values())
+        parts = [
+            f'rooms={self._ingester.running_count}/{self._ingester.client_count}',
+            f'msgs/s={(command_count - last_command_count) / duration:.1f}',
+            f'frames/s={(total.frame_count - last_total.frame_count) / duration:.1f}',
+            f'KB/s={(total.byte_count - last_total.byte_count) / duration / 1024:.1f}',
+            f'reconnects={total.reconnect_count}(+{total.reconnect_count - last_total.reconnect_count})',
+            f'loop_lag_max={self._stall_monitor.max_lag:.3f}s',
+        ]
+        self._stall_monitor.reset()
+        for output in self._outputs:
+            stats = output.get_stats()
+            if isinstance(output, sqlite.SqliteSink):
+                parts.append(
+                    f'sqlite(written={stats["written_count"]}, backlog={stats["backlog"]}, '
+                    f'lag={stats["backlog_age"]:.3f}s, dropped={stats["dropped_count"]})'
+                )
+            else:
+                parts.append(f'jsonl(written={stats["written_count"]})')
+        logger.info('stats: %s', ' '.join(parts))
+
+
+async def run(args: argparse.Namespace):
+    outputs = [create_output(spec) for spec in (args.output or ['stdout'])]
+    for output in outputs:
+        output.start()
+    ingester = Ingester(
+        _TeeHandler(outputs),
+        startup_concurrency=args.startup_concurrency,
+        startup_timeout=args.startup_timeout,
+        restart_interval=args.restart_interval,
+        ws_transport=ws_base.TransportType[args.ws_transport.upper()],
+    )
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+
+    def reload_config():
+        try:
+            config = load_room_config(args.room_file)
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception('failed to reload %s, keeping the current room list', args.room_file)
+            return
+        ingester.apply_config(config)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows不支持
+            pass
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, reload_config)
+
+    stats_future = None
+    try:
+        ingester.apply_config(load_room_config(args.room_file))
+        if args.stats_interval > 0:
+            stats_future = asyncio.create_task(
+                _StatsReporter(ingester, outputs, args.stats_interval).run()
+            )
+        await stop_event.wait()
+        logger.info('stopping')
+    finally:
+        if stats_future is not None:
+            stats_future.cancel()
+        await ingester.close()
+        for output in outputs:
+            output.stop()
+        await asyncio.gather(*(output.join() for output in outputs))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m blivedm', description='批量采集直播间消息')
+    parser.add_argument('room_file', help='房间列表文件，每行一个房间ID，或者.json文件')
+    parser.add_argument('-o', '--output', action='append',
+                        help='输出，可以指定多个：stdout、jsonl:PATH、sqlite:PATH，默认是stdout')
+    parser.add_argument('--startup-concurrency', type=int, default=8, help='最多同时初始化的房间数')
+    parser.add_argument('--startup-timeout', type=float, default=30,
+                        help='一个房间初始化超过这个时间（秒）就继续启动下一个')
+    parser.add_argument('--restart-interval', type=float, default=60, help='房间异常停止后等待这个时间（秒）再重新启动')
+    parser.add_argument('--ws-transport', choices=('aiohttp', 'asyncio'), default='aiohttp',
+                        help='连接弹幕服务器用的WebSocket实现，asyncio开销更小但不支持代理')
+    parser.add_argument('--stats-interval', type=float, default=10, help='打印统计的间隔时间（秒），0表示不打印')
+    parser.add_argument('--log-level', default='INFO', help='日志级别，日志和统计输出到stderr')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=args.log_level.upper())
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
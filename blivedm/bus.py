@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+一个客户端的消息给多个订阅者：业务消息只反序列化一次，每个cmd的消息模型只构造一次，同一个对象交给所有订阅者
+
+用法::
+
+    client = blivedm.BLiveClient(room_id)
+    client.subscribe(archive, cmds=['DANMU_MSG', 'SEND_GIFT'])  # 原始业务消息
+    client.subscribe(show_danmaku, model_type=web_models.DanmakuMessage, filter=lambda msg: msg.dm_type == 0)
+    client.start()
+
+订阅按cmd编译成分发函数，收到消息时只按cmd查一次表，没人订阅的cmd不会构造消息模型，
+所以每条消息的开销和有多少订阅者不关心这个cmd无关
+"""
+import logging
+from typing import *
+
+from . import handlers
+from .clients import ws_base
+from .models import web as web_models, open_live as open_models
+
+__all__ = (
+    'Subscription',
+    'EventBus',
+    'get_model_type',
+)
+
+logger = logging.getLogger('blivedm')
+
+_RawCallback = Callable[[ws_base.WebSocketClientBase, dict], Any]
+_ModelCallback = Callable[[ws_base.WebSocketClientBase, Any], Any]
+_ModelBuilder = Callable[[ws_base.WebSocketClientBase, dict], List[Any]]
+
+
+def _make_builder(message_cls, data_key='data', is_mirror=False) -> _ModelBuilder:
+    construct = message_cls.from_command
+
+    def build(client: ws_base.WebSocketClientBase, command: dict):
+        message = handlers._construct_message(client, message_cls, construct, command[data_key])  # noqa
+        if is_mirror:
+            message.is_mirror = True
+        return [message]
+    return build
+
+
+def _build_gift_v2(client: ws_base.WebSocketClientBase, command: dict):
+    return handlers._construct_message(  # noqa
+        client, web_models.GiftMessage, web_models.GiftMessage.batch_from_command_v2, command['data']
+    )
+
+
+_CMD_MODEL_BUILDERS: Dict[str, Tuple[type, _ModelBuilder]] = {
+    '_HEARTBEAT': (web_models.HeartbeatMessage, _make_builder(web_models.HeartbeatMessage)),
+    'DANMU_MSG': (web_models.DanmakuMessage, _make_builder(web_models.DanmakuMessage, 'info')),
+    'DANMU_MSG_MIRROR': (web_models.DanmakuMessage, _make_builder(web_models.DanmakuMessage, 'info', True)),
+    'SEND_GIFT': (web_models.GiftMessage, _make_builder(web_models.GiftMessage)),
+    'SEND_GIFT_V2': (web_models.GiftMessage, _build_gift_v2),
+    'GUARD_BUY': (web_models.GuardBuyMessage, _make_builder(web_models.GuardBuyMessage)),
+    'USER_TOAST_MSG_V2': (web_models.UserToastV2Message, _make_builder(web_models.UserToastV2Message)),
+    'SUPER_CHAT_MESSAGE': (web_models.SuperChatMessage, _make_builder(web_models.SuperChatMessage)),
+    'SUPER_CHAT_MESSAGE_DELETE': (
+        web_models.SuperChatDeleteMessage, _make_builder(web_models.SuperChatDeleteMessage)
+    ),
+    'INTERACT_WORD_V2': (web_models.InteractWordV2Message, _make_builder(web_models.InteractWordV2Message)),
+
+    'LIVE_OPEN_PLATFORM_DM': (open_models.DanmakuMessage, _make_builder(open_models.DanmakuMessage)),
+    'LIVE_OPEN_PLATFORM_DM_MIRROR': (
+        open_models.DanmakuMessage, _make_builder(open_models.DanmakuMessage, is_mirror=True)
+    ),
+    'LIVE_OPEN_PLATFORM_SEND_GIFT': (open_models.GiftMessage, _make_builder(open_models.GiftMessage)),
+    'LIVE_OPEN_PLATFORM_GUARD': (open_models.GuardBuyMessage, _make_builder(open_models.GuardBuyMessage)),
+    'LIVE_OPEN_PLATFORM_SUPER_CHAT': (open_models.SuperChatMessage, _make_builder(open_models.SuperChatMessage)),
+    'LIVE_OPEN_PLATFORM_SUPER_CHAT_DEL': (
+        open_models.SuperChatDeleteMessage, _make_builder(open_models.SuperChatDeleteMessage)
+    ),
+    'LIVE_OPEN_PLATFORM_LIKE': (open_models.LikeMessage, _make_builder(open_models.LikeMessage)),
+    'LIVE_OPEN_PLATFORM_LIVE_ROOM_ENTER': (open_models.RoomEnterMessage, _make_builder(open_models.RoomEnterMessage)),
+    'LIVE_OPEN_PLATFORM_LIVE_START': (open_models.LiveStartMessage, _make_builder(open_models.LiveStartMessage)),
+    'LIVE_OPEN_PLATFORM_LIVE_END': (open_models.LiveEndMessage, _make_builder(open_models.LiveEndMessage)),
+}
+"""cmd -> (消息模型的类, 从业务消息构造消息模型列表的函数)，和BaseHandler._CMD_CALLBACK_DICT保持一致"""
+
+
+def get_model_type(cmd: str) -> Optional[type]:
+    """
+    返回cmd对应的消息模型的类，没有消息模型则返回None
+    """
+    entry = _CMD_MODEL_BUILDERS.get(cmd, None)
+    return entry[0] if entry is not None else None
+
+
+class Subscription:
+    """
+    一个订阅，用EventBus.subscribe创建
+    """
+
+    def __init__(
+        self,
+        bus: 'EventBus',
+        callback: Callable,
+        cmds: Optional[FrozenSet[str]],
+        model_type: Optional[type],
+        filter_: Optional[Callable[[Any], bool]],
+    ):
+        self._bus = bus
+        self.callback = callback
+        """回调，订阅原始业务消息时是callback(client, command)，订阅消息模型时是callback(client, message)"""
+        self.cmds = cmds
+        """订阅的cmd，None表示所有cmd"""
+        self.model_type = model_type
+        """订阅的消息模型的类，None表示订阅原始业务消息"""
+        self.filter = filter_
+        """过滤函数，输入业务消息或者消息模型，返回False则不调用回调"""
+
+    @property
+    def is_active(self) -> bool:
+        return self in self._bus._subscriptions  # noqa
+
+    def unsubscribe(self):
+        """
+        取消订阅
+        """
+        self._bus.unsubscribe(self)
+
+
+class EventBus(handlers.HandlerInterface):
+    """
+    发布订阅的消息处理器，可以给多个客户端共用。一般用WebSocketClientBase.subscribe，不用自己创建
+
+    消息模型在订阅者之间共享，订阅者不要修改消息模型，需要修改时先dataclasses.replace复制一份
+
+    订阅者的回调抛出异常只会打日志，不影响其他订阅者
+    """
+
+    def __init__(self):
+        self._subscriptions: Dict[Subscription, None] = {}
+        """所有订阅，用dict保持顺序"""
+        self._stop_handlers: List[handlers.HandlerInterface] = []
+        """客户端停止时要通知的消息处理器"""
+        self._cmd_to_dispatch: Dict[str, Callable[[ws_base.WebSocketClientBase, dict], None]] = {}
+        """cmd -> 编译好的分发函数，没有订阅的cmd不在这里"""
+        self._wildcard_dispatch: Optional[Callable[[ws_base.WebSocketClientBase, dict], None]] = None
+        """订阅了所有cmd的原始业务消息的订阅者的分发函数，用于不在_cmd_to_dispatch里的cmd"""
+
+    @property
+    def subscriptions(self) -> List[Subscription]:
+        return list(self._subscriptions)
+
+    def subscribe(
+        self,
+        callback: Union[_RawCallback, _ModelCallback],
+        *,
+        cmds: Optional[Iterable[str]] = None,
+        model_type: Optional[type] = None,
+        filter: Optional[Callable[[Any], bool]] = None,  # noqa
+    ) -> Subscription:
+        """
+        订阅消息
+
+        :param callback: 回调，订阅原始业务消息时是callback(client, command)，订阅消息模型时是callback(client, message)
+        :param cmds: 只订阅这些cmd，None表示所有cmd。订阅消息模型时用来进一步限制cmd，比如只要DANMU_MSG_MIRROR
+        :param model_type: 订阅这个类的消息模型，None表示订阅原始业务消息
+        :param filter: 过滤函数，输入业务消息或者消息模型，返回False则不调用回调
+        :return: 订阅，用来取消订阅
+        """
+        if model_type is not None and not any(
+            entry[0] is model_type for entry in _CMD_MODEL_BUILDERS.values()
+        ):
+            raise ValueError(f'no cmd produces model_type={model_type!r}')
+        subscription = Subscription(
+            self, callback, frozenset(cmds) if cmds is not None else None, model_type, filter
+        )
+        self._subscriptions[subscription] = None
+        self._compile()
+        return subscription
+
+    def subscribe_handler(self, handler: handlers.HandlerInterface, *, cmds: Optional[Iterable[str]] = None
+                          ) -> Subscription:
+        """
+        把一个消息处理器当成订阅者，它会收到原始业务消息，客户端停止时也会通知它
+
+        :param handler: 消息处理器
+        :param cmds: 只订阅这些cmd，None表示所有cmd
+        """
+        subscription = self.subscribe(handler.handle, cmds=cmds)
+        self._stop_handlers.append(handler)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        取消订阅，没有订阅则忽略
+        """
+        if subscription not in self._subscriptions:
+            return
+        del self._subscriptions[subscription]
+        # 用subscribe_handler订阅的消息处理器不再需要停止通知
+        handler = getattr(subscription.callback, '__self__', None)
+        if handler in self._stop_handlers and not any(
+            getattr(sub.callback, '__self__', None) is handler for sub in self._subscriptions
+        ):
+            self._stop_handlers.remove(handler)
+        self._compile()
+
+    def _compile(self):
+        """
+        把所有订阅按cmd编译成分发函数
+        """
+        wildcard_raw: List[Subscription] = []
+        cmd_to_raw: Dict[str, List[Subscription]] = {}
+        cmd_to_model: Dict[str, List[Subscription]] = {}
+        for subscription in self._subscriptions:
+            if subscription.model_type is not None:
+                for cmd, (model_type, _) in _CMD_MODEL_BUILDERS.items():
+                    if model_type is subscription.model_type and (
+                        subscription.cmds is None or cmd in subscription.cmds
+                    ):
+                        cmd_to_model.setdefault(cmd, []).append(subscription)
+            elif subscription.cmds is None:
+                wildcard_raw.append(subscription)
+                # 保持订阅顺序，所有已经出现的cmd都要加上
+                for raw_list in cmd_to_raw.values():
+                    raw_list.append(subscription)
+            else:
+                for cmd in subscription.cmds:
+                    cmd_to_raw.setdefault(cmd, list(wildcard_raw)).append(subscription)
+
+        cmd_to_dispatch = {}
+        for cmd in set(cmd_to_raw) | set(cmd_to_model):
+            raw_subscriptions = cmd_to_raw.get(cmd, wildcard_raw)
+            model_subscriptions = cmd_to_model.get(cmd, [])
+            builder = _CMD_MODEL_BUILDERS[cmd][1] if model_subscriptions else None
+            cmd_to_dispatch[cmd] = self._make_dispatch(raw_subscriptions, builder, model_subscriptions)
+        self._cmd_to_dispatch = cmd_to_dispatch
+        self._wildcard_dispatch = self._make_dispatch(wildcard_raw, None, []) if wildcard_raw else None
+
+    @staticmethod
+    def _make_dispatch(
+        raw_subscriptions: List[Subscription],
+        builder: Optional[_ModelBuilder],
+        model_subscriptions: List[Subscription],
+    ) -> Callable[[ws_base.WebSocketClientBase, dict], None]:
+        raw_targets = tuple((sub.callback, sub.filter) for sub in raw_subscriptions)
+        model_targets = tuple((sub.callback, sub.filter) for sub in model_subscriptions)
+
+        def dispatch(client: ws_base.WebSocketClientBase, command: dict):
+            for callback, filter_ in raw_targets:
+                try:
+                    if filter_ is None or filter_(command):
+                        callback(client, command)
+                except Exception:  # noqa
+                    logger.exception('room=%s subscriber failed, callback=%r', client.room_id, callback)
+
+            if builder is None:
+                return
+            try:
+                messages = builder(client, command)
+            except Exception:  # noqa
+                logger.exception('room=%s failed to construct message, command=%s', client.room_id, command)
+                return
+            for message in messages:
+                for callback, filter_ in model_targets:
+                    try:
+                        if filter_ is None or filter_(message):
+                            callback(client, message)
+                    except Exception:  # noqa
+                        logger.exception('room=%s subscriber failed, callback=%r', client.room_id, callback)
+
+        return dispatch
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        cmd = command.get('cmd', '')
+        pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
+        if pos != -1:
+            cmd = cmd[:pos]
+
+        dispatch = self._cmd_to_dispatch.get(cmd, self._wildcard_dispatch)
+        if dispatch is not None:
+            dispatch(client, command)
+
+    def on_client_stopped(self, client: ws_base.WebSocketClientBase, exception: Optional[Exception]):
+        for handler in list(self._stop_handlers):
+            try:
+                handler.on_client_stopped(client, exception)
+            except Exception:  # noqa
+                logger.exception('room=%s on_client_stopped() failed, handler=%r', client.room_id, handler)
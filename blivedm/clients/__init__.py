@@ -1,3 +1,40 @@
 # -*- coding: utf-8 -*-
-from .web import *
-from .open_live import *
+from typing import TYPE_CHECKING
+
+from .. import utils
+
+if TYPE_CHECKING:
+    from .web import *
+    from .open_live import *
+    from .open_live_session import *
+    from .open_live_manager import *
+    from .multiplex import *
+    from .protocol import Protocol
+    from .ws_base import TransportType
+
+_LAZY_ATTRS = {
+    'BLiveClient': 'web',
+    'OpenLiveClient': 'open_live',
+    'GameSession': 'open_live_session',
+    'GameSessionStoreInterface': 'open_live_session',
+    'FileGameSessionStore': 'open_live_session',
+    'OpenLiveManager': 'open_live_manager',
+    'MultiplexClient': 'multiplex',
+    'Protocol': 'protocol',
+    'TransportType': 'ws_base',
+}
+
+__all__ = tuple(_LAZY_ATTRS)
+
+__getattr__, __dir__ = utils.make_lazy_module_attrs(__name__, globals(), _LAZY_ATTRS, (
+    'asyncio_ws',
+    'dedup',
+    'multiplex',
+    'net',
+    'open_live',
+    'open_live_manager',
+    'open_live_session',
+    'protocol',
+    'web',
+    'ws_base',
+))
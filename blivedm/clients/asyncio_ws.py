@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+基于asyncio.Protocol的最小WebSocket客户端，只实现了连接弹幕服务器需要的部分
+
+aiohttp的WebSocket每收到一帧都要创建WSMessage、经过它自己的读取队列，连接协程每条消息都要await一次。
+这里在data_received里直接分帧，收到的消息攒成一批，连接协程一次取走一批交给解析包的逻辑
+
+客户端构造时传ws_transport=ws_base.TransportType.ASYNCIO使用。不支持代理、permessage-deflate压缩，
+握手失败时抛出aiohttp.ClientConnectionError，连接协程会按重连策略重连
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+from typing import *
+
+import aiohttp
+import aiohttp.abc
+import yarl
+
+from . import net
+
+__all__ = (
+    'WebSocketConnection',
+    'connect',
+)
+
+logger = logging.getLogger('blivedm')
+
+_WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+_OP_CONTINUATION = aiohttp.WSMsgType.CONTINUATION.value
+_OP_TEXT = aiohttp.WSMsgType.TEXT.value
+_OP_BINARY = aiohttp.WSMsgType.BINARY.value
+_OP_CLOSE = aiohttp.WSMsgType.CLOSE.value
+_OP_PING = aiohttp.WSMsgType.PING.value
+_OP_PONG = aiohttp.WSMsgType.PONG.value
+
+CONNECT_TIMEOUT = 10
+"""建立连接和握手的超时时间（秒），和客户端session的默认超时一样"""
+CLOSE_TIMEOUT = 2
+"""发送关闭帧后等待服务器断开的时间（秒），超时则直接断开"""
+MAX_HANDSHAKE_SIZE = 64 * 1024
+"""握手响应的最大长度"""
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+"""一条消息的最大长度，和aiohttp的默认值一样"""
+MAX_BUFFERED_MESSAGES = 1000
+"""收到了还没被取走的消息超过这个数时暂停读取，取走后再恢复"""
+
+
+def _mask(mask: bytes, data: bytes) -> bytes:
+    data_len = len(data)
+    if data_len == 0:
+        return b''
+    mask_int = int.from_bytes((mask * (data_len // 4 + 1))[:data_len], 'big')
+    return (int.from_bytes(data, 'big') ^ mask_int).to_bytes(data_len, 'big')
+
+
+class WebSocketConnection(asyncio.Protocol):
+    """
+    一个WebSocket连接，用connect创建。实现了WebSocketClientBase用到的aiohttp.ClientWebSocketResponse的接口：
+    closed、send_bytes、close，收消息用receive_batch
+
+    :param receive_timeout: 超过这个时间（秒）没收到消息则receive_batch抛出asyncio.TimeoutError，None表示不限制
+    """
+
+    def __init__(self, receive_timeout: Optional[float] = None):
+        self._receive_timeout = receive_timeout
+        self._loop = asyncio.get_running_loop()
+
+        self._transport: Optional[asyncio.Transport] = None
+        self._handshake_future = self._loop.create_future()
+        """握手完成的future"""
+        self._connection_lost_future = self._loop.create_future()
+        """TCP连接断开的future"""
+        self._expected_accept = b''
+        """握手响应里应该返回的Sec-WebSocket-Accept"""
+        self._is_handshaking = True
+        self._buffer = bytearray()
+        """还不完整的握手响应或帧"""
+        self._buffer_needed_size = 0
+        """缓冲区至少要有这么多数据才能解析出下一帧，大帧分很多次收到时不用每次都复制、解析整个缓冲区"""
+        self._fragments: Optional[List[bytes]] = None
+        """正在接收的分片消息"""
+        self._fragment_opcode = 0
+        """分片消息第一帧的操作码"""
+
+        self._messages: List[bytes] = []
+        """收到了还没被取走的消息"""
+        self._waiter: Optional[asyncio.Future] = None
+        """receive_batch等待新消息的future"""
+        self._is_reading_paused = False
+        self._closed = False
+        """收到或者发送了关闭帧，或者TCP连接断开了"""
+        self._close_frame_sent = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    #
+    # asyncio.Protocol
+    #
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._closed = True
+        if not self._handshake_future.done():
+            self._handshake_future.set_exception(
+                aiohttp.ClientConnectionError(f'connection lost during websocket handshake: {exc!r}')
+            )
+        if not self._connection_lost_future.done():
+            self._connection_lost_future.set_result(None)
+        self._wake_up_waiter()
+
+    def data_received(self, data: bytes):
+        if self._buffer:
+            self._buffer += data
+            if len(self._buffer) < self._buffer_needed_size:
+                return
+            data = bytes(self._buffer)
+            self._buffer.clear()
+
+        offset = 0
+        if self._is_handshaking:
+            offset = self._parse_handshake_response(data)
+            if offset < 0:
+                return
+
+        offset = self._parse_frames(data, offset)
+        if offset < len(data) and not self._closed:
+            self._buffer += memoryview(data)[offset:]
+
+        if self._messages:
+            self._wake_up_waiter()
+            if len(self._messages) >= MAX_BUFFERED_MESSAGES and not self._is_reading_paused:
+                self._is_reading_paused = True
+                self._transport.pause_reading()
+
+    def _parse_handshake_response(self, data: bytes) -> int:
+        """
+        :return: 握手响应结束的位置，响应不完整或者握手失败返回-1
+        """
+        end = data.find(b'\r\n\r\n')
+        if end == -1:
+            if len(data) > MAX_HANDSHAKE_SIZE:
+                self._fail_handshake('websocket handshake response is too large')
+            else:
+                self._buffer += data
+            return -1
+
+        status_line, *header_lines = data[:end].decode('latin-1').split('\r\n')
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        status_parts = status_line.split(' ', 2)
+        if len(status_parts) < 2 or status_parts[1] != '101':
+            self._fail_handshake(f'websocket handshake failed: {status_line}')
+            return -1
+        if (
+            headers.get('upgrade', '').lower() != 'websocket'
+            or headers.get('sec-websocket-accept', '').encode('latin-1') != self._expected_accept
+        ):
+            self._fail_handshake(f'websocket handshake failed, bad headers: {headers}')
+            return -1
+
+        self._is_handshaking = False
+        self._handshake_future.set_result(None)
+        return end + 4
+
+    def _fail_handshake(self, message: str):
+        if not self._handshake_future.done():
+            self._handshake_future.set_exception(aiohttp.ClientConnectionError(message))
+        self._closed = True
+        self._transport.abort()
+
+    def _parse_frames(self, data: bytes, offset: int) -> int:
+        """
+        :return: 处理完的位置，后面是不完整的帧
+        """
+        self._buffer_needed_size = 0
+        data_len = len(data)
+        while data_len - offset >= 2 and not self._closed:
+            first_byte = data[offset]
+            second_byte = data[offset + 1]
+            payload_len = second_byte & 0x7F
+            pos = offset + 2
+            if payload_len == 126:
+                if data_len - pos < 2:
+                    break
+                payload_len = int.from_bytes(data[pos: pos + 2], 'big')
+                pos += 2
+            elif payload_len == 127:
+                if data_len - pos < 8:
+                    break
+                payload_len = int.from_bytes(data[pos: pos + 8], 'big')
+                pos += 8
+
+            if first_byte & 0x70 or second_byte & 0x80:
+                # 没有协商扩展，服务器发的帧也不能有掩码
+                self._fail('bad websocket frame header')
+                return offset
+            if payload_len > MAX_MESSAGE_SIZE:
+                self._fail(f'websocket frame is too large, size={payload_len}')
+                return offset
+            if data_len - pos < payload_len:
+                self._buffer_needed_size = pos + payload_len - offset
+                break
+
+            offset = pos + payload_len
+            self._on_frame(first_byte & 0x80, first_byte & 0x0F, data[pos: offset])
+        return offset
+
+    def _on_frame(self, fin: int, opcode: int, payload: bytes):
+        if opcode == _OP_BINARY and fin and self._fragments is None:
+            # 最常见的情况
+            self._messages.append(payload)
+            return
+
+        if opcode >= 8:
+            # 控制帧可以夹在分片消息中间
+            if opcode == _OP_CLOSE:
+                self._on_close_frame(payload)
+            elif opcode == _OP_PING:
+                self._send_frame(_OP_PONG, payload)
+            elif opcode != _OP_PONG:
+                self._fail(f'unknown websocket opcode={opcode}')
+            return
+
+        if opcode == _OP_CONTINUATION:
+            if self._fragments is None:
+                self._fail('unexpected websocket continuation frame')
+                return
+            self._fragments.append(payload)
+            if not fin:
+                return
+            payload = b''.join(self._fragments)
+            opcode = self._fragment_opcode
+            self._fragments = None
+        elif self._fragments is not None:
+            self._fail('websocket fragmented message is not finished')
+            return
+        elif not fin:
+            self._fragments = [payload]
+            self._fragment_opcode = opcode
+            return
+
+        if opcode == _OP_BINARY:
+            self._messages.append(payload)
+        else:
+            logger.warning('unknown websocket message opcode=%d, data=%s', opcode, payload)
+
+    def _on_close_frame(self, payload: bytes):
+        self._closed = True
+        if not self._close_frame_sent:
+            # 回复关闭帧，带上服务器的关闭码
+            self._close_frame_sent = True
+            self._send_frame(_OP_CLOSE, payload[:2])
+        self._transport.close()
+        self._wake_up_waiter()
+
+    def _fail(self, message: str):
+        """
+        协议错误，直接断开，连接协程会重连
+        """
+        logger.warning('%s, aborting websocket connection', message)
+        self._closed = True
+        self._transport.abort()
+        self._wake_up_waiter()
+
+    def _wake_up_waiter(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _on_receive_timeout(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(asyncio.TimeoutError())
+
+    def _send_frame(self, opcode: int, payload: bytes):
+        payload_len = len(payload)
+        if payload_len < 126:
+            header = bytes((0x80 | opcode, 0x80 | payload_len))
+        elif payload_len < 65536:
+            header = bytes((0x80 | opcode, 0x80 | 126)) + payload_len.to_bytes(2, 'big')
+        else:
+            header = bytes((0x80 | opcode, 0x80 | 127)) + payload_len.to_bytes(8, 'big')
+        mask = os.urandom(4)
+        self._transport.write(header + mask + _mask(mask, payload))
+
+    #
+    # 给WebSocketClientBase用的接口
+    #
+
+    async def _handshake(self, url: yarl.URL, headers: Dict[str, str]):
+        key = base64.b64encode(os.urandom(16))
+        self._expected_accept = base64.b64encode(hashlib.sha1(key + _WS_GUID).digest())
+        host = url.raw_host if url.is_default_port() else f'{url.raw_host}:{url.port}'
+        lines = [
+            f'GET {url.raw_path_qs} HTTP/1.1',
+            f'Host: {host}',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Key: {key.decode("ascii")}',
+            'Sec-WebSocket-Version: 13',
+        ]
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        self._transport.write(('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8'))
+        await self._handshake_future
+
+    async def receive_batch(self) -> List[bytes]:
+        """
+        等待并取走收到的所有消息
+
+        :return: 按收到顺序排列的消息数据，连接断开后返回空列表
+        """
+        while not self._messages:
+            if self._closed:
+                return []
+            waiter = self._waiter = self._loop.create_future()
+            timer_handle = (
+                self._loop.call_later(self._receive_timeout, self._on_receive_timeout)
+                if self._receive_timeout is not None else None
+            )
+            try:
+                await waiter
+            finally:
+                self._waiter = None
+                if timer_handle is not None:
+                    timer_handle.cancel()
+
+        messages = self._messages
+        self._messages = []
+        if self._is_reading_paused:
+            self._is_reading_paused = False
+            self._transport.resume_reading()
+        return messages
+
+    async def send_bytes(self, data: bytes):
+        """
+        发送一条二进制消息
+        """
+        if self._closed or self._transport is None or self._transport.is_closing():
+            raise ConnectionResetError('Cannot write to closing transport')
+        self._send_frame(_OP_BINARY, data)
+
+    async def close(self, *, code=1000) -> bool:
+        """
+        发送关闭帧，等待服务器断开，超时则直接断开
+
+        :return: 是不是这次调用关闭的
+        """
+        transport = self._transport
+        if transport is None or self._connection_lost_future.done():
+            self._closed = True
+            return False
+
+        is_first_close = not self._close_frame_sent
+        if is_first_close and not transport.is_closing():
+            self._close_frame_sent = True
+            self._send_frame(_OP_CLOSE, code.to_bytes(2, 'big'))
+        self._closed = True
+        self._wake_up_waiter()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._connection_lost_future), CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            transport.abort()
+        return is_first_close
+
+
+async def connect(
+    url: str,
+    *,
+    headers: Optional[Dict[str, str]] = None,
+    cookie_jar: Optional[aiohttp.abc.AbstractCookieJar] = None,
+    receive_timeout: Optional[float] = None,
+    timeout: float = CONNECT_TIMEOUT,
+) -> WebSocketConnection:
+    """
+    建立WebSocket连接。DNS解析用net模块的缓存，wss用net.get_ssl_context，会复用TLS会话
+
+    :param url: ws或wss的URL
+    :param headers: 握手时额外的HTTP头
+    :param cookie_jar: 握手时从这里取cookie，一般是客户端session的cookie_jar
+    :param receive_timeout: 见WebSocketConnection
+    :param timeout: 建立连接和握手的超时时间（秒）
+    """
+    url = yarl.URL(url)
+    if url.scheme not in ('ws', 'wss'):
+        raise ValueError(f'unsupported websocket url: {url}')
+    headers = dict(headers or {})
+    if cookie_jar is not None:
+        cookies = cookie_jar.filter_cookies(url)
+        if cookies:
+            headers['Cookie'] = '; '.join(f'{name}={morsel.value}' for name, morsel in cookies.items())
+
+    return await asyncio.wait_for(_connect(url, headers, receive_timeout), timeout)
+
+
+async def _connect(url: yarl.URL, headers: Dict[str, str], receive_timeout: Optional[float]) -> WebSocketConnection:
+    loop = asyncio.get_running_loop()
+    is_secure = url.scheme == 'wss'
+    addresses = await net._get_shared_resolver().resolve(url.raw_host, url.port, 0)  # noqa
+
+    last_exception: Optional[OSError] = None
+    for address in addresses:
+        try:
+            _, connection = await loop.create_connection(
+                lambda: WebSocketConnection(receive_timeout),
+                address['host'], address['port'],
+                family=address['family'],
+                proto=address['proto'],
+                flags=address['flags'],
+                ssl=net.get_ssl_context() if is_secure else None,
+                server_hostname=url.raw_host if is_secure else None,
+            )
+            break
+        except OSError as e:
+            last_exception = e
+    else:
+        raise aiohttp.ClientConnectionError(
+            f'cannot connect to {url.raw_host}:{url.port}: {last_exception!r}'
+        ) from last_exception
+
+    try:
+        await connection._handshake(url, headers)  # noqa
+    except BaseException:
+        connection._transport.abort()  # noqa
+        raise
+    return connection
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import collections
+from typing import *
+
+__all__ = (
+    'CommandDeduplicator',
+    'get_command_key',
+)
+
+
+def get_command_key(command: dict) -> Optional[Hashable]:
+    """
+    返回业务消息的标识，同一条消息从不同连接收到时标识相同
+
+    只用消息自带的ID。没有ID的消息返回None，这种消息不能去重，因为内容相同的两条消息可能是两次不同的推送
+
+    :param command: 业务消息
+    """
+    cmd = command.get('cmd', '')
+    try:
+        if cmd.startswith('DANMU_MSG'):
+            # 弹幕的rnd、时间戳、用户ID文本的CRC32
+            info0 = command['info'][0]
+            return cmd, info0[5], info0[4], info0[7]
+        elif cmd == 'SEND_GIFT':
+            return cmd, command['data']['tid']
+        elif cmd == 'SUPER_CHAT_MESSAGE':
+            return cmd, command['data']['id']
+        elif cmd.startswith('LIVE_OPEN_PLATFORM_'):
+            msg_id = command['data'].get('msg_id', '')
+            if msg_id != '':
+                return cmd, msg_id
+    except (KeyError, IndexError, TypeError, AttributeError):
+        pass
+    return None
+
+
+class CommandDeduplicator:
+    """
+    业务消息去重器，用来合并多个连接收到的消息
+
+    只对带ID的消息去重，只保存最近max_size条消息的标识，内存占用有上限
+
+    :param max_size: 最多保存多少条消息的标识
+    """
+
+    def __init__(self, max_size=4096):
+        self._max_size = max_size
+        self._key_set: Set[Hashable] = set()
+        """用来快速查找的消息标识集合"""
+        self._key_queue: Deque[Hashable] = collections.deque()
+        """按收到顺序保存的消息标识，超过上限时淘汰最旧的"""
+
+    def is_duplicate(self, command: dict) -> bool:
+        """
+        判断消息是否已经收到过，没收到过则记录下来。没有ID的消息总是返回False
+
+        :param command: 业务消息
+        """
+        key = get_command_key(command)
+        return key is not None and self.is_duplicate_key(key)
+
+    def is_duplicate_key(self, key: Hashable) -> bool:
+        """
+        判断消息标识是否已经收到过，没收到过则记录下来
+
+        :param key: 消息标识
+        """
+        if key in self._key_set:
+            return True
+
+        if len(self._key_queue) >= self._max_size:
+            self._key_set.discard(self._key_queue.popleft())
+        self._key_queue.append(key)
+        self._key_set.add(key)
+        return False
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextvars
+import logging
+from typing import *
+
+import aiohttp
+
+from . import protocol, web, ws_base
+from .. import handlers
+
+__all__ = (
+    'MultiplexClient',
+)
+
+logger = logging.getLogger('blivedm')
+
+REGISTER_TIMEOUT = 5
+"""等待注册房间回复的超时时间（秒）"""
+
+_current_room_client: contextvars.ContextVar[Optional[web.BLiveClient]] = contextvars.ContextVar(
+    '_current_room_client', default=None
+)
+"""正在解析的消息属于哪个房间，每个连接协程是独立的task，所以不会互相影响"""
+
+
+class MultiplexClient(ws_base.WebSocketClientBase):
+    """
+    实验性功能：在一个WebSocket连接上同时监听多个房间的客户端
+
+    先用第一个房间认证，然后用REGISTER操作注册其他房间，服务器用包头的seq_id区分消息属于哪个房间。
+    B站服务器不一定支持这个操作，被拒绝或者超时没有回复的房间会退回到单独连接
+
+    :param clients: 各个房间的客户端，用来初始化房间和分发消息，除了退回到单独连接时，不会自己连接服务器
+    :param session: cookie、连接池，默认用第一个房间的客户端的session
+    :param heartbeat_interval: 发送心跳包的间隔时间（秒）
+    """
+
+    def __init__(
+        self,
+        clients: List[web.BLiveClient],
+        *,
+        session: Optional[aiohttp.ClientSession] = None,
+        heartbeat_interval=30,
+    ):
+        if not clients:
+            raise ValueError('clients is empty')
+        super().__init__(session if session is not None else clients[0]._session, heartbeat_interval)  # noqa
+
+        self._clients = list(clients)
+        """各个房间的客户端，第一个用来认证"""
+        self._seq_id_to_client: Dict[int, web.BLiveClient] = {
+            # seq_id=1是认证包用的
+            index + 2: client
+            for index, client in enumerate(self._clients)
+        }
+        """注册用的seq_id -> 房间的客户端"""
+
+        # 在运行时初始化的字段
+        self._registered_clients: Set[web.BLiveClient] = set()
+        """注册成功的房间的客户端"""
+        self._fallback_clients: Set[web.BLiveClient] = set()
+        """退回到单独连接的房间的客户端"""
+        self._register_futures: Dict[int, asyncio.Future] = {}
+        """seq_id -> 等待注册回复的future"""
+
+    @property
+    def _primary_client(self) -> web.BLiveClient:
+        return self._clients[0]
+
+    @property
+    def clients(self) -> List[web.BLiveClient]:
+        """
+        各个房间的客户端
+        """
+        return self._clients
+
+    @property
+    def registered_room_ids(self) -> List[int]:
+        """
+        注册成功、共用本连接的房间ID，不包括用来认证的房间
+        """
+        return [client.room_id for client in self._registered_clients]
+
+    @property
+    def fallback_room_ids(self) -> List[int]:
+        """
+        被服务器拒绝注册、退回到单独连接的房间ID
+        """
+        return [client.room_id for client in self._fallback_clients]
+
+    def set_handler(self, handler: Optional['handlers.HandlerInterface']):
+        """
+        设置消息处理器，各个房间的客户端都会设置这个处理器
+
+        :param handler: 消息处理器
+        """
+        super().set_handler(handler)
+        for client in self._clients:
+            client.set_handler(handler)
+
+    def stop(self):
+        """
+        停止本客户端和退回到单独连接的客户端
+        """
+        for client in self._fallback_clients:
+            if client.is_running:
+                client.stop()
+        super().stop()
+
+    async def close(self):
+        """
+        释放本客户端和各个房间的客户端的资源，调用后本客户端将不可用
+        """
+        await asyncio.gather(*(client.stop_and_close() for client in self._clients))
+        await super().close()
+
+    async def init_room(self):
+        """
+        初始化所有房间
+
+        :return: True代表没有降级
+        """
+        results = await asyncio.gather(*(client.init_room() for client in self._clients))
+        self._room_id = self._primary_client.room_id
+        return all(results)
+
+    def _get_ws_url(self, retry_count) -> str:
+        """
+        返回WebSocket连接的URL，用认证的房间的服务器
+        """
+        return self._primary_client._get_ws_url(retry_count)  # noqa
+
+    async def _send_auth(self, websocket: aiohttp.ClientWebSocketResponse):
+        """
+        发送认证包，用第一个房间认证
+        """
+        auth_params = self._primary_client._get_auth_params()  # noqa
+        await websocket.send_bytes(self._make_packet(auth_params, ws_base.Operation.AUTH))
+
+    async def _on_ws_close(self, websocket: aiohttp.ClientWebSocketResponse):
+        """
+        WebSocket连接断开，重连后要重新注册
+        """
+        await super()._on_ws_close(websocket)
+        if not self._websockets:
+            self._registered_clients.clear()
+
+    async def _register_rooms(self, websocket: aiohttp.ClientWebSocketResponse):
+        """
+        认证成功后注册其他房间，被拒绝的房间退回到单独连接
+        """
+        await asyncio.gather(*(
+            self._register_room(websocket, seq_id, client)
+            for seq_id, client in self._seq_id_to_client.items()
+            if client is not self._primary_client and client not in self._fallback_clients
+        ))
+        logger.info('room=%d registered %d rooms, %d rooms fallback', self.room_id,
+                    len(self._registered_clients), len(self._fallback_clients))
+
+    async def _register_room(self, websocket: aiohttp.ClientWebSocketResponse, seq_id: int, client: web.BLiveClient):
+        future = self._register_futures[seq_id] = asyncio.get_running_loop().create_future()
+        try:
+            auth_params = client._get_auth_params()  # noqa
+            await websocket.send_bytes(self._make_packet(auth_params, ws_base.Operation.REGISTER, seq_id))
+            code = await asyncio.wait_for(future, REGISTER_TIMEOUT)
+        except (ConnectionResetError, aiohttp.ClientConnectionError) as e:
+            # 连接断开了，重连后会重新注册
+            logger.warning('room=%d _register_room() failed: %r', client.room_id, e)
+            return
+        except asyncio.TimeoutError:
+            code = None
+        finally:
+            self._register_futures.pop(seq_id, None)
+
+        if code == ws_base.AuthReplyCode.OK:
+            self._registered_clients.add(client)
+            return
+
+        logger.warning('room=%d register rejected, code=%s, fallback to a standalone connection', client.room_id, code)
+        self._fallback_clients.add(client)
+        if self.is_running and not client.is_running:
+            client.start()
+
+    async def _on_ws_data(self, data: bytes, websocket: Optional[aiohttp.ClientWebSocketResponse] = None):
+        """
+        收到WebSocket消息，根据包头的seq_id找到消息属于哪个房间
+        """
+        client = None
+        if len(data) >= ws_base.HEADER_STRUCT.size:
+            header = protocol.unpack_header(data, 0)
+            # 注册回复和推送可能在同一批消息里，所以这里不检查是否已经注册成功
+            client = self._seq_id_to_client.get(header.seq_id, None)
+
+        token = _current_room_client.set(client)
+        try:
+            await super()._on_ws_data(data, websocket)
+        finally:
+            _current_room_client.reset(token)
+
+    async def _on_protocol_event(
+        self, event: protocol.Event, websocket: Optional[aiohttp.ClientWebSocketResponse] = None
+    ):
+        """
+        处理协议层解析出的事件，另外处理注册回复
+        """
+        if isinstance(event, protocol.RegisterReplyEvent):
+            if event.header.operation == ws_base.Operation.REGISTER_REPLY:
+                future = self._register_futures.get(event.header.seq_id, None)
+                if future is not None and not future.done():
+                    future.set_result(event.code)
+            return
+
+        await super()._on_protocol_event(event, websocket)
+
+        if isinstance(event, protocol.AuthReplyEvent) and websocket is not None:
+            # 认证成功了，认证失败会抛出AuthError
+            asyncio.create_task(self._register_rooms(websocket))
+
+    def _handle_command(self, command: dict):
+        """
+        把业务消息交给所属房间的客户端处理
+        """
+        client = _current_room_client.get()
+        if client is None:
+            client = self._primary_client
+        client._handle_command(command)  # noqa
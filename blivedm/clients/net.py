@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import socket
+import ssl
+import time
+import weakref
+from typing import *
+
+import aiohttp
+import aiohttp.abc
+
+__all__ = (
+    'get_shared_connector',
+    'set_shared_connector_limits',
+    'get_ssl_context',
+    'prefetch_hosts',
+    'get_stats',
+    'close_shared_connectors',
+)
+
+logger = logging.getLogger('blivedm')
+
+_connector_limit = 0
+"""共享连接池的总连接数限制，0表示不限制。每个WebSocket连接都会一直占用一个连接"""
+_connector_limit_per_host = 0
+"""共享连接池对每个host的连接数限制，0表示不限制"""
+
+_loop_to_connector: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.TCPConnector]' = (
+    weakref.WeakKeyDictionary()
+)
+"""每个事件循环共享一个连接池"""
+_loop_to_resolver: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _CachingResolver]' = (
+    weakref.WeakKeyDictionary()
+)
+"""每个事件循环共享一个DNS解析器，但是DNS缓存是进程共享的"""
+_ssl_context: Optional['_SessionCachingSSLContext'] = None
+
+DNS_CACHE_TTL = 5 * 60
+"""DNS缓存的有效时间（秒）"""
+DNS_CACHE_STALE_TTL = 60 * 60
+"""DNS缓存过期后，在这个时间（秒）内还可以先用旧的结果，同时在后台刷新"""
+
+_DnsCacheKey = Tuple[str, int, int]
+_dns_cache: Dict[_DnsCacheKey, Tuple[float, List[Dict[str, Any]]]] = {}
+"""(host, port, family) -> (解析的时间（time.monotonic()）, 解析结果)"""
+
+
+class _ConnectStats:
+    def __init__(self):
+        self.connect_count = 0
+        """建立WebSocket连接的次数"""
+        self.connect_failed_count = 0
+        """建立WebSocket连接失败的次数"""
+        self.connect_time_total = 0.0
+        """建立WebSocket连接成功的总耗时（秒），包括DNS、TCP、TLS握手和HTTP升级"""
+        self.connect_time_max = 0.0
+        """建立WebSocket连接成功的最大耗时（秒）"""
+
+        self.dns_query_count = 0
+        """DNS查询次数，包括命中缓存的"""
+        self.dns_cache_hit_count = 0
+        """DNS查询命中缓存的次数"""
+        self.dns_resolve_count = 0
+        """实际解析DNS的次数"""
+        self.dns_resolve_failed_count = 0
+        """解析DNS失败的次数"""
+        self.dns_resolve_time_total = 0.0
+        """解析DNS成功的总耗时（秒）"""
+        self.dns_resolve_time_max = 0.0
+        """解析DNS成功的最大耗时（秒）"""
+
+
+_connect_stats = _ConnectStats()
+
+
+class _SessionCachingSSLContext(ssl.SSLContext):
+    """
+    会缓存TLS会话的SSLContext，重连同一个host时复用会话，跳过完整的TLS握手
+
+    asyncio创建TLS连接时会调用wrap_bio，但是不支持传入session，所以在这里注入
+    """
+
+    _session_cache: Dict[str, ssl.SSLSession]
+    """host -> 可以复用的TLS会话"""
+    _last_ssl_objects: Dict[str, ssl.SSLObject]
+    """host -> 最近一次握手的SSLObject，握手完成后才能拿到会话，所以下次握手时再取"""
+    handshake_count: int
+    """TLS握手次数"""
+    resumed_count: int
+    """复用了会话的TLS握手次数，只统计到上一次握手"""
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if server_side or server_hostname is None:
+            return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+        self._update_session_cache(server_hostname)
+        if session is None:
+            session = self._get_cached_session(server_hostname)
+        ssl_object = super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        self._last_ssl_objects[server_hostname] = ssl_object
+        self.handshake_count += 1
+        return ssl_object
+
+    def _update_session_cache(self, host: str):
+        ssl_object = self._last_ssl_objects.pop(host, None)
+        if ssl_object is None:
+            return
+        try:
+            if ssl_object.session_reused:
+                self.resumed_count += 1
+            session = ssl_object.session
+        except (ValueError, ssl.SSLError):
+            # 握手还没完成或者失败了
+            return
+        if session is not None and session.has_ticket:
+            self._session_cache[host] = session
+
+    def _get_cached_session(self, host: str) -> Optional[ssl.SSLSession]:
+        session = self._session_cache.get(host, None)
+        if session is None:
+            return None
+        if session.time + session.timeout <= time.time():
+            del self._session_cache[host]
+            return None
+        return session
+
+
+class _CachingResolver(aiohttp.abc.AbstractResolver):
+    """
+    带缓存的DNS解析器，同时解析同一个host只会查询一次，缓存快过期时先用旧的结果，在后台刷新
+    """
+
+    def __init__(self):
+        self._resolver = aiohttp.DefaultResolver()
+        self._resolve_futures: Dict[_DnsCacheKey, asyncio.Future] = {}
+        """正在解析的future，用来避免同时解析"""
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict[str, Any]]:
+        _connect_stats.dns_query_count += 1
+        key = (host, port, family)
+        cache_entry = _dns_cache.get(key, None)
+        if cache_entry is not None:
+            resolve_time, addresses = cache_entry
+            age = time.monotonic() - resolve_time
+            if age < DNS_CACHE_STALE_TTL:
+                _connect_stats.dns_cache_hit_count += 1
+                if age >= DNS_CACHE_TTL:
+                    self.resolve_in_background(host, port, family)
+                return addresses
+
+        # 不能直接等待共享的task，否则一个调用方取消时会把task也取消了
+        return await asyncio.shield(self.resolve_in_background(host, port, family))
+
+    def resolve_in_background(self, host: str, port: int = 0, family: int = socket.AF_INET) -> asyncio.Future:
+        """
+        在后台解析，结果会放进缓存
+
+        :return: 解析结果的future
+        """
+        key = (host, port, family)
+        future = self._resolve_futures.get(key, None)
+        if future is None:
+            future = self._resolve_futures[key] = asyncio.create_task(self._do_resolve(key))
+
+            def on_done(fu: asyncio.Future):
+                self._resolve_futures.pop(key, None)
+                if not fu.cancelled() and fu.exception() is not None:
+                    logger.warning('failed to resolve host=%s: %r', host, fu.exception())
+            future.add_done_callback(on_done)
+
+        return future
+
+    async def _do_resolve(self, key: _DnsCacheKey) -> List[Dict[str, Any]]:
+        host, port, family = key
+        _connect_stats.dns_resolve_count += 1
+        start_time = time.perf_counter()
+        try:
+            addresses = await self._resolver.resolve(host, port, family)
+        except BaseException:
+            _connect_stats.dns_resolve_failed_count += 1
+            raise
+        resolve_time = time.perf_counter() - start_time
+        _connect_stats.dns_resolve_time_total += resolve_time
+        if resolve_time > _connect_stats.dns_resolve_time_max:
+            _connect_stats.dns_resolve_time_max = resolve_time
+
+        _dns_cache[key] = (time.monotonic(), addresses)
+        return addresses
+
+    async def close(self) -> None:
+        await self._resolver.close()
+
+
+def _get_shared_resolver() -> _CachingResolver:
+    loop = asyncio.get_event_loop()
+    resolver = _loop_to_resolver.get(loop, None)
+    if resolver is None:
+        resolver = _loop_to_resolver[loop] = _CachingResolver()
+    return resolver
+
+
+def prefetch_hosts(hosts: Iterable[Tuple[str, int]]):
+    """
+    在后台预先解析host，结果放进共享连接池用的DNS缓存，已经缓存了的不会重复解析
+
+    :param hosts: (host, port)的列表
+    """
+    resolver = _get_shared_resolver()
+    now = time.monotonic()
+    for host, port in hosts:
+        # 和连接池查询时的参数一致，连接池默认family=0
+        cache_entry = _dns_cache.get((host, port, 0), None)
+        if cache_entry is not None and now - cache_entry[0] < DNS_CACHE_TTL:
+            continue
+        resolver.resolve_in_background(host, port, 0)
+
+
+def _create_ssl_context() -> _SessionCachingSSLContext:
+    context = _SessionCachingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.options |= ssl.OP_NO_COMPRESSION
+    # aiohttp的WebSocket只支持HTTP/1.1
+    context.set_alpn_protocols(['http/1.1'])
+    context._session_cache = {}  # noqa
+    context._last_ssl_objects = {}  # noqa
+    context.handshake_count = 0
+    context.resumed_count = 0
+    return context
+
+
+def get_ssl_context() -> ssl.SSLContext:
+    """
+    返回进程共享的SSLContext，会复用TLS会话
+
+    自己创建session时也可以用，例如`aiohttp.TCPConnector(ssl=get_ssl_context())`
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = _create_ssl_context()
+    return _ssl_context
+
+
+def set_shared_connector_limits(limit: int = 0, limit_per_host: int = 0):
+    """
+    设置共享连接池的连接数限制，只对之后创建的连接池生效
+
+    :param limit: 总连接数限制，0表示不限制
+    :param limit_per_host: 每个host的连接数限制，0表示不限制
+    """
+    global _connector_limit, _connector_limit_per_host
+    _connector_limit = limit
+    _connector_limit_per_host = limit_per_host
+
+
+def get_shared_connector() -> aiohttp.TCPConnector:
+    """
+    返回当前事件循环共享的连接池。没有传入session的客户端会用这个连接池创建自己的session，
+    这样所有客户端共用连接、DNS缓存和SSLContext
+    """
+    loop = asyncio.get_event_loop()
+    connector = _loop_to_connector.get(loop, None)
+    if connector is None or connector.closed:
+        connector = _loop_to_connector[loop] = aiohttp.TCPConnector(
+            limit=_connector_limit,
+            limit_per_host=_connector_limit_per_host,
+            ssl=get_ssl_context(),
+            resolver=_get_shared_resolver(),
+            # 用自己的DNS缓存
+            use_dns_cache=False,
+        )
+    return connector
+
+
+async def close_shared_connectors():
+    """
+    关闭当前事件循环共享的连接池，一般在程序退出前调用
+    """
+    connector = _loop_to_connector.pop(asyncio.get_running_loop(), None)
+    if connector is not None:
+        await connector.close()
+
+
+def record_connect(connect_time: Optional[float]):
+    """
+    记录一次建立WebSocket连接
+
+    :param connect_time: 耗时（秒），None表示失败
+    """
+    _connect_stats.connect_count += 1
+    if connect_time is None:
+        _connect_stats.connect_failed_count += 1
+        return
+    _connect_stats.connect_time_total += connect_time
+    if connect_time > _connect_stats.connect_time_max:
+        _connect_stats.connect_time_max = connect_time
+
+
+def get_stats() -> dict:
+    """
+    返回建立连接、DNS解析和TLS握手的统计数据
+    """
+    stats = {
+        'connect_count': _connect_stats.connect_count,
+        'connect_failed_count': _connect_stats.connect_failed_count,
+        'connect_time_total': _connect_stats.connect_time_total,
+        'connect_time_max': _connect_stats.connect_time_max,
+        'dns_query_count': _connect_stats.dns_query_count,
+        'dns_cache_hit_count': _connect_stats.dns_cache_hit_count,
+        'dns_resolve_count': _connect_stats.dns_resolve_count,
+        'dns_resolve_failed_count': _connect_stats.dns_resolve_failed_count,
+        'dns_resolve_time_total': _connect_stats.dns_resolve_time_total,
+        'dns_resolve_time_max': _connect_stats.dns_resolve_time_max,
+        'dns_cached_host_count': len(_dns_cache),
+        'tls_handshake_count': 0,
+        'tls_resumed_count': 0,
+        'tls_cached_session_count': 0,
+    }
+    if _ssl_context is not None:
+        stats['tls_handshake_count'] = _ssl_context.handshake_count
+        stats['tls_resumed_count'] = _ssl_context.resumed_count
+        stats['tls_cached_session_count'] = len(_ssl_context._session_cache)  # noqa
+    return stats
@@ -9,8 +9,12 @@ import uuid
 from typing import *
 
 import aiohttp
+import yarl
 
-from . import ws_base
+from . import net, open_live_session, ws_base
+
+if TYPE_CHECKING:
+    from . import open_live_manager
 
 __all__ = (
     'OpenLiveClient',
@@ -21,6 +25,37 @@ logger = logging.getLogger('blivedm')
 START_URL = 'https://live-open.biliapi.com/v2/app/start'
 HEARTBEAT_URL = 'https://live-open.biliapi.com/v2/app/heartbeat'
 END_URL = 'https://live-open.biliapi.com/v2/app/end'
+BATCH_HEARTBEAT_URL = 'https://live-open.biliapi.com/v2/app/batchHeartbeat'
+
+
+def request_open_live(session: aiohttp.ClientSession, access_key_id: str, access_key_secret: str, url, body: dict):
+    """
+    发送带签名的开放平台请求
+
+    :return: session.post的返回值，用async with获取响应
+    """
+    body_bytes = json.dumps(body).encode('utf-8')
+    headers = {
+        'x-bili-accesskeyid': access_key_id,
+        'x-bili-content-md5': hashlib.md5(body_bytes).hexdigest(),
+        'x-bili-signature-method': 'HMAC-SHA256',
+        'x-bili-signature-nonce': uuid.uuid4().hex,
+        'x-bili-signature-version': '1.0',
+        'x-bili-timestamp': str(int(datetime.datetime.now().timestamp())),
+    }
+
+    str_to_sign = '\n'.join(
+        f'{key}:{value}'
+        for key, value in headers.items()
+    )
+    signature = hmac.new(
+        access_key_secret.encode('utf-8'), str_to_sign.encode('utf-8'), hashlib.sha256
+    ).hexdigest()
+    headers['Authorization'] = signature
+
+    headers['Content-Type'] = 'application/json'
+    headers['Accept'] = 'application/json'
+    return session.post(url, headers=headers, data=body_bytes)
 
 
 class OpenLiveClient(ws_base.WebSocketClientBase):
@@ -36,6 +71,8 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
     :param session: cookie、连接池
     :param heartbeat_interval: 发送连接心跳包的间隔时间（秒）
     :param game_heartbeat_interval: 发送项目心跳包的间隔时间（秒）
+    :param connection_count: 同时保持的WebSocket连接数，大于1时开启冗余模式，多个连接收到的消息会合并去重
+    :param ws_transport: 连接弹幕服务器用的WebSocket实现，见ws_base.TransportType，HTTP接口总是用aiohttp
     """
 
     def __init__(
@@ -48,14 +85,17 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         session: Optional[aiohttp.ClientSession] = None,
         heartbeat_interval=30,
         game_heartbeat_interval=20,
+        connection_count=1,
+        ws_transport=ws_base.TransportType.AIOHTTP,
     ):
-        super().__init__(session, heartbeat_interval)
+        super().__init__(session, heartbeat_interval, connection_count, ws_transport)
 
         self._access_key_id = access_key_id
         self._access_key_secret = access_key_secret
         self._app_id = app_id
         self._room_owner_auth_code = room_owner_auth_code
         self._game_heartbeat_interval = game_heartbeat_interval
+        self._internal_cmd_markers = (b'LIVE_OPEN_PLATFORM_INTERACTION_END',)
 
         # 在调用init_room后初始化的字段
         self._room_owner_uid: Optional[int] = None
@@ -72,6 +112,14 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         # 在运行时初始化的字段
         self._game_heartbeat_timer_handle: Optional[asyncio.TimerHandle] = None
         """发项目心跳包定时器的handle"""
+        self._manager: Optional['open_live_manager.OpenLiveManager'] = None
+        """批量管理本客户端的管理器，有管理器时由管理器批量发项目心跳包，开启、关闭项目也由管理器限制并发数"""
+        self._game_session_store: Optional[open_live_session.GameSessionStoreInterface] = None
+        """保存项目场次的存储，没有时为None，见set_game_session_store"""
+        self._end_game_on_close = True
+        """close时是否关闭项目"""
+        self._need_restore_game = False
+        """下次init_room时先尝试恢复保存的项目场次，只在第一次init_room时尝试"""
 
     @property
     def room_owner_uid(self) -> Optional[int]:
@@ -108,6 +156,50 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         """
         return self._game_id
 
+    def set_game_session_store(
+        self,
+        store: Optional[open_live_session.GameSessionStoreInterface],
+        *,
+        end_game_on_close=False,
+    ):
+        """
+        设置保存项目场次的存储，在第一次init_room之前调用。开启项目后会保存项目场次，下次启动时如果保存的项目场次
+        发心跳包还有效，就直接用它连接，不用重新开启项目，这样重启进程时不会关闭项目，也不会短时间内无法重复连接同一个房间
+
+        :param store: 项目场次的存储，None表示不保存
+        :param end_game_on_close: close时是否关闭项目。默认不关闭，项目在心跳超时后由服务器关闭，
+            在这之前重启的进程可以继续使用。彻底不用这个房间时应该传True，或者调用end_game
+        """
+        self._game_session_store = store
+        self._end_game_on_close = store is None or end_game_on_close
+        self._need_restore_game = store is not None and self._game_id is None
+
+    @property
+    def _game_session_key(self) -> str:
+        return f'{self._app_id}:{self._room_owner_auth_code}'
+
+    async def end_game(self):
+        """
+        关闭项目并删除保存的项目场次，set_game_session_store时end_game_on_close=False的客户端彻底不用时调用。
+        关闭失败时不删除保存的项目场次
+
+        :return: 是否成功
+        """
+        if self._game_heartbeat_timer_handle is not None:
+            self._game_heartbeat_timer_handle.cancel()
+            self._game_heartbeat_timer_handle = None
+        res = await self._end_game()
+        if not res:
+            # 保留保存的项目场次，下次启动的进程还能恢复或者关闭这个项目
+            return False
+        self._game_id = ''
+        if self._game_session_store is not None:
+            try:
+                await self._game_session_store.delete(self._game_session_key)
+            except Exception:  # noqa
+                logger.exception('room=%s end_game() failed to delete game session:', self._room_id)
+        return True
+
     async def close(self):
         """
         释放本客户端的资源，调用后本客户端将不可用
@@ -115,36 +207,37 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         if self.is_running:
             logger.warning('room=%s is calling close(), but client is running', self.room_id)
 
+        # 还在管理时关闭项目，这样请求受管理器的并发数限制
+        if self._end_game_on_close:
+            await self.end_game()
+        # 移出管理时会恢复自己发项目心跳包的定时器（项目没关闭时），之后才能取消
+        if self._manager is not None:
+            self._manager.remove_client(self)
         if self._game_heartbeat_timer_handle is not None:
             self._game_heartbeat_timer_handle.cancel()
             self._game_heartbeat_timer_handle = None
-        await self._end_game()
 
         await super().close()
 
-    def _request_open_live(self, url, body: dict):
-        body_bytes = json.dumps(body).encode('utf-8')
-        headers = {
-            'x-bili-accesskeyid': self._access_key_id,
-            'x-bili-content-md5': hashlib.md5(body_bytes).hexdigest(),
-            'x-bili-signature-method': 'HMAC-SHA256',
-            'x-bili-signature-nonce': uuid.uuid4().hex,
-            'x-bili-signature-version': '1.0',
-            'x-bili-timestamp': str(int(datetime.datetime.now().timestamp())),
-        }
-
-        str_to_sign = '\n'.join(
-            f'{key}:{value}'
-            for key, value in headers.items()
-        )
-        signature = hmac.new(
-            self._access_key_secret.encode('utf-8'), str_to_sign.encode('utf-8'), hashlib.sha256
-        ).hexdigest()
-        headers['Authorization'] = signature
+    def _set_manager(self, manager: Optional['open_live_manager.OpenLiveManager']):
+        """
+        由OpenLiveManager.add_client、remove_client调用
+        """
+        self._manager = manager
+        if manager is not None:
+            # 项目心跳包交给管理器批量发
+            if self._game_heartbeat_timer_handle is not None:
+                self._game_heartbeat_timer_handle.cancel()
+                self._game_heartbeat_timer_handle = None
+        elif self._game_id not in (None, '') and self._game_heartbeat_timer_handle is None:
+            self._game_heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+                self._game_heartbeat_interval, self._on_send_game_heartbeat
+            )
 
-        headers['Content-Type'] = 'application/json'
-        headers['Accept'] = 'application/json'
-        return self._session.post(url, headers=headers, data=body_bytes)
+    def _request_open_live(self, url, body: dict):
+        if self._manager is not None:
+            return self._manager.request_limited(url, body)
+        return request_open_live(self._session, self._access_key_id, self._access_key_secret, url, body)
 
     async def init_room(self):
         """
@@ -152,10 +245,16 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
 
         :return: 是否成功
         """
-        if not await self._start_game():
-            return False
-
-        if self._game_id != '' and self._game_heartbeat_timer_handle is None:
+        restored = False
+        if self._need_restore_game:
+            self._need_restore_game = False
+            restored = await self._restore_game()
+        if not restored:
+            if not await self._start_game():
+                return False
+            await self._save_game()
+
+        if self._game_id != '' and self._game_heartbeat_timer_handle is None and self._manager is None:
             self._game_heartbeat_timer_handle = asyncio.get_running_loop().call_later(
                 self._game_heartbeat_interval, self._on_send_game_heartbeat
             )
@@ -182,11 +281,84 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
             return False
         return True
 
+    async def _restore_game(self):
+        """
+        恢复保存的项目场次，发一次心跳包确认项目还没关闭
+
+        :return: 是否成功
+        """
+        store = self._game_session_store
+        key = self._game_session_key
+        try:
+            session = await store.load(key)
+        except Exception:  # noqa
+            logger.exception('_restore_game() failed to load game session:')
+            return False
+        if session is None:
+            return False
+
+        if not await self._check_game_alive(session.game_id):
+            logger.info('room=%d saved game is not alive, starting a new game, game_id=%s', session.room_id,
+                        session.game_id)
+            try:
+                await store.delete(key)
+            except Exception:  # noqa
+                logger.exception('_restore_game() failed to delete game session:')
+            return False
+
+        self._game_id = session.game_id
+        self._auth_body = session.auth_body
+        self._host_server_url_list = session.wss_link
+        urls = [yarl.URL(url) for url in self._host_server_url_list]
+        net.prefetch_hosts((url.host, url.port) for url in urls if url.host is not None)
+        self._room_id = session.room_id
+        self._room_owner_uid = session.room_owner_uid
+        self._room_owner_open_id = session.room_owner_open_id
+        logger.info('room=%d restored game, game_id=%s', self._room_id, self._game_id)
+        return True
+
+    async def _check_game_alive(self, game_id: str):
+        """
+        发一次项目心跳包，检查项目是否还没关闭
+        """
+        try:
+            async with self._request_open_live(HEARTBEAT_URL, {'game_id': game_id}) as res:
+                if res.status != 200:
+                    logger.warning('_check_game_alive() failed, status=%d, reason=%s', res.status, res.reason)
+                    return False
+                data = await res.json()
+                return data['code'] == 0
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            logger.exception('_check_game_alive() failed:')
+            return False
+
+    async def _save_game(self):
+        """
+        开启项目后保存项目场次
+        """
+        if self._game_session_store is None or self._game_id in (None, ''):
+            return
+        session = open_live_session.GameSession(
+            game_id=self._game_id,
+            auth_body=self._auth_body,
+            wss_link=list(self._host_server_url_list),
+            room_id=self._room_id,
+            room_owner_uid=self._room_owner_uid,
+            room_owner_open_id=self._room_owner_open_id,
+        )
+        try:
+            await self._game_session_store.save(self._game_session_key, session)
+        except Exception:  # noqa
+            logger.exception('room=%d _save_game() failed:', self._room_id)
+
     def _parse_start_game(self, data):
         self._game_id = data['game_info']['game_id']
         websocket_info = data['websocket_info']
         self._auth_body = websocket_info['auth_body']
         self._host_server_url_list = websocket_info['wss_link']
+        # 在后台预先解析弹幕服务器的DNS，重连时不用等DNS
+        urls = [yarl.URL(url) for url in self._host_server_url_list]
+        net.prefetch_hosts((url.host, url.port) for url in urls if url.host is not None)
         anchor_info = data['anchor_info']
         self._room_id = anchor_info['room_id']
         self._room_owner_uid = anchor_info['uid']
@@ -258,11 +430,8 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
                     logger.warning('room=%d _send_game_heartbeat() failed, code=%d, message=%s, request_id=%s',
                                    self._room_id, code, data['message'], data['request_id'])
 
-                    if code == 7003 and self._game_id == game_id:
-                        # 项目异常关闭，可能是心跳超时，需要重新开启项目
-                        self._need_init_room = True
-                        if self._websocket is not None and not self._websocket.closed:
-                            await self._websocket.close()
+                    if code == 7003:
+                        await self._on_game_heartbeat_failed(game_id)
 
                     return False
         except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
@@ -270,6 +439,23 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
             return False
         return True
 
+    async def _on_game_heartbeat_failed(self, game_id: str):
+        """
+        项目心跳包返回7003，批量心跳时由管理器调用
+        """
+        if self._game_id == game_id:
+            # 项目异常关闭，可能是心跳超时，需要重新开启项目
+            await self._reinit_room_and_migrate()
+
+    async def _reinit_room_and_migrate(self):
+        """
+        重新开启项目，然后平滑迁移连接。迁移失败则断开连接，让连接协程重新开启项目后重连
+        """
+        if not self._is_migrating and await self.migrate(reinit_room=True):
+            return
+        self._need_init_room = True
+        await self._close_websockets()
+
     async def _on_before_ws_connect(self, retry_count):
         """
         在每次建立连接之前调用，可以用来初始化房间
@@ -286,22 +472,24 @@ class OpenLiveClient(ws_base.WebSocketClientBase):
         """
         return self._host_server_url_list[retry_count % len(self._host_server_url_list)]
 
-    async def _send_auth(self):
+    async def _send_auth(self, websocket: aiohttp.ClientWebSocketResponse):
         """
         发送认证包
         """
-        await self._websocket.send_bytes(self._make_packet(self._auth_body, ws_base.Operation.AUTH))
+        await websocket.send_bytes(self._make_packet(self._auth_body, ws_base.Operation.AUTH))
 
     def _handle_command(self, command: dict):
+        if self._handle_internal_command(command):
+            return
+        super()._handle_command(command)
+
+    def _handle_internal_command(self, command: dict) -> bool:
         cmd = command.get('cmd', '')
         if cmd == 'LIVE_OPEN_PLATFORM_INTERACTION_END':
             if command['data']['game_id'] == self._game_id:
                 # 服务器主动停止推送，可能是心跳超时，需要重新开启项目
                 logger.warning('room=%d game end by server, game_id=%s', self._room_id, self._game_id)
 
-                self._need_init_room = True
-                if self._websocket is not None and not self._websocket.closed:
-                    asyncio.create_task(self._websocket.close())
-            return
-
-        super()._handle_command(command)
+                asyncio.create_task(self._reinit_room_and_migrate())
+            return True
+        return False
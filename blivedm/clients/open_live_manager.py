@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import logging
+import time
+from typing import *
+
+import aiohttp
+
+from . import net, open_live, open_live_session
+
+__all__ = (
+    'OpenLiveManager',
+)
+
+logger = logging.getLogger('blivedm')
+
+BATCH_HEARTBEAT_MAX_GAME_IDS = 200
+"""批量项目心跳接口一次最多这么多个game_id"""
+
+
+class OpenLiveManager:
+    """
+    批量管理同一个开放平台项目的多个OpenLiveClient
+
+    - 所有客户端的项目心跳包合并成批量心跳请求，每个心跳间隔只发 ceil(场次数 / 200) 个请求
+    - 开启、关闭项目的请求限制并发数，启动、关闭大量客户端时不会瞬间发出大量请求
+    - 批量心跳返回的失败场次交给对应的客户端处理，和单独发心跳返回7003一样重新开启项目
+
+    用法::
+
+        manager = OpenLiveManager(ACCESS_KEY_ID, ACCESS_KEY_SECRET, APP_ID)
+        manager.start()
+        for auth_code in auth_codes:
+            client = manager.create_client(auth_code)
+            client.set_handler(handler)
+            client.start()
+        ...
+        await manager.stop_and_close(timeout=10)
+
+    :param access_key_id: 在开放平台申请的access_key_id
+    :param access_key_secret: 在开放平台申请的access_key_secret
+    :param app_id: 在开放平台创建的项目ID
+    :param session: 连接池，不传则创建自己的session，和其他客户端共用连接池
+    :param game_heartbeat_interval: 发送批量项目心跳包的间隔时间（秒）
+    :param request_concurrency: 开启、关闭项目的请求最多同时发这么多个
+    :param game_session_store: create_client创建的客户端用的项目场次存储，见OpenLiveClient.set_game_session_store
+    """
+
+    def __init__(
+        self,
+        access_key_id: str,
+        access_key_secret: str,
+        app_id: int,
+        *,
+        session: Optional[aiohttp.ClientSession] = None,
+        game_heartbeat_interval: float = 20,
+        request_concurrency: int = 10,
+        game_session_store: Optional[open_live_session.GameSessionStoreInterface] = None,
+    ):
+        self._access_key_id = access_key_id
+        self._access_key_secret = access_key_secret
+        self._app_id = app_id
+        if session is None:
+            self._session = aiohttp.ClientSession(
+                connector=net.get_shared_connector(),
+                connector_owner=False,
+                timeout=aiohttp.ClientTimeout(total=10),
+            )
+            self._own_session = True
+        else:
+            self._session = session
+            self._own_session = False
+        self._game_heartbeat_interval = game_heartbeat_interval
+        self._request_semaphore = asyncio.Semaphore(request_concurrency)
+        self._game_session_store = game_session_store
+
+        self._clients: Dict[open_live.OpenLiveClient, None] = {}
+        """管理的客户端，用dict保持顺序"""
+        self._game_heartbeat_timer_handle: Optional[asyncio.TimerHandle] = None
+        """发批量项目心跳包定时器的handle"""
+
+        self._heartbeat_request_count = 0
+        """发出的批量心跳请求数"""
+        self._heartbeat_failed_game_count = 0
+        """批量心跳返回失败的场次数"""
+
+    @property
+    def is_running(self) -> bool:
+        """
+        正在定时发送批量项目心跳包
+        """
+        return self._game_heartbeat_timer_handle is not None
+
+    @property
+    def clients(self) -> List[open_live.OpenLiveClient]:
+        """
+        管理的客户端
+        """
+        return list(self._clients)
+
+    def get_stats(self) -> dict:
+        """
+        返回统计数据
+        """
+        return {
+            'client_count': len(self._clients),
+            'game_count': sum(1 for client in self._clients if client.game_id not in (None, '')),
+            'heartbeat_request_count': self._heartbeat_request_count,
+            'heartbeat_failed_game_count': self._heartbeat_failed_game_count,
+        }
+
+    def create_client(self, room_owner_auth_code: str, **kwargs) -> open_live.OpenLiveClient:
+        """
+        用本管理器的开发者密钥和session创建客户端，并加入管理
+
+        :param room_owner_auth_code: 主播身份码
+        :param kwargs: 见OpenLiveClient
+        """
+        kwargs.setdefault('session', self._session)
+        client = open_live.OpenLiveClient(
+            access_key_id=self._access_key_id,
+            access_key_secret=self._access_key_secret,
+            app_id=self._app_id,
+            room_owner_auth_code=room_owner_auth_code,
+            **kwargs,
+        )
+        if self._game_session_store is not None:
+            client.set_game_session_store(self._game_session_store)
+        self.add_client(client)
+        return client
+
+    def add_client(self, client: open_live.OpenLiveClient):
+        """
+        加入管理，之后客户端不再自己发项目心跳包。客户端必须属于同一个开放平台项目
+
+        :param client: 客户端
+        """
+        if client.app_id != self._app_id:
+            raise ValueError(f'client app_id={client.app_id} does not match manager app_id={self._app_id}')
+        if client in self._clients:
+            return
+        self._clients[client] = None
+        client._set_manager(self)  # noqa
+
+    def remove_client(self, client: open_live.OpenLiveClient):
+        """
+        移出管理，之后客户端自己发项目心跳包。客户端close时会自动调用
+
+        :param client: 客户端
+        """
+        if client not in self._clients:
+            return
+        del self._clients[client]
+        client._set_manager(None)  # noqa
+
+    def start(self):
+        """
+        开始定时发送批量项目心跳包
+        """
+        if self.is_running:
+            logger.warning('open live manager is running, cannot start() again')
+            return
+
+        self._game_heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+            self._game_heartbeat_interval, self._on_send_game_heartbeat
+        )
+
+    def stop(self):
+        """
+        停止定时发送批量项目心跳包
+        """
+        if not self.is_running:
+            logger.warning('open live manager is stopped, cannot stop() again')
+            return
+
+        self._game_heartbeat_timer_handle.cancel()
+        self._game_heartbeat_timer_handle = None
+
+    async def stop_and_close(self, timeout: Optional[float] = None):
+        """
+        并行停止并关闭所有客户端，然后释放资源，调用后本管理器将不可用。设置了项目场次存储的客户端默认不关闭项目
+
+        :param timeout: 最多等待这个时间（秒），超时后不再等待还没关闭的项目，None表示一直等待
+        """
+        clients = list(self._clients)
+        start_time = time.monotonic()
+        tasks = [asyncio.create_task(client.stop_and_close()) for client in clients]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            if pending:
+                logger.warning('open live manager stop_and_close() timed out, %d/%d clients are not closed',
+                               len(pending), len(tasks))
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+            logger.info('open live manager closed %d clients in %.3fs', len(tasks), time.monotonic() - start_time)
+
+        if self.is_running:
+            self.stop()
+        for client in list(self._clients):
+            self.remove_client(client)
+        if self._own_session:
+            await self._session.close()
+
+    @contextlib.asynccontextmanager
+    async def request_limited(self, url, body: dict):
+        """
+        限制并发数地发送带签名的开放平台请求，客户端开启、关闭项目时调用
+
+        :return: 用async with获取响应
+        """
+        async with self._request_semaphore:
+            async with open_live.request_open_live(
+                self._session, self._access_key_id, self._access_key_secret, url, body
+            ) as res:
+                yield res
+
+    def _on_send_game_heartbeat(self):
+        """
+        定时发送批量项目心跳包的回调
+        """
+        self._game_heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+            self._game_heartbeat_interval, self._on_send_game_heartbeat
+        )
+        asyncio.create_task(self.send_game_heartbeat())
+
+    async def send_game_heartbeat(self):
+        """
+        给所有已开启项目的客户端发送批量项目心跳包，一般不用手动调用
+        """
+        game_id_to_client = {
+            client.game_id: client
+            for client in self._clients
+            if client.game_id not in (None, '')
+        }
+        if not game_id_to_client:
+            return
+        game_ids = list(game_id_to_client)
+        await asyncio.gather(*(
+            self._send_batch_game_heartbeat(game_ids[i:i + BATCH_HEARTBEAT_MAX_GAME_IDS], game_id_to_client)
+            for i in range(0, len(game_ids), BATCH_HEARTBEAT_MAX_GAME_IDS)
+        ))
+
+    async def _send_batch_game_heartbeat(
+        self, game_ids: List[str], game_id_to_client: Dict[str, open_live.OpenLiveClient]
+    ):
+        self._heartbeat_request_count += 1
+        try:
+            # 心跳不受开启、关闭项目的并发数限制，否则大量开启项目时心跳可能超时
+            async with open_live.request_open_live(
+                self._session, self._access_key_id, self._access_key_secret, open_live.BATCH_HEARTBEAT_URL,
+                {'game_ids': game_ids}
+            ) as res:
+                if res.status != 200:
+                    logger.warning('_send_batch_game_heartbeat() failed, status=%d, reason=%s', res.status,
+                                   res.reason)
+                    return
+                data = await res.json()
+                code = data['code']
+                if code != 0:
+                    logger.warning('_send_batch_game_heartbeat() failed, code=%d, message=%s, request_id=%s',
+                                   code, data['message'], data['request_id'])
+                    return
+                failed_game_ids = (data.get('data', None) or {}).get('failed_game_ids', None) or []
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            logger.exception('_send_batch_game_heartbeat() failed:')
+            return
+
+        self._heartbeat_failed_game_count += len(failed_game_ids)
+        for game_id in failed_game_ids:
+            client = game_id_to_client.get(game_id, None)
+            if client is None:
+                continue
+            logger.warning('room=%s batch heartbeat failed, game_id=%s', client.room_id, game_id)
+            # 和单独发心跳返回7003一样处理
+            asyncio.create_task(client._on_game_heartbeat_failed(game_id))  # noqa
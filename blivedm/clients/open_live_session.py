@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import dataclasses
+import json
+import logging
+import os
+import time
+from typing import *
+
+__all__ = (
+    'GameSession',
+    'GameSessionStoreInterface',
+    'FileGameSessionStore',
+)
+
+logger = logging.getLogger('blivedm')
+
+
+@dataclasses.dataclass
+class GameSession:
+    """
+    开放平台的一个项目场次，保存下来以便重启进程后继续使用
+    """
+
+    game_id: str
+    """项目场次ID"""
+    auth_body: str
+    """连接弹幕服务器用的认证包内容"""
+    wss_link: List[str]
+    """弹幕服务器URL列表"""
+    room_id: int
+    """房间ID"""
+    room_owner_uid: int
+    """主播用户ID"""
+    room_owner_open_id: str
+    """主播Open ID"""
+    start_time: float = dataclasses.field(default_factory=time.time)
+    """开启项目的时间戳（秒）"""
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            game_id=data['game_id'],
+            auth_body=data['auth_body'],
+            wss_link=list(data['wss_link']),
+            room_id=data['room_id'],
+            room_owner_uid=data['room_owner_uid'],
+            room_owner_open_id=data['room_owner_open_id'],
+            start_time=data.get('start_time', 0.0),
+        )
+
+    def to_dict(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+class GameSessionStoreInterface:
+    """
+    项目场次的存储，键是 f'{app_id}:{主播身份码}'。可以自己实现，比如存到Redis让多个进程共用
+    """
+
+    async def load(self, key: str) -> Optional[GameSession]:
+        """
+        读取项目场次，没有则返回None
+        """
+        raise NotImplementedError
+
+    async def save(self, key: str, session: GameSession):
+        """
+        保存项目场次，覆盖旧的
+        """
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        """
+        删除项目场次，没有则忽略
+        """
+        raise NotImplementedError
+
+
+class FileGameSessionStore(GameSessionStoreInterface):
+    """
+    把所有项目场次存到一个JSON文件，每次修改都先写临时文件再替换，进程崩溃也不会写坏文件
+
+    注意文件里有连接弹幕服务器用的认证包内容，要注意权限
+
+    :param path: 文件路径，不存在会自动创建
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._sessions: Dict[str, dict] = {}
+        """键 -> 项目场次的dict"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                self._sessions = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logger.exception('failed to load game sessions from %s, starting empty', path)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    async def load(self, key: str) -> Optional[GameSession]:
+        data = self._sessions.get(key, None)
+        if data is None:
+            return None
+        try:
+            return GameSession.from_dict(data)
+        except (KeyError, TypeError):
+            logger.warning('bad game session, key=%s', key)
+            return None
+
+    async def save(self, key: str, session: GameSession):
+        self._sessions[key] = session.to_dict()
+        self._write()
+
+    async def delete(self, key: str):
+        if self._sessions.pop(key, None) is not None:
+            self._write()
+
+    def _write(self):
+        # 文件很小，直接在事件循环里写
+        tmp_path = self._path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._sessions, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            logger.exception('failed to save game sessions to %s', self._path)
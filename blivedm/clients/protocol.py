@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+不依赖网络库和事件循环的弹幕协议核心（sans-IO）
+
+Protocol只负责把收到的数据解析成事件、把要发的包放进发送缓冲区，收发数据由调用者用任意传输方式完成，
+所以可以在WebSocket、TCP、子进程、没有事件循环的基准测试里复用同一套解析逻辑
+"""
+import enum
+import json
+import logging
+import struct
+import zlib
+from typing import *
+
+__all__ = (
+    'HEADER_STRUCT',
+    'HeaderTuple',
+    'ProtoVer',
+    'Operation',
+    'AuthReplyCode',
+    'AuthError',
+    'ProtocolError',
+    'make_packet',
+    'make_heartbeat_command',
+    'CommandEvent',
+    'CompressedEvent',
+    'HeartbeatReplyEvent',
+    'AuthReplyEvent',
+    'RegisterReplyEvent',
+    'UnknownPacketEvent',
+    'Protocol',
+)
+
+logger = logging.getLogger('blivedm')
+
+HEADER_STRUCT = struct.Struct('>I2H2I')
+
+
+class HeaderTuple(NamedTuple):
+    pack_len: int
+    raw_header_size: int
+    ver: int
+    operation: int
+    seq_id: int
+
+
+def unpack_header(data: bytes, offset: int) -> HeaderTuple:
+    return HeaderTuple(*HEADER_STRUCT.unpack_from(data, offset))
+
+
+def brotli_decompress(data: bytes) -> bytes:
+    """
+    第一次解压时才导入brotli，之后这个名字直接指向brotli.decompress
+    """
+    global brotli_decompress
+    import brotli
+    brotli_decompress = brotli.decompress
+    return brotli.decompress(data)
+
+
+# WS_BODY_PROTOCOL_VERSION
+class ProtoVer(enum.IntEnum):
+    NORMAL = 0
+    HEARTBEAT = 1
+    DEFLATE = 2
+    BROTLI = 3
+
+
+# go-common\app\service\main\broadcast\model\operation.go
+class Operation(enum.IntEnum):
+    HANDSHAKE = 0
+    HANDSHAKE_REPLY = 1
+    HEARTBEAT = 2
+    HEARTBEAT_REPLY = 3
+    SEND_MSG = 4
+    SEND_MSG_REPLY = 5
+    DISCONNECT_REPLY = 6
+    AUTH = 7
+    AUTH_REPLY = 8
+    RAW = 9
+    PROTO_READY = 10
+    PROTO_FINISH = 11
+    CHANGE_ROOM = 12
+    CHANGE_ROOM_REPLY = 13
+    REGISTER = 14
+    REGISTER_REPLY = 15
+    UNREGISTER = 16
+    UNREGISTER_REPLY = 17
+    # B站业务自定义OP
+    # MinBusinessOp = 1000
+    # MaxBusinessOp = 10000
+
+
+# WS_AUTH
+class AuthReplyCode(enum.IntEnum):
+    OK = 0
+    TOKEN_ERROR = -101
+
+
+class AuthError(Exception):
+    """认证失败"""
+
+
+class ProtocolError(Exception):
+    """数据不符合协议，字节流无法继续分包"""
+
+
+def make_packet(data: Union[dict, str, bytes], operation: int, seq_id=1) -> bytes:
+    """
+    创建一个要发送给服务器的包
+
+    :param data: 包体JSON数据
+    :param operation: 操作码，见Operation
+    :param seq_id: 序列号，服务器回复时会带上
+    :return: 整个包的数据
+    """
+    if isinstance(data, dict):
+        body = json.dumps(data).encode('utf-8')
+    elif isinstance(data, str):
+        body = data.encode('utf-8')
+    else:
+        body = data
+    header = HEADER_STRUCT.pack(*HeaderTuple(
+        pack_len=HEADER_STRUCT.size + len(body),
+        raw_header_size=HEADER_STRUCT.size,
+        ver=1,
+        operation=operation,
+        seq_id=seq_id
+    ))
+    return header + body
+
+
+def make_heartbeat_command(popularity: int) -> dict:
+    """
+    服务器心跳包不是业务消息，自己造个业务消息，这样可以和其他消息一样交给消息处理器
+
+    :param popularity: 人气值
+    """
+    return {
+        'cmd': '_HEARTBEAT',
+        'data': {
+            'popularity': popularity
+        }
+    }
+
+
+class CommandEvent(NamedTuple):
+    """
+    收到一条业务消息
+    """
+
+    header: HeaderTuple
+    """包头"""
+    command: Optional[dict]
+    """业务消息，不反序列化时是None"""
+    body: bytes
+    """业务消息的原始JSON数据"""
+
+
+class CompressedEvent(NamedTuple):
+    """
+    收到压缩过的业务消息，只有不解压时才有。调用者解压后再用Protocol.receive_message处理
+    """
+
+    header: HeaderTuple
+    """包头，ver是压缩格式"""
+    body: bytes
+    """压缩过的数据"""
+
+
+class HeartbeatReplyEvent(NamedTuple):
+    """
+    收到服务器心跳包
+    """
+
+    header: HeaderTuple
+    """包头"""
+    popularity: int
+    """人气值"""
+
+
+class AuthReplyEvent(NamedTuple):
+    """
+    收到认证响应。认证成功时发送缓冲区会自动加一个心跳包，认证失败怎么处理由调用者决定
+    """
+
+    header: HeaderTuple
+    """包头"""
+    body: dict
+    """响应内容"""
+
+    @property
+    def code(self) -> int:
+        return self.body.get('code', None)
+
+    @property
+    def ok(self) -> bool:
+        return self.code == AuthReplyCode.OK
+
+
+class RegisterReplyEvent(NamedTuple):
+    """
+    收到注册、取消注册房间的响应，header.operation区分是哪种，header.seq_id是请求时的序列号
+    """
+
+    header: HeaderTuple
+    """包头"""
+    body: dict
+    """响应内容"""
+
+    @property
+    def code(self) -> int:
+        return self.body.get('code', None)
+
+
+class UnknownPacketEvent(NamedTuple):
+    """
+    未知操作码或者协议版本的包
+    """
+
+    header: HeaderTuple
+    """包头"""
+    body: bytes
+    """包体"""
+
+
+Event = Union[
+    CommandEvent, CompressedEvent, HeartbeatReplyEvent, AuthReplyEvent, RegisterReplyEvent, UnknownPacketEvent
+]
+
+
+class Protocol:
+    """
+    弹幕协议的状态机，不做任何IO：把收到的数据喂给它，返回解析出的事件；要发送的包放在发送缓冲区，
+    用data_to_send取出来自己发送
+
+    WebSocket的一条消息包含完整的包，用receive_message；TCP等字节流可能在任意位置断开，用receive_data
+
+    用法::
+
+        protocol = Protocol()
+        protocol.send_auth(auth_body)
+        for packet in protocol.data_to_send():
+            websocket.send(packet)
+
+        for event in protocol.receive_message(websocket.recv()):
+            if isinstance(event, CommandEvent):
+                handle(event.command)
+            elif isinstance(event, AuthReplyEvent) and not event.ok:
+                raise AuthError(...)
+        # 认证成功后发送缓冲区里有心跳包
+        for packet in protocol.data_to_send():
+            websocket.send(packet)
+
+    :param decompress: 是否在receive_message里同步解压，False则返回CompressedEvent，调用者可以放到其他线程解压
+    :param decode_json: 是否反序列化业务消息，False则CommandEvent.command是None，适合直通模式
+    """
+
+    def __init__(self, decompress=True, decode_json=True):
+        self._decompress = decompress
+        self._decode_json = decode_json
+
+        self._outgoing: List[bytes] = []
+        """发送缓冲区，每个元素是一个完整的包"""
+        self._stream_buffer = bytearray()
+        """receive_data收到的还不完整的包"""
+        self._is_authed = False
+        """收到了认证成功的响应"""
+
+    @property
+    def is_authed(self) -> bool:
+        """
+        收到了认证成功的响应
+        """
+        return self._is_authed
+
+    def send_packet(self, data: Union[dict, str, bytes], operation: int, seq_id=1):
+        """
+        把一个包放进发送缓冲区，参数见make_packet
+        """
+        self._outgoing.append(make_packet(data, operation, seq_id))
+
+    def send_auth(self, auth_body: Union[dict, str, bytes], seq_id=1):
+        """
+        把认证包放进发送缓冲区
+
+        :param auth_body: 认证包内容
+        :param seq_id: 序列号
+        """
+        self._is_authed = False
+        self.send_packet(auth_body, Operation.AUTH, seq_id)
+
+    def send_heartbeat(self):
+        """
+        把心跳包放进发送缓冲区
+        """
+        self.send_packet({}, Operation.HEARTBEAT)
+
+    def data_to_send(self) -> List[bytes]:
+        """
+        取出发送缓冲区里所有的包
+        """
+        packets = self._outgoing
+        self._outgoing = []
+        return packets
+
+    def receive_message(
+        self, data: bytes, header_parser: Callable[[bytes, int], HeaderTuple] = unpack_header
+    ) -> List[Event]:
+        """
+        处理一条WebSocket消息
+
+        :param data: WebSocket消息数据，包含一个或多个完整的包
+        :param header_parser: 解析包头的函数，客户端用来在解析包头时调用阶段钩子
+        :return: 解析出的事件
+        """
+        return list(self._iter_message(data, header_parser))
+
+    def iter_message(
+        self, data: bytes, header_parser: Callable[[bytes, int], HeaderTuple] = unpack_header
+    ) -> Iterator[Event]:
+        """
+        同receive_message，但是边解析边返回事件，一条WebSocket消息包含很多包时不用同时保存所有包体
+        """
+        return self._iter_message(data, header_parser)
+
+    def receive_data(self, data: bytes) -> List[Event]:
+        """
+        处理字节流收到的数据，不完整的包留到下次
+
+        :param data: 收到的数据
+        :return: 解析出的事件
+        """
+        buffer = self._stream_buffer
+        buffer += data
+        events: List[Event] = []
+        offset = 0
+        header_size = HEADER_STRUCT.size
+        while len(buffer) - offset >= header_size:
+            pack_len = int.from_bytes(buffer[offset: offset + 4], 'big')
+            if pack_len < header_size:
+                raise ProtocolError(f'bad pack_len={pack_len}, offset={offset}')
+            if len(buffer) - offset < pack_len:
+                break
+            events.extend(self._iter_message(bytes(buffer[offset: offset + pack_len]), unpack_header))
+            offset += pack_len
+        del buffer[:offset]
+        return events
+
+    def _iter_message(self, data: bytes, header_parser: Callable[[bytes, int], HeaderTuple]) -> Iterator[Event]:
+        offset = 0
+        data_len = len(data)
+        while offset < data_len:
+            try:
+                header = header_parser(data, offset)
+            except struct.error:
+                logger.exception('parsing header failed, offset=%d, data=%s', offset, data)
+                return
+            if header.pack_len <= 0:
+                return
+
+            operation = header.operation
+            if operation == Operation.SEND_MSG_REPLY:
+                body = data[offset + header.raw_header_size: offset + header.pack_len]
+                yield from self._iter_send_msg_reply(header, body, header_parser)
+
+            elif operation == Operation.HEARTBEAT_REPLY:
+                # 服务器心跳包，前4字节是人气值，后面是客户端发的心跳包内容
+                # pack_len不包括客户端发的心跳包内容，不知道是不是服务器BUG，所以后面的数据不再分包
+                body = data[offset + header.raw_header_size: offset + header.raw_header_size + 4]
+                yield HeartbeatReplyEvent(header, int.from_bytes(body, 'big'))
+                return
+
+            elif operation == Operation.AUTH_REPLY:
+                body = data[offset + header.raw_header_size: offset + header.pack_len]
+                event = AuthReplyEvent(header, json.loads(body.decode('utf-8')))
+                if event.ok:
+                    self._is_authed = True
+                    self.send_heartbeat()
+                yield event
+
+            elif operation in (Operation.REGISTER_REPLY, Operation.UNREGISTER_REPLY):
+                body = data[offset + header.raw_header_size: offset + header.pack_len]
+                yield RegisterReplyEvent(header, json.loads(body.decode('utf-8')))
+
+            else:
+                # 未知消息，不知道pack_len可不可信，后面的数据不再分包
+                body = data[offset + header.raw_header_size: offset + header.pack_len]
+                yield UnknownPacketEvent(header, body)
+                return
+
+            offset += header.pack_len
+
+    def _iter_send_msg_reply(
+        self, header: HeaderTuple, body: bytes, header_parser: Callable[[bytes, int], HeaderTuple]
+    ) -> Iterator[Event]:
+        ver = header.ver
+        if ver == ProtoVer.NORMAL:
+            if len(body) != 0:
+                command = json.loads(body.decode('utf-8')) if self._decode_json else None
+                yield CommandEvent(header, command, body)
+        elif ver == ProtoVer.BROTLI or ver == ProtoVer.DEFLATE:
+            if not self._decompress:
+                yield CompressedEvent(header, body)
+            elif ver == ProtoVer.BROTLI:
+                yield from self._iter_message(brotli_decompress(body), header_parser)
+            else:
+                # web端已经不用zlib压缩了，但是开放平台会用
+                yield from self._iter_message(zlib.decompress(body), header_parser)
+        else:
+            yield UnknownPacketEvent(header, body)
@@ -3,6 +3,7 @@ import asyncio
 import datetime
 import hashlib
 import logging
+import time
 import urllib
 import weakref
 from typing import *
@@ -10,7 +11,7 @@ from typing import *
 import aiohttp
 import yarl
 
-from . import ws_base
+from . import net, ws_base
 from .. import utils
 
 __all__ = (
@@ -27,6 +28,10 @@ DANMAKU_SERVER_CONF_URL = 'https://api.live.bilibili.com/xlive/web-room/v1/index
 DEFAULT_DANMAKU_SERVER_LIST = [
     {'host': 'broadcastlv.chat.bilibili.com', 'port': 2243, 'wss_port': 443, 'ws_port': 2244}
 ]
+HOST_SERVER_TOKEN_REFRESH_INTERVAL = 10 * 60
+"""在后台刷新弹幕服务器token的间隔时间（秒）"""
+HOST_SERVER_TOKEN_MAX_AGE = 30 * 60
+"""token超过这个时间（秒）没刷新就不直接用来重连了，要先刷新"""
 
 _session_to_wbi_signer = weakref.WeakKeyDictionary()
 
@@ -158,6 +163,8 @@ class BLiveClient(ws_base.WebSocketClientBase):
     :param uid: B站用户ID，0表示未登录，None表示自动获取
     :param session: cookie、连接池
     :param heartbeat_interval: 发送心跳包的间隔时间（秒）
+    :param connection_count: 同时保持的WebSocket连接数，大于1时开启冗余模式，多个连接收到的消息会合并去重
+    :param ws_transport: 连接弹幕服务器用的WebSocket实现，见ws_base.TransportType，HTTP接口总是用aiohttp
     """
 
     def __init__(
@@ -167,8 +174,10 @@ class BLiveClient(ws_base.WebSocketClientBase):
         uid: Optional[int] = None,
         session: Optional[aiohttp.ClientSession] = None,
         heartbeat_interval=30,
+        connection_count=1,
+        ws_transport=ws_base.TransportType.AIOHTTP,
     ):
-        super().__init__(session, heartbeat_interval)
+        super().__init__(session, heartbeat_interval, connection_count, ws_transport)
         self._wbi_signer = _get_wbi_signer(self._session)
 
         self._tmp_room_id = room_id
@@ -186,6 +195,18 @@ class BLiveClient(ws_base.WebSocketClientBase):
         """
         self._host_server_token: Optional[str] = None
         """连接弹幕服务器用的token"""
+        self._host_server_token_time: Optional[float] = None
+        """获取token的时间（time.monotonic()），None表示token已失效"""
+
+        # 在运行时初始化的字段
+        self._auth_token: Optional[str] = None
+        """最近一次认证用的token，认证失败时用来判断是不是当前的token失效了"""
+        self._refresh_token_future: Optional[asyncio.Future] = None
+        """在后台刷新token的future，用来避免同时刷新"""
+        self._refresh_token_timer_handle: Optional[asyncio.TimerHandle] = None
+        """定时刷新token定时器的handle"""
+        self._is_closed = False
+        """调用了close，不再刷新token"""
 
     @property
     def tmp_room_id(self) -> int:
@@ -208,6 +229,33 @@ class BLiveClient(ws_base.WebSocketClientBase):
         """
         return self._uid
 
+    @property
+    def _is_host_server_token_fresh(self) -> bool:
+        """
+        token还有效并且没有太旧，可以直接用来重连
+        """
+        return (
+            self._host_server_token is not None
+            and self._host_server_token_time is not None
+            and time.monotonic() - self._host_server_token_time < HOST_SERVER_TOKEN_MAX_AGE
+        )
+
+    async def close(self):
+        """
+        释放本客户端的资源，调用后本客户端将不可用
+        """
+        self._is_closed = True
+        if self._refresh_token_timer_handle is not None:
+            self._refresh_token_timer_handle.cancel()
+            self._refresh_token_timer_handle = None
+        # 正在后台刷新的token用不上了，而且要在关闭session之前结束
+        refresh_token_future = self._refresh_token_future
+        if refresh_token_future is not None:
+            refresh_token_future.cancel()
+            await asyncio.wait([refresh_token_future])
+
+        await super().close()
+
     async def init_room(self):
         """
         初始化连接房间需要的字段
@@ -235,6 +283,8 @@ class BLiveClient(ws_base.WebSocketClientBase):
             # 失败了则降级
             self._host_server_list = DEFAULT_DANMAKU_SERVER_LIST
             self._host_server_token = None
+            self._host_server_token_time = None
+            self._prefetch_host_servers()
         return res
 
     async def _init_uid(self):
@@ -361,23 +411,106 @@ class BLiveClient(ws_base.WebSocketClientBase):
         return True
 
     def _parse_danmaku_server_conf(self, data):
-        self._host_server_list = data['host_list']
-        self._host_server_token = data['token']
-        if not self._host_server_list:
+        # 先检查再赋值，后台刷新失败时不能覆盖掉还能用的服务器列表
+        if not data['host_list']:
             logger.warning('room=%d _parse_danmaku_server_conf() failed: host_server_list is empty', self._room_id)
             return False
+        self._host_server_list = data['host_list']
+        self._host_server_token = data['token']
+        self._host_server_token_time = time.monotonic()
+        self._schedule_refresh_host_server_token()
+        self._prefetch_host_servers()
         return True
 
+    def _prefetch_host_servers(self):
+        """
+        在后台预先解析弹幕服务器的DNS，重连时不用等DNS
+        """
+        net.prefetch_hosts(
+            (host_server['host'], host_server['wss_port'])
+            for host_server in self._host_server_list
+        )
+
+    def _refresh_host_server_token(self) -> Awaitable[bool]:
+        """
+        只重新获取弹幕服务器列表和token，不用整个init_room
+
+        :return: 一个可以等待的future，结果为是否成功
+        """
+        if self._refresh_token_future is None:
+            self._refresh_token_future = asyncio.create_task(self._init_host_server())
+
+            def on_done(fu: asyncio.Future):
+                self._refresh_token_future = None
+                if fu.cancelled() or fu.exception() is not None or not fu.result():
+                    # 失败了也要定时重试，token太旧时下次连接前会先阻塞刷新
+                    self._schedule_refresh_host_server_token()
+            self._refresh_token_future.add_done_callback(on_done)
+
+        return self._refresh_token_future
+
+    def _schedule_refresh_host_server_token(self):
+        """
+        在token过期之前定时在后台刷新
+        """
+        if self._is_closed:
+            return
+        if self._refresh_token_timer_handle is not None:
+            self._refresh_token_timer_handle.cancel()
+        self._refresh_token_timer_handle = asyncio.get_running_loop().call_later(
+            HOST_SERVER_TOKEN_REFRESH_INTERVAL, self._on_refresh_host_server_token
+        )
+
+    def _on_refresh_host_server_token(self):
+        """
+        定时刷新token的回调
+        """
+        self._refresh_token_timer_handle = None
+        if not self.is_running:
+            # 已经停止了就不刷新了，下次连接前会检查token是否太旧
+            return
+        self._refresh_host_server_token()
+
     async def _on_before_ws_connect(self, retry_count):
         """
         在每次建立连接之前调用，可以用来初始化房间
         """
-        # 重连次数太多则重新init_room，保险
-        reinit_period = max(3, len(self._host_server_list or ()))
-        if retry_count > 0 and retry_count % reinit_period == 0:
-            self._need_init_room = True
+        if not self._need_init_room:
+            # 重连次数太多则刷新token，保险
+            reinit_period = max(3, len(self._host_server_list or ()))
+            if retry_count > 0 and retry_count % reinit_period == 0:
+                if self._is_host_server_token_fresh:
+                    # 旧的token还能用，先直接重连，在后台刷新，不阻塞重连
+                    self._refresh_host_server_token()
+                else:
+                    self._need_init_room = True
+            elif self._host_server_token is not None and not self._is_host_server_token_fresh:
+                # token失效或者太旧了，只需要重新获取token。如果正在后台刷新，则等待刷新结果
+                if not await self._refresh_host_server_token():
+                    self._need_init_room = True
+
         await super()._on_before_ws_connect(retry_count)
 
+        if (
+            self._refresh_token_timer_handle is None
+            and self._refresh_token_future is None
+            and self._is_host_server_token_fresh
+        ):
+            # 停止后重新启动的情况，恢复定时刷新
+            self._schedule_refresh_host_server_token()
+
+    def _on_auth_failed(self):
+        """
+        认证失败，只让用来认证的token失效，下次连接前只重新获取token
+        """
+        if self._host_server_token is None:
+            # 降级时没有token，还是要重新init_room
+            super()._on_auth_failed()
+            return
+        if self._host_server_token == self._auth_token:
+            self._host_server_token_time = None
+        # 否则在后台已经刷新到新的token了，可以直接重连
+
     def _get_ws_url(self, retry_count) -> str:
         """
         返回WebSocket连接的URL，可以在这里做故障转移和负载均衡
@@ -385,10 +518,16 @@ class BLiveClient(ws_base.WebSocketClientBase):
         host_server = self._host_server_list[retry_count % len(self._host_server_list)]
         return f"wss://{host_server['host']}:{host_server['wss_port']}/sub"
 
-    async def _send_auth(self):
+    async def _send_auth(self, websocket: aiohttp.ClientWebSocketResponse):
         """
         发送认证包
         """
+        await websocket.send_bytes(self._make_packet(self._get_auth_params(), ws_base.Operation.AUTH))
+
+    def _get_auth_params(self) -> dict:
+        """
+        返回认证包的内容
+        """
         auth_params = {
             'uid': self._uid,
             'roomid': self._room_id,
@@ -399,4 +538,5 @@ class BLiveClient(ws_base.WebSocketClientBase):
         }
         if self._host_server_token is not None:
             auth_params['key'] = self._host_server_token
-        await self._websocket.send_bytes(self._make_packet(auth_params, ws_base.Operation.AUTH))
+        self._auth_token = self._host_server_token
+        return auth_params
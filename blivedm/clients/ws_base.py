@@ -3,93 +3,79 @@ import asyncio
 import enum
 import json
 import logging
-import struct
+import time
 import zlib
 from typing import *
 
 import aiohttp
-import brotli
 
-from .. import handlers, utils
+from . import asyncio_ws, dedup, net, protocol
+# 协议的定义在protocol模块，这里导入是为了兼容以前的用法
+from .protocol import HEADER_STRUCT, AuthError, AuthReplyCode, HeaderTuple, Operation, ProtoVer  # noqa
+from .. import hooks, metrics, utils
+
+if TYPE_CHECKING:
+    # handlers会导入本模块，这里只用来标注类型，避免先导入本模块时循环导入
+    from .. import bus, handlers
+    from ..recording import recorder as recording
+    from ..sinks import raw as raw_sinks
 
 logger = logging.getLogger('blivedm')
 
-HEADER_STRUCT = struct.Struct('>I2H2I')
-
-
-class HeaderTuple(NamedTuple):
-    pack_len: int
-    raw_header_size: int
-    ver: int
-    operation: int
-    seq_id: int
-
-
-# WS_BODY_PROTOCOL_VERSION
-class ProtoVer(enum.IntEnum):
-    NORMAL = 0
-    HEARTBEAT = 1
-    DEFLATE = 2
-    BROTLI = 3
-
-
-# go-common\app\service\main\broadcast\model\operation.go
-class Operation(enum.IntEnum):
-    HANDSHAKE = 0
-    HANDSHAKE_REPLY = 1
-    HEARTBEAT = 2
-    HEARTBEAT_REPLY = 3
-    SEND_MSG = 4
-    SEND_MSG_REPLY = 5
-    DISCONNECT_REPLY = 6
-    AUTH = 7
-    AUTH_REPLY = 8
-    RAW = 9
-    PROTO_READY = 10
-    PROTO_FINISH = 11
-    CHANGE_ROOM = 12
-    CHANGE_ROOM_REPLY = 13
-    REGISTER = 14
-    REGISTER_REPLY = 15
-    UNREGISTER = 16
-    UNREGISTER_REPLY = 17
-    # B站业务自定义OP
-    # MinBusinessOp = 1000
-    # MaxBusinessOp = 10000
-
-
-# WS_AUTH
-class AuthReplyCode(enum.IntEnum):
-    OK = 0
-    TOKEN_ERROR = -101
+
+def _decode_json(body: bytes):
+    return json.loads(body.decode('utf-8'))
+
+
+class TransportType(enum.IntEnum):
+    """
+    连接弹幕服务器用的WebSocket实现
+    """
+
+    AIOHTTP = 0
+    """aiohttp的WebSocket，支持代理等aiohttp的所有功能"""
+    ASYNCIO = 1
+    """asyncio_ws模块基于asyncio.Protocol的实现，每条消息的开销更小，不支持代理"""
 
 
 class InitError(Exception):
     """初始化失败"""
 
 
-class AuthError(Exception):
-    """认证失败"""
+DEFAULT_RECONNECT_POLICY = utils.make_constant_retry_policy(1)
 
+RECEIVE_TIMEOUT_MARGIN = 5
+"""接收消息的超时时间比心跳间隔多出的时间（秒），超过heartbeat_interval + RECEIVE_TIMEOUT_MARGIN没收到消息则断线重连"""
 
-DEFAULT_RECONNECT_POLICY = utils.make_constant_retry_policy(1)
+_MIGRATE_DEDUP_DURATION = 10
+"""只有一个连接时，迁移完成后继续去重的时间（秒）"""
 
 
 class WebSocketClientBase:
     """
     基于WebSocket的客户端
 
-    :param session: cookie、连接池
+    :param session: cookie、连接池，不传则创建自己的session，但是和其他客户端共用连接池，见net.get_shared_connector
     :param heartbeat_interval: 发送心跳包的间隔时间（秒）
+    :param connection_count: 同时保持的WebSocket连接数，大于1时开启冗余模式，多个连接收到的带ID的消息会合并去重，
+        没有ID的消息和心跳包只处理主连接收到的
+    :param ws_transport: 连接弹幕服务器用的WebSocket实现，见TransportType，HTTP接口总是用session
     """
 
     def __init__(
         self,
         session: Optional[aiohttp.ClientSession] = None,
         heartbeat_interval: float = 30,
+        connection_count: int = 1,
+        ws_transport: TransportType = TransportType.AIOHTTP,
     ):
         if session is None:
-            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+            # cookie还是每个客户端独立的
+            self._session = aiohttp.ClientSession(
+                connector=net.get_shared_connector(),
+                connector_owner=False,
+                timeout=aiohttp.ClientTimeout(total=10),
+            )
             self._own_session = True
         else:
             self._session = session
@@ -97,8 +83,12 @@ class WebSocketClientBase:
             assert self._session.loop is asyncio.get_event_loop()  # noqa
 
         self._heartbeat_interval = heartbeat_interval
+        self._connection_count = max(connection_count, 1)
+        self._ws_transport = ws_transport
 
         self._need_init_room = True
+        self._init_room_lock = asyncio.Lock()
+        """冗余模式下用来避免多个连接同时init_room"""
         self._handler: Optional[handlers.HandlerInterface] = None
         """消息处理器"""
         self._get_reconnect_interval: Callable[[int, int], float] = DEFAULT_RECONNECT_POLICY
@@ -108,12 +98,42 @@ class WebSocketClientBase:
         self._room_id: Optional[int] = None
 
         # 在运行时初始化的字段
-        self._websocket: Optional[aiohttp.ClientWebSocketResponse] = None
-        """WebSocket连接"""
+        self._websockets: List[aiohttp.ClientWebSocketResponse] = []
+        """当前所有的WebSocket连接"""
+        self._connection_websockets: Dict[int, aiohttp.ClientWebSocketResponse] = {}
+        """连接序号 -> 连接协程正在收消息的WebSocket连接"""
+        self._migrated_websockets: Dict[int, aiohttp.ClientWebSocketResponse] = {}
+        """连接序号 -> 迁移时建立的新连接，已经认证过了，等连接协程接管"""
+        self._is_migrating = False
+        """是否正在迁移连接"""
+        self._migrate_count = 0
+        """迁移次数，用来选择新的服务器"""
+        self._deduplicator: Optional[dedup.CommandDeduplicator] = (
+            dedup.CommandDeduplicator() if self._connection_count > 1 else None
+        )
+        """多个连接同时收消息时用来去重，冗余模式或者迁移连接时才会创建"""
+        self._migrate_dedup_timer_handle: Optional[asyncio.TimerHandle] = None
+        """只有一个连接时，迁移完成后过一段时间删除去重器的定时器的handle"""
         self._network_future: Optional[asyncio.Future] = None
         """网络协程的future"""
         self._heartbeat_timer_handle: Optional[asyncio.TimerHandle] = None
         """发心跳包定时器的handle"""
+        self._metrics: Optional[metrics.ClientMetrics] = None
+        """统计数据，没开启统计时为None，见enable_metrics"""
+        self._metrics_registry: Optional[metrics.MetricsRegistry] = None
+        """统计数据注册到的注册表"""
+        self._stage_hooks: Optional[hooks.StageHookList] = None
+        """收消息路径上的阶段钩子，没有钩子时为None，见add_stage_hook"""
+        self._recorder: Optional['recording.FrameRecorder'] = None
+        """录制原始WebSocket消息，没有录制时为None，见set_recorder"""
+        self._raw_sink: Optional['raw_sinks.RawSinkInterface'] = None
+        """直通模式下接收原始业务消息，不是直通模式时为None，见set_raw_sink"""
+        self._internal_cmd_markers: Tuple[bytes, ...] = ()
+        """客户端自己要处理的cmd，直通模式下包含这些字节串的业务消息也要反序列化，交给_handle_internal_command"""
+        self._protocols: Dict[aiohttp.ClientWebSocketResponse, protocol.Protocol] = {}
+        """WebSocket连接 -> 这个连接的协议状态"""
+        self._default_protocol = protocol.Protocol(decompress=False, decode_json=False)
+        """不属于任何连接的消息（比如回放）用的协议状态"""
 
     @property
     def is_running(self) -> bool:
@@ -134,12 +154,120 @@ class WebSocketClientBase:
         设置消息处理器
 
         注意消息处理器和网络协程运行在同一个协程，如果处理消息耗时太长会阻塞接收消息。如果是CPU密集型的任务，建议将消息推到线程池处理；
-        如果是IO密集型的任务，应该使用async函数，并且在handler里使用create_task创建新的协程
+        如果是IO密集型的任务，应该使用async函数，并且在handler里使用create_task创建新的协程。可以用monitor.StallMonitor检测耗时太长的消息
 
         :param handler: 消息处理器
         """
         self._handler = handler
 
+    def get_event_bus(self) -> 'bus.EventBus':
+        """
+        取消息总线，当前的消息处理器不是消息总线时创建一个并设置为消息处理器，原来的消息处理器会订阅所有cmd
+
+        :return: 消息总线
+        """
+        from .. import bus  # 避免循环导入
+        handler = self._handler
+        if isinstance(handler, bus.EventBus):
+            return handler
+        event_bus = bus.EventBus()
+        if handler is not None:
+            event_bus.subscribe_handler(handler)
+        self._handler = event_bus
+        return event_bus
+
+    def subscribe(
+        self,
+        callback: Callable[['WebSocketClientBase', Any], Any],
+        *,
+        cmds: Optional[Iterable[str]] = None,
+        model_type: Optional[type] = None,
+        filter: Optional[Callable[[Any], bool]] = None,  # noqa
+    ) -> 'bus.Subscription':
+        """
+        订阅消息，一个客户端可以有多个订阅者，参数见bus.EventBus.subscribe
+
+        :return: 订阅，用来取消订阅
+        """
+        return self.get_event_bus().subscribe(callback, cmds=cmds, model_type=model_type, filter=filter)
+
+    @property
+    def metrics(self) -> Optional['metrics.ClientMetrics']:
+        """
+        本客户端的统计数据，没开启统计时为None
+        """
+        return self._metrics
+
+    def enable_metrics(self, registry: Optional['metrics.MetricsRegistry'] = None) -> 'metrics.ClientMetrics':
+        """
+        开启统计，不开启时收消息的路径上只多一次判断None的开销
+
+        :param registry: 统计数据注册到的注册表，默认是metrics.default_registry
+        :return: 本客户端的统计数据
+        """
+        if registry is None:
+            registry = metrics.default_registry
+        if self._metrics is not None:
+            if self._metrics_registry is registry:
+                return self._metrics
+            self.disable_metrics()
+
+        self._metrics_registry = registry
+        self._metrics = registry.register(self)
+        return self._metrics
+
+    def disable_metrics(self):
+        """
+        关闭统计，已有的统计数据会合并到注册表的进程总计里
+        """
+        if self._metrics is None:
+            return
+        self._metrics_registry.unregister(self)
+        self._metrics = None
+        self._metrics_registry = None
+
+    def add_stage_hook(self, hook: 'hooks.StageHookInterface'):
+        """
+        安装阶段钩子，钩子会在解析包头、解压、JSON反序列化、调用消息处理器、构造消息模型前后调用。
+        没有钩子时每个阶段只多一次判断None的开销
+
+        :param hook: 阶段钩子
+        """
+        old_hooks = self._stage_hooks.hooks if self._stage_hooks is not None else ()
+        if hook in old_hooks:
+            return
+        # 每次都创建新的列表，这样在钩子里安装、卸载钩子也不影响正在进行的阶段
+        self._stage_hooks = hooks.StageHookList(old_hooks + (hook,))
+
+    def remove_stage_hook(self, hook: 'hooks.StageHookInterface'):
+        """
+        卸载阶段钩子
+
+        :param hook: 阶段钩子
+        """
+        if self._stage_hooks is None:
+            return
+        new_hooks = tuple(h for h in self._stage_hooks.hooks if h is not hook)
+        self._stage_hooks = hooks.StageHookList(new_hooks) if new_hooks else None
+
+    def set_recorder(self, recorder: Optional['recording.FrameRecorder']):
+        """
+        设置录制器，收到的原始WebSocket消息会在解压前交给录制器。没有录制器时收消息的路径上只多一次判断None的开销
+
+        :param recorder: 录制器，None表示停止录制
+        """
+        self._recorder = recorder
+
+    def set_raw_sink(self, raw_sink: Optional['raw_sinks.RawSinkInterface']):
+        """
+        设置原始业务消息的接收者，开启直通模式。直通模式下解压后的每个业务消息包不做JSON反序列化，
+        直接把原始JSON数据交给raw_sink，不再调用消息处理器。客户端自己要处理的cmd（比如开放平台的项目结束消息）
+        还是会反序列化并处理
+
+        :param raw_sink: 原始业务消息的接收者，None表示关闭直通模式
+        """
+        self._raw_sink = raw_sink
+
     def set_reconnect_policy(self, get_reconnect_interval: Callable[[int, int], float]):
         """
         设置重连间隔时间增长策略
@@ -194,6 +322,8 @@ class WebSocketClientBase:
         if self.is_running:
             logger.warning('room=%s is calling close(), but client is running', self.room_id)
 
+        self.disable_metrics()
+
         # 如果session是自己创建的则关闭session
         if self._own_session:
             await self._session.close()
@@ -206,29 +336,67 @@ class WebSocketClientBase:
         """
         raise NotImplementedError
 
-    @staticmethod
-    def _make_packet(data: Union[dict, str, bytes], operation: int) -> bytes:
+    async def migrate(self, reinit_room=False) -> bool:
         """
-        创建一个要发送给服务器的包
+        平滑迁移所有连接：先建立新连接并认证，认证成功后再断开旧连接，迁移期间旧连接继续收消息，两边收到的消息会去重
+
+        可以用来重新初始化房间后切换到新的认证信息，或者离开状态不好的服务器
 
-        :param data: 包体JSON数据
-        :param operation: 操作码，见Operation
-        :return: 整个包的数据
+        :param reinit_room: 是否在建立新连接之前重新init_room
+        :return: 是否所有连接都迁移成功，失败的连接保留旧连接
         """
-        if isinstance(data, dict):
-            body = json.dumps(data).encode('utf-8')
-        elif isinstance(data, str):
-            body = data.encode('utf-8')
-        else:
-            body = data
-        header = HEADER_STRUCT.pack(*HeaderTuple(
-            pack_len=HEADER_STRUCT.size + len(body),
-            raw_header_size=HEADER_STRUCT.size,
-            ver=1,
-            operation=operation,
-            seq_id=1
-        ))
-        return header + body
+        if not self.is_running:
+            logger.warning('room=%s client is stopped, cannot migrate()', self.room_id)
+            return False
+        if self._is_migrating:
+            logger.warning('room=%s client is migrating, cannot migrate() again', self.room_id)
+            return False
+
+        self._is_migrating = True
+        try:
+            if reinit_room:
+                self._need_init_room = True
+            try:
+                await self._on_before_ws_connect(0)
+            except InitError:
+                logger.exception('room=%s migrate() failed:', self.room_id)
+                return False
+
+            self._cancel_migrate_dedup_timer()
+            if self._deduplicator is None:
+                self._deduplicator = dedup.CommandDeduplicator()
+            self._migrate_count += 1
+            results = await asyncio.gather(*(
+                self._migrate_connection(index) for index in range(self._connection_count)
+            ))
+            return all(results)
+        finally:
+            self._is_migrating = False
+            if self._connection_count == 1 and self._deduplicator is not None:
+                # 新连接被接管后还会处理已经缓冲的、旧连接也收到过的消息，所以过一段时间再删除去重器
+                self._migrate_dedup_timer_handle = asyncio.get_running_loop().call_later(
+                    _MIGRATE_DEDUP_DURATION, self._on_migrate_dedup_timeout
+                )
+
+    def _cancel_migrate_dedup_timer(self):
+        if self._migrate_dedup_timer_handle is not None:
+            self._migrate_dedup_timer_handle.cancel()
+            self._migrate_dedup_timer_handle = None
+
+    def _on_migrate_dedup_timeout(self):
+        """
+        只有一个连接时迁移的重叠期已经过去，删除去重器
+        """
+        self._migrate_dedup_timer_handle = None
+        if self._connection_count == 1 and not self._is_migrating:
+            self._deduplicator = None
+
+    @staticmethod
+    def _make_packet(data: Union[dict, str, bytes], operation: int, seq_id=1) -> bytes:
+        """
+        创建一个要发送给服务器的包，见protocol.make_packet
+        """
+        return protocol.make_packet(data, operation, seq_id)
 
     async def _network_coroutine_wrapper(self):
         """
@@ -252,28 +420,69 @@ class WebSocketClientBase:
 
     async def _network_coroutine(self):
         """
-        网络协程，负责连接服务器、接收消息、解包
+        网络协程，负责启动所有连接协程
+        """
+        try:
+            if self._connection_count == 1:
+                await self._connection_coroutine(0)
+                return
+
+            # 冗余模式，任何一个连接协程异常退出则全部停止
+            tasks = [
+                asyncio.create_task(self._connection_coroutine(index))
+                for index in range(self._connection_count)
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.wait(tasks)
+        finally:
+            self._cancel_migrate_dedup_timer()
+            if self._connection_count == 1:
+                self._deduplicator = None
+            # 停止时还没被接管的迁移连接
+            for websocket in self._migrated_websockets.values():
+                await websocket.close()
+                await self._on_ws_close(websocket)
+            self._migrated_websockets.clear()
+
+    async def _connection_coroutine(self, index: int):
+        """
+        连接协程，负责连接服务器、接收消息、解包
+
+        :param index: 连接序号，冗余模式下不同的连接会优先连到不同的服务器
         """
         # retry_count在连接成功后会重置为0，total_retry_count不会
         retry_count = 0
         total_retry_count = 0
         while True:
+            # 迁移过来的新连接已经认证过了，直接接着收消息
+            websocket = self._migrated_websockets.pop(index, None)
             try:
-                await self._on_before_ws_connect(retry_count)
-
-                # 连接
-                async with self._session.ws_connect(
-                    self._get_ws_url(retry_count),
-                    headers={'User-Agent': utils.USER_AGENT},  # web端的token也会签名UA
-                    receive_timeout=self._heartbeat_interval + 5,
-                ) as websocket:
-                    self._websocket = websocket
-                    await self._on_ws_connect()
-
-                    # 处理消息
+                if websocket is None:
+                    await self._on_before_ws_connect(retry_count)
+
+                    # 连接
+                    websocket = await self._connect_websocket(self._get_ws_url(retry_count + index))
+                    await self._on_ws_connect(websocket)
+                self._connection_websockets[index] = websocket
+
+                # 处理消息
+                if isinstance(websocket, asyncio_ws.WebSocketConnection):
+                    while True:
+                        data_list = await websocket.receive_batch()
+                        if not data_list:
+                            break
+                        for data in data_list:
+                            await self._on_ws_data(data, websocket)
+                        # 至少成功处理1条消息
+                        retry_count = 0
+                else:
                     message: aiohttp.WSMessage
                     async for message in websocket:
-                        await self._on_ws_message(message)
+                        await self._on_ws_message(message, websocket)
                         # 至少成功处理1条消息
                         retry_count = 0
 
@@ -283,17 +492,27 @@ class WebSocketClientBase:
             except AuthError:
                 # 认证失败了，应该重新获取token再重连
                 logger.exception('room=%d auth failed, trying init_room() again', self.room_id)
-                self._need_init_room = True
+                self._on_auth_failed()
             finally:
-                self._websocket = None
-                await self._on_ws_close()
+                if websocket is not None:
+                    if self._connection_websockets.get(index, None) is websocket:
+                        del self._connection_websockets[index]
+                    await websocket.close()
+                    await self._on_ws_close(websocket)
+
+            if index in self._migrated_websockets:
+                # 旧连接是迁移完成后主动断开的，不用重连
+                retry_count = 0
+                continue
 
             # 准备重连
             retry_count += 1
             total_retry_count += 1
+            if self._metrics is not None:
+                self._metrics.reconnect_count += 1
             logger.warning(
-                'room=%d is reconnecting, retry_count=%d, total_retry_count=%d',
-                self.room_id, retry_count, total_retry_count
+                'room=%d is reconnecting, index=%d, retry_count=%d, total_retry_count=%d',
+                self.room_id, index, retry_count, total_retry_count
             )
             await asyncio.sleep(self._get_reconnect_interval(retry_count, total_retry_count))
 
@@ -304,9 +523,109 @@ class WebSocketClientBase:
         if not self._need_init_room:
             return
 
-        if not await self.init_room():
-            raise InitError('init_room() failed')
-        self._need_init_room = False
+        async with self._init_room_lock:
+            if not self._need_init_room:
+                # 其他连接已经初始化过了
+                return
+            if not await self.init_room():
+                raise InitError('init_room() failed')
+            self._need_init_room = False
+
+    async def _connect_websocket(self, url: str) -> aiohttp.ClientWebSocketResponse:
+        """
+        建立WebSocket连接
+
+        :param url: WebSocket连接的URL
+        """
+        start_time = time.perf_counter()
+        try:
+            if self._ws_transport == TransportType.ASYNCIO:
+                websocket = await asyncio_ws.connect(
+                    url,
+                    headers={'User-Agent': utils.USER_AGENT},  # web端的token也会签名UA
+                    cookie_jar=self._session.cookie_jar,
+                    receive_timeout=self._heartbeat_interval + RECEIVE_TIMEOUT_MARGIN,
+                )
+            else:
+                websocket = await self._session.ws_connect(
+                    url,
+                    headers={'User-Agent': utils.USER_AGENT},  # web端的token也会签名UA
+                    receive_timeout=self._heartbeat_interval + RECEIVE_TIMEOUT_MARGIN,
+                )
+        except BaseException:
+            net.record_connect(None)
+            raise
+        net.record_connect(time.perf_counter() - start_time)
+        return websocket
+
+    async def _migrate_connection(self, index: int) -> bool:
+        """
+        迁移一个连接，新连接认证成功后交给连接协程接管，然后断开旧连接
+
+        :param index: 连接序号
+        :return: 是否迁移成功
+        """
+        websocket: Optional[aiohttp.ClientWebSocketResponse] = None
+        try:
+            websocket = await self._connect_websocket(self._get_ws_url(index + self._migrate_count))
+            await self._on_ws_connect(websocket)
+
+            # 新连接认证成功之前，新连接收到的消息也要处理，和旧连接收到的消息去重
+            if not await self._receive_until_auth_reply(websocket):
+                logger.warning('room=%s _migrate_connection() failed: closed before auth, index=%d',
+                               self.room_id, index)
+                return False
+
+            old_websocket = self._connection_websockets.get(index, None)
+            if old_websocket is None or not self.is_running:
+                # 连接协程正在重连或者已经停止了，用不上新连接
+                logger.warning('room=%s _migrate_connection() failed: connection is not active, index=%d',
+                               self.room_id, index)
+                return False
+
+            self._migrated_websockets[index] = websocket
+            websocket = None
+            await old_websocket.close()
+            return True
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError, AuthError) as e:
+            logger.warning('room=%s _migrate_connection() failed, index=%d: %r', self.room_id, index, e)
+            return False
+        finally:
+            if websocket is not None:
+                await websocket.close()
+                await self._on_ws_close(websocket)
+
+    async def _receive_until_auth_reply(self, websocket: aiohttp.ClientWebSocketResponse) -> bool:
+        """
+        处理消息直到收到认证响应，认证失败会抛出AuthError
+
+        :return: 是否收到了认证响应，False表示连接断开了
+        """
+        # 认证成功的响应由协议层解析，认证失败时处理消息会抛出AuthError
+        proto = self._get_protocol(websocket)
+        if isinstance(websocket, asyncio_ws.WebSocketConnection):
+            while True:
+                data_list = await websocket.receive_batch()
+                if not data_list:
+                    return False
+                # 同一批里认证响应后面的消息也在这里处理，保持顺序
+                for data in data_list:
+                    await self._on_ws_data(data, websocket)
+                if proto.is_authed:
+                    return True
+
+        message: aiohttp.WSMessage
+        async for message in websocket:
+            await self._on_ws_message(message, websocket)
+            if proto.is_authed:
+                return True
+        return False
+
+    def _on_auth_failed(self):
+        """
+        认证失败，默认在下次连接之前重新初始化房间
+        """
+        self._need_init_room = True
 
     def _get_ws_url(self, retry_count) -> str:
         """
@@ -314,26 +633,50 @@ class WebSocketClientBase:
         """
         raise NotImplementedError
 
-    async def _on_ws_connect(self):
+    async def _on_ws_connect(self, websocket: aiohttp.ClientWebSocketResponse):
         """
         WebSocket连接成功
+
+        :param websocket: 新的WebSocket连接
         """
-        await self._send_auth()
-        self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
-            self._heartbeat_interval, self._on_send_heartbeat
-        )
+        self._websockets.append(websocket)
+        # 解压和反序列化在客户端做，这样可以放到线程池执行、去重、直通
+        self._protocols[websocket] = protocol.Protocol(decompress=False, decode_json=False)
+        await self._send_auth(websocket)
+        # 所有连接共用一个心跳定时器
+        if self._heartbeat_timer_handle is None:
+            self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+                self._heartbeat_interval, self._on_send_heartbeat
+            )
 
-    async def _on_ws_close(self):
+    async def _on_ws_close(self, websocket: aiohttp.ClientWebSocketResponse):
         """
         WebSocket连接断开
+
+        :param websocket: 断开的WebSocket连接
         """
-        if self._heartbeat_timer_handle is not None:
+        try:
+            self._websockets.remove(websocket)
+        except ValueError:
+            pass
+        self._protocols.pop(websocket, None)
+        if not self._websockets and self._heartbeat_timer_handle is not None:
             self._heartbeat_timer_handle.cancel()
             self._heartbeat_timer_handle = None
 
-    async def _send_auth(self):
+    async def _close_websockets(self):
+        """
+        断开所有WebSocket连接，连接协程会自动重连
+        """
+        for websocket in list(self._websockets):
+            if not websocket.closed:
+                await websocket.close()
+
+    async def _send_auth(self, websocket: aiohttp.ClientWebSocketResponse):
         """
         发送认证包
+
+        :param websocket: 要认证的WebSocket连接
         """
         raise NotImplementedError
 
@@ -341,136 +684,231 @@ class WebSocketClientBase:
         """
         定时发送心跳包的回调
         """
-        if self._websocket is None or self._websocket.closed:
+        if not self._websockets:
             self._heartbeat_timer_handle = None
             return
 
         self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
             self._heartbeat_interval, self._on_send_heartbeat
         )
-        asyncio.create_task(self._send_heartbeat())
+        for websocket in self._websockets:
+            asyncio.create_task(self._send_heartbeat(websocket))
 
-    async def _send_heartbeat(self):
+    async def _send_heartbeat(self, websocket: aiohttp.ClientWebSocketResponse):
         """
         发送心跳包
+
+        :param websocket: 要发心跳包的WebSocket连接
         """
-        if self._websocket is None or self._websocket.closed:
+        if websocket.closed:
             return
 
         try:
-            await self._websocket.send_bytes(self._make_packet({}, Operation.HEARTBEAT))
+            await websocket.send_bytes(self._make_packet({}, Operation.HEARTBEAT))
         except (ConnectionResetError, aiohttp.ClientConnectionError) as e:
             logger.warning('room=%d _send_heartbeat() failed: %r', self.room_id, e)
         except Exception:  # noqa
             logger.exception('room=%d _send_heartbeat() failed:', self.room_id)
 
-    async def _on_ws_message(self, message: aiohttp.WSMessage):
+    async def _on_ws_message(
+        self, message: aiohttp.WSMessage, websocket: Optional[aiohttp.ClientWebSocketResponse] = None
+    ):
         """
         收到WebSocket消息
 
         :param message: WebSocket消息
+        :param websocket: 收到消息的WebSocket连接
         """
         if message.type != aiohttp.WSMsgType.BINARY:
             logger.warning('room=%d unknown websocket message type=%s, data=%s', self.room_id,
                            message.type, message.data)
             return
+        await self._on_ws_data(message.data, websocket)
+
+    async def _on_ws_data(self, data: bytes, websocket: Optional[aiohttp.ClientWebSocketResponse] = None):
+        """
+        收到WebSocket二进制消息
+
+        :param data: WebSocket消息数据
+        :param websocket: 收到消息的WebSocket连接
+        """
+        client_metrics = self._metrics
+        if client_metrics is not None:
+            client_metrics.frame_count += 1
+            client_metrics.byte_count += len(data)
+
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.record(self._room_id, data)
 
         try:
-            await self._parse_ws_message(message.data)
+            await self._parse_ws_message(data, websocket)
         except AuthError:
             # 认证失败，让外层处理
             raise
         except Exception:  # noqa
             logger.exception('room=%d _parse_ws_message() error:', self.room_id)
 
-    async def _parse_ws_message(self, data: bytes):
+    async def _parse_ws_message(self, data: bytes, websocket: Optional[aiohttp.ClientWebSocketResponse] = None):
         """
-        解析WebSocket消息
+        解析WebSocket消息，分包和解析包头由protocol.Protocol完成，这里只处理解析出的事件
 
         :param data: WebSocket消息数据
+        :param websocket: 收到消息的WebSocket连接
         """
-        offset = 0
-        try:
-            header = HeaderTuple(*HEADER_STRUCT.unpack_from(data, offset))
-        except struct.error:
-            logger.exception('room=%d parsing header failed, offset=%d, data=%s', self.room_id, offset, data)
-            return
+        proto = self._get_protocol(websocket)
+        if self._stage_hooks is None:
+            events = proto.iter_message(data)
+        else:
+            events = proto.iter_message(data, self._unpack_header_instrumented)
 
-        if header.operation in (Operation.SEND_MSG_REPLY, Operation.AUTH_REPLY):
-            # 业务消息，可能有多个包一起发，需要分包
-            while True:
-                body = data[offset + header.raw_header_size: offset + header.pack_len]
-                await self._parse_business_message(header, body)
-
-                offset += header.pack_len
-                if offset >= len(data):
-                    break
-
-                try:
-                    header = HeaderTuple(*HEADER_STRUCT.unpack_from(data, offset))
-                except struct.error:
-                    logger.exception('room=%d parsing header failed, offset=%d, data=%s', self.room_id, offset, data)
-                    break
-
-        elif header.operation == Operation.HEARTBEAT_REPLY:
-            # 服务器心跳包，前4字节是人气值，后面是客户端发的心跳包内容
-            # pack_len不包括客户端发的心跳包内容，不知道是不是服务器BUG
-            body = data[offset + header.raw_header_size: offset + header.raw_header_size + 4]
-            popularity = int.from_bytes(body, 'big')
-            # 自己造个消息当成业务消息处理
-            body = {
-                'cmd': '_HEARTBEAT',
-                'data': {
-                    'popularity': popularity
-                }
-            }
-            self._handle_command(body)
+        client_metrics = self._metrics
+        for event in events:
+            if client_metrics is not None:
+                header = event.header
+                client_metrics.packet_counts[(header.ver, header.operation)] += 1
+            await self._on_protocol_event(event, websocket)
+
+    def _get_protocol(self, websocket: Optional[aiohttp.ClientWebSocketResponse]) -> protocol.Protocol:
+        """
+        返回WebSocket连接的协议状态
+        """
+        proto = self._protocols.get(websocket, None) if websocket is not None else None
+        return proto if proto is not None else self._default_protocol
+
+    def _unpack_header_instrumented(self, data: bytes, offset: int) -> HeaderTuple:
+        """
+        有钩子时解析包头
+        """
+        return self._stage_hooks.call(self, hooks.Stage.HEADER_PARSE, offset, protocol.unpack_header, data, offset)
+
+    async def _on_protocol_event(
+        self, event: protocol.Event, websocket: Optional[aiohttp.ClientWebSocketResponse] = None
+    ):
+        """
+        处理协议层解析出的事件
+
+        :param event: 事件
+        :param websocket: 收到消息的WebSocket连接
+        """
+        if isinstance(event, protocol.CommandEvent):
+            # 没压缩过的直接反序列化，因为有万恶的GIL，这里不能并行避免阻塞
+            self._on_command_body(event.body, websocket)
+
+        elif isinstance(event, protocol.CompressedEvent):
+            # 压缩过的先解压，为了避免阻塞网络线程，放在其他线程执行
+            # web端已经不用zlib压缩了，但是开放平台会用
+            decompress = protocol.brotli_decompress if event.header.ver == ProtoVer.BROTLI else zlib.decompress
+            if self._metrics is None and self._stage_hooks is None:
+                body = await asyncio.get_running_loop().run_in_executor(None, decompress, event.body)
+            else:
+                body = await self._decompress_instrumented(event.header, decompress, event.body)
+            await self._parse_ws_message(body, websocket)
+
+        elif isinstance(event, protocol.HeartbeatReplyEvent):
+            if self._deduplicator is not None and not self._is_primary_websocket(websocket):
+                # 每个连接都会收到心跳包，只处理主连接的
+                return
+            # 服务器心跳包，自己造个消息当成业务消息处理
+            command = protocol.make_heartbeat_command(event.popularity)
+            raw_sink = self._raw_sink
+            if raw_sink is not None:
+                raw_sink.on_raw_packet(
+                    self._room_id, event.header.operation, time.time(), json.dumps(command).encode('utf-8')
+                )
+                return
+            self._handle_command(command)
+
+        elif isinstance(event, protocol.AuthReplyEvent):
+            if not event.ok:
+                raise AuthError(f"auth reply error, code={event.code}, body={event.body}")
+            # 认证成功后协议层会把心跳包放进发送缓冲区
+            packets = self._get_protocol(websocket).data_to_send()
+            if websocket is not None and not websocket.closed:
+                for packet in packets:
+                    await websocket.send_bytes(packet)
 
         else:
-            # 未知消息
-            body = data[offset + header.raw_header_size: offset + header.pack_len]
+            # 未知消息，注册房间的响应只有MultiplexClient会处理
             logger.warning('room=%d unknown message operation=%d, header=%s, body=%s', self.room_id,
-                           header.operation, header, body)
-
-    async def _parse_business_message(self, header: HeaderTuple, body: bytes):
-        """
-        解析业务消息
-        """
-        if header.operation == Operation.SEND_MSG_REPLY:
-            # 业务消息
-            if header.ver == ProtoVer.BROTLI:
-                # 压缩过的先解压，为了避免阻塞网络线程，放在其他线程执行
-                body = await asyncio.get_running_loop().run_in_executor(None, brotli.decompress, body)
-                await self._parse_ws_message(body)
-            elif header.ver == ProtoVer.DEFLATE:
-                # web端已经不用zlib压缩了，但是开放平台会用
-                body = await asyncio.get_running_loop().run_in_executor(None, zlib.decompress, body)
-                await self._parse_ws_message(body)
-            elif header.ver == ProtoVer.NORMAL:
-                # 没压缩过的直接反序列化，因为有万恶的GIL，这里不能并行避免阻塞
-                if len(body) != 0:
-                    try:
-                        body = json.loads(body.decode('utf-8'))
-                        self._handle_command(body)
-                    except Exception:
-                        logger.error('room=%d, body=%s', self.room_id, body)
-                        raise
+                           event.header.operation, event.header, event.body)
+
+    def _on_command_body(self, body: bytes, websocket: Optional[aiohttp.ClientWebSocketResponse] = None):
+        """
+        处理一条业务消息的原始JSON数据
+
+        :param body: 业务消息的原始JSON数据
+        :param websocket: 收到消息的WebSocket连接
+        """
+        deduplicator = self._deduplicator
+        raw_sink = self._raw_sink
+        if raw_sink is not None:
+            # 直通模式，不反序列化，拿不到消息ID，多个连接同时收消息时只转发主连接的
+            if deduplicator is not None and not self._is_primary_websocket(websocket):
+                return
+            if self._internal_cmd_markers and self._handle_internal_command_body(body):
+                return
+            raw_sink.on_raw_packet(self._room_id, Operation.SEND_MSG_REPLY, time.time(), body)
+            return
+        try:
+            if self._metrics is None and self._stage_hooks is None:
+                command = json.loads(body.decode('utf-8'))
             else:
-                # 未知格式
-                logger.warning('room=%d unknown protocol version=%d, header=%s, body=%s', self.room_id,
-                               header.ver, header, body)
+                command = self._decode_json_instrumented(body)
+            if deduplicator is not None:
+                # 冗余模式下同一条消息会从多个连接收到
+                key = dedup.get_command_key(command)
+                if key is None:
+                    # 没有ID的消息不能去重，只处理主连接的
+                    if not self._is_primary_websocket(websocket):
+                        return
+                elif deduplicator.is_duplicate_key(key):
+                    return
+            self._handle_command(command)
+        except Exception:
+            logger.error('room=%d, body=%s', self.room_id, body)
+            raise
 
-        elif header.operation == Operation.AUTH_REPLY:
-            # 认证响应
-            body = json.loads(body.decode('utf-8'))
-            if body['code'] != AuthReplyCode.OK:
-                raise AuthError(f"auth reply error, code={body['code']}, body={body}")
-            await self._websocket.send_bytes(self._make_packet({}, Operation.HEARTBEAT))
+    def _handle_internal_command_body(self, body: bytes) -> bool:
+        """
+        直通模式下处理客户端自己要处理的cmd，只有包含_internal_cmd_markers的业务消息才反序列化
 
-        else:
-            # 未知消息
-            logger.warning('room=%d unknown message operation=%d, header=%s, body=%s', self.room_id,
-                           header.operation, header, body)
+        :param body: 业务消息的原始JSON数据
+        :return: 客户端是否已经处理了这条消息，不用再交给raw_sink
+        """
+        if not any(marker in body for marker in self._internal_cmd_markers):
+            return False
+        try:
+            command = json.loads(body.decode('utf-8'))
+        except Exception:
+            logger.error('room=%d, body=%s', self.room_id, body)
+            raise
+        return self._handle_internal_command(command)
+
+    def _handle_internal_command(self, command: dict) -> bool:
+        """
+        处理客户端自己要处理的cmd，直通模式和普通模式下都会调用
+
+        :param command: 业务消息
+        :return: 客户端是否已经处理了这条消息，不用再交给消息处理器或raw_sink
+        """
+        return False
+
+    def _is_primary_websocket(self, websocket: Optional[aiohttp.ClientWebSocketResponse]) -> bool:
+        """
+        多个连接同时收消息时，不能去重的消息只处理主连接收到的。主连接是序号最小的正在收消息的连接，
+        迁移时新连接被接管之前不是主连接
+
+        :param websocket: 收到消息的WebSocket连接
+        """
+        if websocket is None:
+            return True
+        for index in range(self._connection_count):
+            primary_websocket = self._connection_websockets.get(index, None)
+            if primary_websocket is not None:
+                return websocket is primary_websocket
+        # 所有连接都在重连，没有可以比较的
+        return True
 
     def _handle_command(self, command: dict):
         """
@@ -478,6 +916,16 @@ class WebSocketClientBase:
 
         :param command: 业务消息
         """
+        client_metrics = self._metrics
+        stage_hooks = self._stage_hooks
+        if client_metrics is not None:
+            # 处理器不认识的cmd也统计
+            cmd = command.get('cmd', '')
+            pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
+            if pos != -1:
+                cmd = cmd[:pos]
+            client_metrics.command_counts[cmd] += 1
+
         if self._handler is None:
             return
         try:
@@ -485,6 +933,60 @@ class WebSocketClientBase:
             # 1. 为了保持处理消息的顺序，这里不使用call_soon、create_task等方法延迟处理
             # 2. 如果支持handle使用async函数，用户可能会在里面处理耗时很长的异步操作，导致网络协程阻塞
             # 这里做成同步的，强制用户使用create_task或消息队列处理异步操作，这样就不会阻塞网络协程
-            self._handler.handle(self, command)
+            if client_metrics is None and stage_hooks is None:
+                self._handler.handle(self, command)
+            else:
+                self._dispatch_instrumented(command)
         except Exception as e:
             logger.exception('room=%d _handle_command() failed, command=%s', self.room_id, command, exc_info=e)
+
+    async def _decompress_instrumented(self, header: HeaderTuple, decompress: Callable[[bytes], bytes], body: bytes):
+        """
+        开启统计或者有钩子时的解压
+        """
+        client_metrics = self._metrics
+        stage_hooks = self._stage_hooks
+        contexts = stage_hooks.begin(self, hooks.Stage.DECOMPRESS, header) if stage_hooks is not None else None
+        start_time = time.perf_counter()
+        try:
+            body = await asyncio.get_running_loop().run_in_executor(None, decompress, body)
+        except BaseException as e:
+            if stage_hooks is not None:
+                stage_hooks.end(self, hooks.Stage.DECOMPRESS, header, contexts, e)
+            raise
+        if client_metrics is not None:
+            client_metrics.decompress_time.observe(time.perf_counter() - start_time)
+        if stage_hooks is not None:
+            stage_hooks.end(self, hooks.Stage.DECOMPRESS, header, contexts, None)
+        return body
+
+    def _decode_json_instrumented(self, body: bytes):
+        """
+        开启统计或者有钩子时的JSON反序列化
+        """
+        client_metrics = self._metrics
+        stage_hooks = self._stage_hooks
+        start_time = time.perf_counter()
+        if stage_hooks is None:
+            command = json.loads(body.decode('utf-8'))
+        else:
+            command = stage_hooks.call(self, hooks.Stage.JSON_DECODE, body, _decode_json, body)
+        if client_metrics is not None:
+            client_metrics.json_decode_time.observe(time.perf_counter() - start_time)
+        return command
+
+    def _dispatch_instrumented(self, command: dict):
+        """
+        开启统计或者有钩子时调用消息处理器
+        """
+        client_metrics = self._metrics
+        stage_hooks = self._stage_hooks
+        start_time = time.perf_counter()
+        try:
+            if stage_hooks is None:
+                self._handler.handle(self, command)
+            else:
+                stage_hooks.call(self, hooks.Stage.DISPATCH, command, self._handler.handle, self, command)
+        finally:
+            if client_metrics is not None:
+                client_metrics.handler_time.observe(time.perf_counter() - start_time)
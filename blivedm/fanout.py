@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+本地消息分发：一个进程连接直播间，把解析后的业务消息通过Unix域套接字转发给任意多个本地订阅者，
+这样多个进程订阅同一个房间时只需要一个连接，只解析一次
+
+守护进程::
+
+    python -m blivedm.fanout /tmp/blivedm.sock 3 4 5
+
+订阅者进程用FanoutClient代替BLiveClient，消息处理器不用改::
+
+    client = FanoutClient('/tmp/blivedm.sock', room_ids=[3], cmds=['DANMU_MSG'])
+    client.set_handler(MyHandler())
+    client.start()
+
+协议：两个方向都是一个个包，格式同sinks.raw的直通模式，包头是RAW_PACKET_HEADER_STRUCT，包体是JSON。
+守护进程发给订阅者的包体是业务消息；订阅者发给守护进程的包操作码是SUBSCRIBE_OPERATION，包体是
+{"rooms": [房间ID] 或者 null, "cmds": [cmd] 或者 null}，null表示全部，每次发送会替换之前的订阅
+"""
+import argparse
+import asyncio
+import collections
+import enum
+import json
+import logging
+import os
+import time
+from typing import *
+
+import aiohttp
+
+from . import handlers
+from .clients import web, ws_base
+from .sinks import raw
+
+__all__ = (
+    'SUBSCRIBE_OPERATION',
+    'DropPolicy',
+    'FanoutServer',
+    'FanoutClient',
+)
+
+logger = logging.getLogger('blivedm')
+
+SUBSCRIBE_OPERATION = 1000
+"""订阅者发给守护进程的订阅包的操作码，B站业务自定义OP从1000开始，不会和协议的操作码冲突"""
+
+
+class DropPolicy(enum.IntEnum):
+    """
+    订阅者的缓冲区满时怎么办
+    """
+
+    DROP_NEWEST = 0
+    """丢弃新的消息"""
+    DROP_OLDEST = 1
+    """丢弃最旧的消息，直到放得下新的消息"""
+    DISCONNECT = 2
+    """断开这个订阅者"""
+
+
+def _strip_cmd(cmd: str) -> str:
+    pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
+    if pos != -1:
+        cmd = cmd[:pos]
+    return cmd
+
+
+class _Subscriber:
+    """
+    一个订阅者连接，有自己的缓冲区和写出协程，慢的订阅者不会影响其他订阅者
+    """
+
+    def __init__(
+        self,
+        server: 'FanoutServer',
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        max_buffer_bytes: int,
+        drop_policy: DropPolicy,
+    ):
+        self._server = server
+        self._reader = reader
+        self._writer = writer
+        self._max_buffer_bytes = max_buffer_bytes
+        self._drop_policy = drop_policy
+
+        self.room_ids: Optional[Set[int]] = set()
+        """订阅的房间，None表示全部。连接后发订阅包之前不订阅任何房间"""
+        self.cmds: Optional[Set[str]] = None
+        """订阅的cmd，None表示全部"""
+
+        self._frames: Deque[bytes] = collections.deque()
+        """还没写出的包"""
+        self._buffer_bytes = 0
+        """还没写出的包的总大小"""
+        self._has_frames_event = asyncio.Event()
+        self._is_closed = False
+
+        self.sent_count = 0
+        """写出的包数"""
+        self.dropped_count = 0
+        """缓冲区满时丢弃的包数"""
+
+        self._reader_future = asyncio.create_task(self._reader_coroutine())
+        self._writer_future = asyncio.create_task(self._writer_coroutine())
+
+    @property
+    def name(self) -> str:
+        return str(id(self))
+
+    def is_subscribed(self, room_id: int, cmd: str) -> bool:
+        room_ids = self.room_ids
+        if room_ids is not None and room_id not in room_ids:
+            return False
+        cmds = self.cmds
+        return cmds is None or cmd in cmds
+
+    def push(self, frame: bytes):
+        """
+        把包放进缓冲区，在handle里调用，不会阻塞
+        """
+        if self._is_closed:
+            return
+        frame_len = len(frame)
+        if self._buffer_bytes + frame_len > self._max_buffer_bytes:
+            if self._drop_policy == DropPolicy.DROP_NEWEST:
+                self.dropped_count += 1
+                return
+            elif self._drop_policy == DropPolicy.DROP_OLDEST:
+                while self._frames and self._buffer_bytes + frame_len > self._max_buffer_bytes:
+                    self._buffer_bytes -= len(self._frames.popleft())
+                    self.dropped_count += 1
+            else:
+                logger.warning('fanout subscriber=%s is too slow, disconnecting', self.name)
+                self.close()
+                return
+
+        self._frames.append(frame)
+        self._buffer_bytes += frame_len
+        self._has_frames_event.set()
+
+    def close(self):
+        if self._is_closed:
+            return
+        self._is_closed = True
+        self._reader_future.cancel()
+        self._writer_future.cancel()
+        self._writer.close()
+        self._frames.clear()
+        self._buffer_bytes = 0
+        self._server._on_subscriber_closed(self)  # noqa
+
+    async def wait_closed(self):
+        await asyncio.gather(self._reader_future, self._writer_future, return_exceptions=True)
+
+    def get_stats(self) -> dict:
+        return {
+            'room_ids': sorted(self.room_ids) if self.room_ids is not None else None,
+            'cmds': sorted(self.cmds) if self.cmds is not None else None,
+            'buffer_bytes': self._buffer_bytes,
+            'buffer_count': len(self._frames),
+            'sent_count': self.sent_count,
+            'dropped_count': self.dropped_count,
+        }
+
+    async def _reader_coroutine(self):
+        header_struct = raw.RAW_PACKET_HEADER_STRUCT
+        try:
+            while True:
+                header = await self._reader.readexactly(header_struct.size)
+                body_len, operation, _, _ = header_struct.unpack(header)
+                body = await self._reader.readexactly(body_len)
+                if operation != SUBSCRIBE_OPERATION:
+                    logger.warning('fanout subscriber=%s sent unknown operation=%d', self.name, operation)
+                    continue
+                self._on_subscribe(json.loads(body.decode('utf-8')))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, TypeError, AttributeError):
+            logger.exception('fanout subscriber=%s sent a bad subscribe packet:', self.name)
+        finally:
+            # 不能在协程里取消自己以后再等待自己
+            if not self._is_closed:
+                asyncio.get_running_loop().call_soon(self.close)
+
+    def _on_subscribe(self, body: dict):
+        rooms = body.get('rooms', None)
+        cmds = body.get('cmds', None)
+        self.room_ids = {int(room_id) for room_id in rooms} if rooms is not None else None
+        self.cmds = {_strip_cmd(str(cmd)) for cmd in cmds} if cmds is not None else None
+        logger.info('fanout subscriber=%s subscribed rooms=%s cmds=%s', self.name, rooms, cmds)
+
+    async def _writer_coroutine(self):
+        try:
+            while True:
+                await self._has_frames_event.wait()
+                self._has_frames_event.clear()
+                frames = self._frames
+                frame_count = len(frames)
+                self._frames = collections.deque()
+                self._buffer_bytes = 0
+                self._writer.writelines(frames)
+                self.sent_count += frame_count
+                # 订阅者读得慢的时候在这里等待，期间新的包攒在缓冲区，由丢弃策略处理
+                await self._writer.drain()
+        except ConnectionError:
+            if not self._is_closed:
+                asyncio.get_running_loop().call_soon(self.close)
+
+
+class FanoutServer(handlers.HandlerInterface):
+    """
+    分发业务消息的守护进程端，同时也是消息处理器，设置为客户端的消息处理器后，收到的业务消息会转发给订阅了的订阅者
+
+    每条业务消息最多序列化一次，没有订阅者订阅时不序列化
+
+    用法::
+
+        server = FanoutServer('/tmp/blivedm.sock')
+        await server.start()
+        client = blivedm.BLiveClient(room_id)
+        client.set_handler(server)
+        client.start()
+
+    :param path: Unix域套接字路径，已存在的文件会被删除
+    :param max_buffer_bytes: 每个订阅者的缓冲区大小
+    :param drop_policy: 订阅者的缓冲区满时怎么办
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        max_buffer_bytes: int = 4 * 1024 * 1024,
+        drop_policy: DropPolicy = DropPolicy.DROP_OLDEST,
+    ):
+        self._path = path
+        self._max_buffer_bytes = max_buffer_bytes
+        self._drop_policy = drop_policy
+
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._subscribers: Dict[_Subscriber, None] = {}
+        """所有订阅者，用dict保持顺序"""
+
+        self._published_count = 0
+        """转发给至少一个订阅者的业务消息数"""
+        self._total_dropped_count = 0
+        """已断开的订阅者丢弃的包数"""
+
+    @property
+    def path(self) -> str:
+        """
+        Unix域套接字路径
+        """
+        return self._path
+
+    @property
+    def is_running(self) -> bool:
+        return self._server is not None
+
+    async def start(self):
+        """
+        开始监听
+        """
+        if self.is_running:
+            logger.warning('fanout server is running, cannot start() again')
+            return
+
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._server = await asyncio.start_unix_server(self._on_connection, self._path)
+        logger.info('fanout server is listening on %s', self._path)
+
+    async def stop_and_close(self):
+        """
+        停止监听并断开所有订阅者
+        """
+        if not self.is_running:
+            logger.warning('fanout server is stopped, cannot stop_and_close()')
+            return
+
+        server = self._server
+        self._server = None
+        server.close()
+        subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+        await asyncio.gather(*(subscriber.wait_closed() for subscriber in subscribers))
+        # Python 3.12开始wait_closed会等待所有连接关闭，所以先断开订阅者
+        await server.wait_closed()
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+    def get_stats(self) -> dict:
+        """
+        返回分发的统计数据
+        """
+        return {
+            'subscriber_count': len(self._subscribers),
+            'published_count': self._published_count,
+            'dropped_count': self._total_dropped_count + sum(
+                subscriber.dropped_count for subscriber in self._subscribers
+            ),
+            'subscribers': {subscriber.name: subscriber.get_stats() for subscriber in self._subscribers},
+        }
+
+    def _on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscriber = _Subscriber(self, reader, writer, self._max_buffer_bytes, self._drop_policy)
+        self._subscribers[subscriber] = None
+        logger.info('fanout subscriber=%s connected, subscriber_count=%d', subscriber.name, len(self._subscribers))
+
+    def _on_subscriber_closed(self, subscriber: _Subscriber):
+        if subscriber in self._subscribers:
+            del self._subscribers[subscriber]
+            self._total_dropped_count += subscriber.dropped_count
+            logger.info('fanout subscriber=%s disconnected, subscriber_count=%d', subscriber.name,
+                        len(self._subscribers))
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        if not self._subscribers:
+            return
+        room_id = client.room_id or 0
+        cmd = _strip_cmd(command.get('cmd', ''))
+        frame = None
+        # 订阅者断开时会从字典删除，所以复制一份
+        for subscriber in list(self._subscribers):
+            if not subscriber.is_subscribed(room_id, cmd):
+                continue
+            if frame is None:
+                frame = raw.encode_raw_packet(
+                    room_id, ws_base.Operation.SEND_MSG_REPLY, time.time(),
+                    json.dumps(command, ensure_ascii=False).encode('utf-8')
+                )
+                self._published_count += 1
+            subscriber.push(frame)
+
+
+class FanoutClient(ws_base.WebSocketClientBase):
+    """
+    订阅者端，从FanoutServer接收业务消息，交给消息处理器。用法和其他客户端一样
+
+    断线后按重连策略重连。收到消息时room_id是消息所属的房间ID
+
+    :param path: Unix域套接字路径
+    :param room_ids: 订阅的房间，None表示全部
+    :param cmds: 订阅的cmd，None表示全部
+    :param session: 同WebSocketClientBase，用不到
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        room_ids: Optional[Iterable[int]] = None,
+        cmds: Optional[Iterable[str]] = None,
+        session: Optional[aiohttp.ClientSession] = None,
+    ):
+        super().__init__(session)
+        self._path = path
+        self._subscribed_room_ids: Optional[List[int]] = list(room_ids) if room_ids is not None else None
+        self._subscribed_cmds: Optional[List[str]] = list(cmds) if cmds is not None else None
+
+    async def init_room(self) -> bool:
+        return True
+
+    async def _network_coroutine(self):
+        retry_count = 0
+        total_retry_count = 0
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self._path)
+            except OSError as e:
+                logger.warning('fanout client failed to connect to %s: %r', self._path, e)
+            else:
+                try:
+                    await self._send_subscribe(writer)
+                    retry_count = 0
+                    await self._receive_coroutine(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    pass
+                finally:
+                    writer.close()
+
+            retry_count += 1
+            total_retry_count += 1
+            logger.warning('fanout client is reconnecting, retry_count=%d, total_retry_count=%d',
+                           retry_count, total_retry_count)
+            await asyncio.sleep(self._get_reconnect_interval(retry_count, total_retry_count))
+
+    async def _send_subscribe(self, writer: asyncio.StreamWriter):
+        body = json.dumps({'rooms': self._subscribed_room_ids, 'cmds': self._subscribed_cmds}).encode('utf-8')
+        writer.write(raw.encode_raw_packet(None, SUBSCRIBE_OPERATION, time.time(), body))
+        await writer.drain()
+
+    async def _receive_coroutine(self, reader: asyncio.StreamReader):
+        header_struct = raw.RAW_PACKET_HEADER_STRUCT
+        while True:
+            header = await reader.readexactly(header_struct.size)
+            body_len, _, _, room_id = header_struct.unpack(header)
+            body = await reader.readexactly(body_len)
+            self._room_id = room_id
+            try:
+                self._handle_command(json.loads(body.decode('utf-8')))
+            except Exception:  # noqa
+                logger.exception('room=%d fanout client failed to handle body=%s', room_id, body)
+
+
+async def run_daemon(path: str, room_ids: List[int], **kwargs):
+    """
+    运行守护进程，直到被取消
+
+    :param path: Unix域套接字路径
+    :param room_ids: 连接的房间ID
+    :param kwargs: 见FanoutServer
+    """
+    server = FanoutServer(path, **kwargs)
+    await server.start()
+    clients = [web.BLiveClient(room_id) for room_id in room_ids]
+    try:
+        for client in clients:
+            client.set_handler(server)
+            client.start()
+        await asyncio.gather(*(client.join() for client in clients))
+    finally:
+        await asyncio.gather(*(client.stop_and_close() for client in clients))
+        await server.stop_and_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地消息分发守护进程')
+    parser.add_argument('path', help='Unix域套接字路径')
+    parser.add_argument('room_ids', type=int, nargs='+', help='连接的房间ID')
+    parser.add_argument('--max-buffer-bytes', type=int, default=4 * 1024 * 1024, help='每个订阅者的缓冲区大小')
+    parser.add_argument('--drop-policy', choices=[policy.name.lower() for policy in DropPolicy],
+                        default=DropPolicy.DROP_OLDEST.name.lower(), help='订阅者的缓冲区满时怎么办')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    try:
+        asyncio.run(run_daemon(
+            args.path, args.room_ids, max_buffer_bytes=args.max_buffer_bytes,
+            drop_policy=DropPolicy[args.drop_policy.upper()]
+        ))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 import logging
 from typing import *
 
+from . import hooks
 from .clients import ws_base
 from .models import web as web_models, open_live as open_models
 
@@ -86,12 +87,22 @@ def _get_valid_method(handler: 'BaseHandler', method_name):
     return method
 
 
+def _construct_message(client: ws_base.WebSocketClientBase, message_cls, construct: Callable[[Any], Any], data):
+    """
+    构造消息模型，客户端安装了阶段钩子时在钩子里调用。client不一定是WebSocketClientBase，比如转码时传的是简单对象
+    """
+    stage_hooks = getattr(client, '_stage_hooks', None)
+    if stage_hooks is None:
+        return construct(data)
+    return stage_hooks.call(client, hooks.Stage.MODEL_CONSTRUCT, message_cls, construct, data)
+
+
 def _make_msg_callback(method_name, message_cls):
     def callback(self: 'BaseHandler', client: ws_base.WebSocketClientBase, command: dict):
         method = _get_valid_method(self, method_name)
         if method is None:
             return None
-        return method(client, message_cls.from_command(command['data']))
+        return method(client, _construct_message(client, message_cls, message_cls.from_command, command['data']))
     return callback
 
 
@@ -104,13 +115,17 @@ class BaseHandler(HandlerInterface):
         method = _get_valid_method(self, '_on_danmaku')
         if method is None:
             return None
-        return method(client, web_models.DanmakuMessage.from_command(command['info']))
+        return method(client, _construct_message(
+            client, web_models.DanmakuMessage, web_models.DanmakuMessage.from_command, command['info']
+        ))
 
     def __danmu_msg_mirror_callback(self, client: ws_base.WebSocketClientBase, command: dict):
         method = _get_valid_method(self, '_on_danmaku')
         if method is None:
             return None
-        message = web_models.DanmakuMessage.from_command(command['info'])
+        message = _construct_message(
+            client, web_models.DanmakuMessage, web_models.DanmakuMessage.from_command, command['info']
+        )
         message.is_mirror = True
         return method(client, message)
 
@@ -119,7 +134,9 @@ class BaseHandler(HandlerInterface):
         if method is None:
             return None
         # 跨房弹幕可能缺少一些字段，详情参考官方文档
-        message = open_models.DanmakuMessage.from_command(command['data'])
+        message = _construct_message(
+            client, open_models.DanmakuMessage, open_models.DanmakuMessage.from_command, command['data']
+        )
         message.is_mirror = True
         return method(client, message)
 
@@ -127,7 +144,9 @@ class BaseHandler(HandlerInterface):
         method = _get_valid_method(self, '_on_gift')
         if method is None:
             return
-        messages = web_models.GiftMessage.batch_from_command_v2(command['data'])
+        messages = _construct_message(
+            client, web_models.GiftMessage, web_models.GiftMessage.batch_from_command_v2, command['data']
+        )
         for message in messages:
             method(client, message)
 
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import enum
+import logging
+from typing import *
+
+if TYPE_CHECKING:
+    from .clients import ws_base
+
+__all__ = (
+    'Stage',
+    'StageHookInterface',
+    'StageHookList',
+)
+
+logger = logging.getLogger('blivedm')
+
+
+class Stage(enum.IntEnum):
+    """
+    收消息路径上的阶段
+    """
+
+    HEADER_PARSE = 0
+    """解析包头，info是包头在WebSocket消息里的偏移"""
+    DECOMPRESS = 1
+    """解压，info是包头HeaderTuple"""
+    JSON_DECODE = 2
+    """JSON反序列化，info是原始JSON数据"""
+    DISPATCH = 3
+    """调用消息处理器的handle，info是业务消息"""
+    MODEL_CONSTRUCT = 4
+    """BaseHandler把业务消息转换成消息模型，info是消息模型的类"""
+
+
+class StageHookInterface:
+    """
+    阶段钩子接口，可以用来计时、采样、追踪，不用monkey patch私有方法
+
+    注意钩子和网络协程运行在同一个协程，耗时太长会阻塞接收消息
+    """
+
+    def on_stage_begin(self, client: 'ws_base.WebSocketClientBase', stage: Stage, info: Any) -> Any:
+        """
+        阶段开始时调用
+
+        :param client: 客户端
+        :param stage: 阶段
+        :param info: 阶段相关的数据，见Stage
+        :return: 会原样传给on_stage_end，例如开始时间
+        """
+
+    def on_stage_end(
+        self,
+        client: 'ws_base.WebSocketClientBase',
+        stage: Stage,
+        info: Any,
+        context: Any,
+        exception: Optional[BaseException],
+    ):
+        """
+        阶段结束时调用，阶段抛出异常时也会调用
+
+        :param client: 客户端
+        :param stage: 阶段
+        :param info: 阶段相关的数据，见Stage
+        :param context: on_stage_begin的返回值
+        :param exception: 阶段抛出的异常，没有则为None
+        """
+
+
+class StageHookList:
+    """
+    客户端安装的所有钩子，按安装顺序调用on_stage_begin，按相反顺序调用on_stage_end
+
+    钩子抛出的异常只打日志，不影响收消息
+    """
+
+    def __init__(self, hooks: Iterable[StageHookInterface] = ()):
+        self._hooks: Tuple[StageHookInterface, ...] = tuple(hooks)
+
+    @property
+    def hooks(self) -> Tuple[StageHookInterface, ...]:
+        return self._hooks
+
+    def begin(self, client: 'ws_base.WebSocketClientBase', stage: Stage, info: Any) -> List[Any]:
+        """
+        调用所有钩子的on_stage_begin
+
+        :return: 各个钩子的返回值，要传给end
+        """
+        contexts = []
+        for hook in self._hooks:
+            try:
+                context = hook.on_stage_begin(client, stage, info)
+            except Exception:  # noqa
+                logger.exception('room=%s on_stage_begin() failed, stage=%s', client.room_id, stage.name)
+                context = None
+            contexts.append(context)
+        return contexts
+
+    def end(
+        self,
+        client: 'ws_base.WebSocketClientBase',
+        stage: Stage,
+        info: Any,
+        contexts: List[Any],
+        exception: Optional[BaseException],
+    ):
+        """
+        调用所有钩子的on_stage_end
+
+        :param contexts: begin的返回值
+        """
+        for hook, context in zip(reversed(self._hooks), reversed(contexts)):
+            try:
+                hook.on_stage_end(client, stage, info, context, exception)
+            except Exception:  # noqa
+                logger.exception('room=%s on_stage_end() failed, stage=%s', client.room_id, stage.name)
+
+    def call(self, client: 'ws_base.WebSocketClientBase', stage: Stage, info: Any, func: Callable, *args):
+        """
+        便利函数，在钩子里调用一个同步函数
+
+        :return: func的返回值
+        """
+        contexts = self.begin(client, stage, info)
+        try:
+            result = func(*args)
+        except BaseException as e:
+            self.end(client, stage, info, contexts, e)
+            raise
+        self.end(client, stage, info, contexts, None)
+        return result
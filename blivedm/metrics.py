@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+import collections
+import threading
+import weakref
+from typing import *
+
+if TYPE_CHECKING:
+    from .clients import ws_base
+
+__all__ = (
+    'TimeSummary',
+    'ClientMetrics',
+    'MetricsRegistry',
+    'default_registry',
+)
+
+
+class TimeSummary:
+    """
+    耗时统计
+    """
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        """次数"""
+        self.total = 0.0
+        """总耗时（秒）"""
+        self.max = 0.0
+        """最大耗时（秒）"""
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: 'TimeSummary'):
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'total': self.total, 'max': self.max}
+
+
+class ClientMetrics:
+    """
+    一个客户端的统计数据，由网络协程直接修改，不加锁
+
+    :param room_id: 房间ID，导出时会更新成客户端当前的房间ID
+    """
+
+    def __init__(self, room_id: Optional[int] = None):
+        self.room_id = room_id
+        """房间ID"""
+
+        self.frame_count = 0
+        """收到的WebSocket消息数"""
+        self.byte_count = 0
+        """收到的WebSocket消息字节数"""
+        self.packet_counts: DefaultDict[Tuple[int, int], int] = collections.defaultdict(int)
+        """(协议版本ProtoVer, 操作码Operation) -> 包数，包括解压出来的包"""
+        self.command_counts: DefaultDict[str, int] = collections.defaultdict(int)
+        """cmd -> 业务消息数，包括处理器不认识的cmd"""
+        self.reconnect_count = 0
+        """重连次数"""
+
+        self.decompress_time = TimeSummary()
+        """解压耗时，包括在线程池排队的时间"""
+        self.json_decode_time = TimeSummary()
+        """JSON反序列化耗时"""
+        self.handler_time = TimeSummary()
+        """消息处理器耗时"""
+
+    def merge(self, other: 'ClientMetrics'):
+        """
+        把另一个统计数据加到这个上面
+        """
+        self.frame_count += other.frame_count
+        self.byte_count += other.byte_count
+        for key, count in other.packet_counts.items():
+            self.packet_counts[key] += count
+        for cmd, count in other.command_counts.items():
+            self.command_counts[cmd] += count
+        self.reconnect_count += other.reconnect_count
+        self.decompress_time.merge(other.decompress_time)
+        self.json_decode_time.merge(other.json_decode_time)
+        self.handler_time.merge(other.handler_time)
+
+    def snapshot(self) -> dict:
+        """
+        返回当前统计数据的副本
+        """
+        from .clients import ws_base
+
+        return {
+            'room_id': self.room_id,
+            'frame_count': self.frame_count,
+            'byte_count': self.byte_count,
+            'packet_counts': {
+                (_enum_name(ws_base.ProtoVer, ver), _enum_name(ws_base.Operation, operation)): count
+                for (ver, operation), count in self.packet_counts.items()
+            },
+            'command_counts': dict(self.command_counts),
+            'reconnect_count': self.reconnect_count,
+            'decompress_time': self.decompress_time.snapshot(),
+            'json_decode_time': self.json_decode_time.snapshot(),
+            'handler_time': self.handler_time.snapshot(),
+        }
+
+
+def _enum_name(enum_cls, value: int) -> str:
+    try:
+        return enum_cls(value).name
+    except ValueError:
+        return str(value)
+
+
+class MetricsRegistry:
+    """
+    统计数据注册表，汇总一个进程里多个客户端的统计数据
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client_to_metrics: 'weakref.WeakKeyDictionary[ws_base.WebSocketClientBase, ClientMetrics]' = (
+            weakref.WeakKeyDictionary()
+        )
+        """客户端 -> 统计数据"""
+        self._retired_metrics = ClientMetrics()
+        """已经注销的客户端的统计数据，这样进程总计不会变小"""
+
+    def register(self, client: 'ws_base.WebSocketClientBase') -> ClientMetrics:
+        """
+        注册一个客户端，一般不直接调用，而是用client.enable_metrics()
+        """
+        with self._lock:
+            metrics = self._client_to_metrics.get(client, None)
+            if metrics is None:
+                metrics = self._client_to_metrics[client] = ClientMetrics(client.room_id)
+            return metrics
+
+    def unregister(self, client: 'ws_base.WebSocketClientBase'):
+        """
+        注销一个客户端，它的统计数据会合并到进程总计里
+        """
+        with self._lock:
+            metrics = self._client_to_metrics.pop(client, None)
+            if metrics is not None:
+                self._retired_metrics.merge(metrics)
+
+    def get_all_metrics(self) -> List[ClientMetrics]:
+        """
+        返回所有已注册客户端的统计数据
+        """
+        with self._lock:
+            client_metrics_list = list(self._client_to_metrics.items())
+        # 客户端调用init_room后房间ID才确定
+        for client, metrics in client_metrics_list:
+            metrics.room_id = client.room_id
+        return [metrics for _, metrics in client_metrics_list]
+
+    def get_total_metrics(self) -> ClientMetrics:
+        """
+        返回进程总计，包括已经注销的客户端
+        """
+        total = ClientMetrics()
+        with self._lock:
+            total.merge(self._retired_metrics)
+            for metrics in self._client_to_metrics.values():
+                total.merge(metrics)
+        return total
+
+    def snapshot(self) -> dict:
+        """
+        返回所有统计数据的副本
+
+        `{'total': {...}, 'clients': [{...}, ...], 'net': {...}}`
+        """
+        from .clients import net
+
+        return {
+            'total': self.get_total_metrics().snapshot(),
+            'clients': [metrics.snapshot() for metrics in self.get_all_metrics()],
+            'net': net.get_stats(),
+        }
+
+    def to_prometheus_text(self, per_room=True) -> str:
+        """
+        导出Prometheus文本格式
+
+        :param per_room: 是否按房间ID分开导出，房间很多时可以关掉，只导出进程总计。连同一个房间的客户端会合并，
+                         房间ID还没确定的客户端只计入进程总计
+        """
+        from .clients import net
+
+        if per_room:
+            labeled_metrics = [
+                ({'room_id': str(room_id)}, metrics) for room_id, metrics in sorted(self._get_room_metrics().items())
+            ]
+        else:
+            labeled_metrics = [({}, self.get_total_metrics())]
+
+        writer = _PrometheusWriter()
+        writer.add_counter('blivedm_frames_total', 'WebSocket messages received', [
+            (labels, metrics.frame_count) for labels, metrics in labeled_metrics
+        ])
+        writer.add_counter('blivedm_received_bytes_total', 'WebSocket message bytes received', [
+            (labels, metrics.byte_count) for labels, metrics in labeled_metrics
+        ])
+        writer.add_counter('blivedm_packets_total', 'Packets received, including decompressed ones', [
+            ({**labels, 'ver': ver, 'operation': operation}, count)
+            for labels, metrics in labeled_metrics
+            for (ver, operation), count in metrics.snapshot()['packet_counts'].items()
+        ])
+        writer.add_counter('blivedm_commands_total', 'Business commands received', [
+            ({**labels, 'cmd': cmd}, count)
+            for labels, metrics in labeled_metrics
+            for cmd, count in metrics.command_counts.items()
+        ])
+        writer.add_counter('blivedm_reconnects_total', 'Reconnections', [
+            (labels, metrics.reconnect_count) for labels, metrics in labeled_metrics
+        ])
+        for name, attr, help_ in (
+            ('blivedm_decompress_seconds', 'decompress_time', 'Time spent decompressing'),
+            ('blivedm_json_decode_seconds', 'json_decode_time', 'Time spent decoding JSON'),
+            ('blivedm_handler_seconds', 'handler_time', 'Time spent in the message handler'),
+        ):
+            writer.add_summary(name, help_, [
+                (labels, getattr(metrics, attr)) for labels, metrics in labeled_metrics
+            ])
+
+        for key, value in net.get_stats().items():
+            if key.endswith('_time_total'):
+                writer.add_counter(f'blivedm_net_{key[:-len("_time_total")]}_seconds_total', key, [({}, value)])
+            elif key.endswith('_time_max'):
+                writer.add_gauge(f'blivedm_net_{key[:-len("_time_max")]}_seconds_max', key, [({}, value)])
+            elif '_cached_' in key:
+                # 缓存大小，不是累计值
+                writer.add_gauge(f'blivedm_net_{key}', key, [({}, value)])
+            else:
+                writer.add_counter(f'blivedm_net_{key[:-len("_count")]}_total', key, [({}, value)])
+        return writer.getvalue()
+
+    def _get_room_metrics(self) -> Dict[int, ClientMetrics]:
+        """
+        按房间ID汇总已注册客户端的统计数据，同一个标签集合只能导出一次
+
+        冗余模式、迁移时可能有多个客户端连同一个房间，要合并起来；还没调用init_room的客户端不导出
+        """
+        room_id_to_metrics: Dict[int, ClientMetrics] = {}
+        for metrics in self.get_all_metrics():
+            if metrics.room_id is None:
+                continue
+            room_metrics = room_id_to_metrics.get(metrics.room_id, None)
+            if room_metrics is None:
+                room_metrics = room_id_to_metrics[metrics.room_id] = ClientMetrics(metrics.room_id)
+            room_metrics.merge(metrics)
+        return room_id_to_metrics
+
+
+class _PrometheusWriter:
+    def __init__(self):
+        self._lines: List[str] = []
+
+    def getvalue(self) -> str:
+        return '\n'.join(self._lines) + '\n'
+
+    def add_counter(self, name: str, help_: str, samples: Iterable[Tuple[Dict[str, str], float]]):
+        self._add_metric(name, help_, 'counter', samples)
+
+    def add_gauge(self, name: str, help_: str, samples: Iterable[Tuple[Dict[str, str], float]]):
+        self._add_metric(name, help_, 'gauge', samples)
+
+    def add_summary(self, name: str, help_: str, samples: Iterable[Tuple[Dict[str, str], TimeSummary]]):
+        self._lines.append(f'# HELP {name} {help_}')
+        self._lines.append(f'# TYPE {name} summary')
+        for labels, summary in samples:
+            self._lines.append(f'{name}_count{self._format_labels(labels)} {summary.count}')
+            self._lines.append(f'{name}_sum{self._format_labels(labels)} {summary.total}')
+
+    def _add_metric(self, name: str, help_: str, type_: str, samples: Iterable[Tuple[Dict[str, str], float]]):
+        self._lines.append(f'# HELP {name} {help_}')
+        self._lines.append(f'# TYPE {name} {type_}')
+        for labels, value in samples:
+            self._lines.append(f'{name}{self._format_labels(labels)} {value}')
+
+    @staticmethod
+    def _format_labels(labels: Dict[str, str]) -> str:
+        if not labels:
+            return ''
+        label_str = ','.join(
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels.items()
+        )
+        return '{' + label_str + '}'
+
+
+default_registry = MetricsRegistry()
+"""默认的统计数据注册表"""
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+消息处理器前的中间件管道：去重、屏蔽、补充信息、采样等步骤按顺序执行，可以处理业务消息或者消息模型
+
+步骤按cmd编译成一个分发函数，收到消息时只按cmd查一次表。不处理某个cmd的步骤对这个cmd没有任何开销，
+没有步骤处理的cmd直接交给消息处理器::
+
+    handler = middleware.MiddlewareHandler(MyHandler(), [
+        middleware.DedupStep(),
+        middleware.FilterStep(lambda message: message.uid not in blocked_uids, model_type=web_models.DanmakuMessage),
+        middleware.SampleStep(0.1, cmds=['INTERACT_WORD_V2']),
+    ])
+    client.set_handler(handler)
+"""
+import functools
+import random
+from typing import *
+
+from . import bus, handlers
+from .clients import dedup, ws_base
+from .models import web as web_models, open_live as open_models
+
+__all__ = (
+    'StepInterface',
+    'FunctionStep',
+    'FilterStep',
+    'SampleStep',
+    'DedupStep',
+    'MiddlewareHandler',
+)
+
+_Dispatch = Callable[[ws_base.WebSocketClientBase, dict], Any]
+
+_MODEL_METHOD_NAMES: Dict[type, str] = {
+    web_models.HeartbeatMessage: '_on_heartbeat',
+    web_models.DanmakuMessage: '_on_danmaku',
+    web_models.GiftMessage: '_on_gift',
+    web_models.GuardBuyMessage: '_on_buy_guard',
+    web_models.UserToastV2Message: '_on_user_toast_v2',
+    web_models.SuperChatMessage: '_on_super_chat',
+    web_models.SuperChatDeleteMessage: '_on_super_chat_delete',
+    web_models.InteractWordV2Message: '_on_interact_word_v2',
+
+    open_models.DanmakuMessage: '_on_open_live_danmaku',
+    open_models.GiftMessage: '_on_open_live_gift',
+    open_models.GuardBuyMessage: '_on_open_live_buy_guard',
+    open_models.SuperChatMessage: '_on_open_live_super_chat',
+    open_models.SuperChatDeleteMessage: '_on_open_live_super_chat_delete',
+    open_models.LikeMessage: '_on_open_live_like',
+    open_models.RoomEnterMessage: '_on_open_live_enter_room',
+    open_models.LiveStartMessage: '_on_open_live_start_live',
+    open_models.LiveEndMessage: '_on_open_live_end_live',
+}
+"""消息模型的类 -> BaseHandler处理它的方法名"""
+
+
+class StepInterface:
+    """
+    中间件步骤接口
+
+    model_type是None时处理业务消息，否则处理这个类的消息模型
+    """
+
+    cmds: Optional[Collection[str]] = None
+    """只处理这些cmd，None表示所有cmd"""
+    model_type: Optional[type] = None
+    """处理的消息模型的类，None表示处理业务消息"""
+
+    def process(self, client: ws_base.WebSocketClientBase, item: Any) -> Any:
+        """
+        处理一条消息
+
+        :param client: 客户端
+        :param item: 业务消息或者消息模型
+        :return: 交给下一步的业务消息或者消息模型，可以是修改过的或者新的对象。返回None则丢弃这条消息
+        """
+        raise NotImplementedError
+
+
+class FunctionStep(StepInterface):
+    """
+    用函数实现的步骤，函数签名同StepInterface.process
+
+    :param func: process函数
+    :param cmds: 只处理这些cmd，None表示所有cmd
+    :param model_type: 处理的消息模型的类，None表示处理业务消息
+    """
+
+    def __init__(
+        self,
+        func: Callable[[ws_base.WebSocketClientBase, Any], Any],
+        *,
+        cmds: Optional[Iterable[str]] = None,
+        model_type: Optional[type] = None,
+    ):
+        self.cmds = frozenset(cmds) if cmds is not None else None
+        self.model_type = model_type
+        self.process = func
+
+
+class FilterStep(StepInterface):
+    """
+    过滤消息，可以用来实现屏蔽词、屏蔽用户
+
+    :param predicate: 输入业务消息或者消息模型，返回False则丢弃这条消息
+    :param cmds: 只处理这些cmd，None表示所有cmd
+    :param model_type: 处理的消息模型的类，None表示处理业务消息
+    """
+
+    def __init__(
+        self,
+        predicate: Callable[[Any], bool],
+        *,
+        cmds: Optional[Iterable[str]] = None,
+        model_type: Optional[type] = None,
+    ):
+        self.cmds = frozenset(cmds) if cmds is not None else None
+        self.model_type = model_type
+        self._predicate = predicate
+
+    def process(self, client: ws_base.WebSocketClientBase, item: Any) -> Any:
+        return item if self._predicate(item) else None
+
+
+class SampleStep(StepInterface):
+    """
+    随机采样业务消息，适合只用来做统计的高频消息
+
+    :param rate: 保留的比例，0~1
+    :param cmds: 只处理这些cmd，None表示所有cmd
+    """
+
+    def __init__(self, rate: float, *, cmds: Optional[Iterable[str]] = None):
+        if not 0 <= rate <= 1:
+            raise ValueError(f'rate={rate} should be in [0, 1]')
+        self.cmds = frozenset(cmds) if cmds is not None else None
+        self._rate = rate
+        self._random = random.random
+
+    def process(self, client: ws_base.WebSocketClientBase, item: dict) -> Optional[dict]:
+        return item if self._random() < self._rate else None
+
+
+class DedupStep(StepInterface):
+    """
+    按消息ID去重业务消息，用来合并多个来源重复推送的消息。没有ID的消息不去重
+
+    :param cmds: 只处理这些cmd，默认是带ID的cmd
+    :param max_size: 最多保存多少条消息的标识
+    """
+
+    DEFAULT_CMDS = frozenset((
+        'DANMU_MSG',
+        'DANMU_MSG_MIRROR',
+        'SEND_GIFT',
+        'SUPER_CHAT_MESSAGE',
+        'LIVE_OPEN_PLATFORM_DM',
+        'LIVE_OPEN_PLATFORM_DM_MIRROR',
+        'LIVE_OPEN_PLATFORM_SEND_GIFT',
+        'LIVE_OPEN_PLATFORM_GUARD',
+        'LIVE_OPEN_PLATFORM_SUPER_CHAT',
+        'LIVE_OPEN_PLATFORM_LIKE',
+    ))
+    """带ID的cmd"""
+
+    def __init__(self, *, cmds: Optional[Iterable[str]] = DEFAULT_CMDS, max_size=4096):
+        self.cmds = frozenset(cmds) if cmds is not None else None
+        self._deduplicator = dedup.CommandDeduplicator(max_size)
+
+    def process(self, client: ws_base.WebSocketClientBase, item: dict) -> Optional[dict]:
+        return None if self._deduplicator.is_duplicate(item) else item
+
+
+def _compile_dispatch(
+    raw_steps: Tuple[Callable, ...],
+    builder: Optional[bus._ModelBuilder],  # noqa
+    model_steps: Tuple[Callable, ...],
+    deliver: Callable,
+) -> _Dispatch:
+    """
+    把一个cmd的所有步骤编译成一个分发函数
+
+    :param raw_steps: 处理业务消息的步骤的process
+    :param builder: 构造消息模型的函数，None表示不用构造消息模型
+    :param model_steps: 处理消息模型的步骤的process
+    :param deliver: 最后调用的函数，builder是None时是deliver(client, command)，否则是deliver(client, message)
+    """
+    if builder is None:
+        if not raw_steps:
+            return deliver
+
+        def dispatch(client: ws_base.WebSocketClientBase, command: dict):
+            for step in raw_steps:
+                command = step(client, command)
+                if command is None:
+                    return
+            deliver(client, command)
+        return dispatch
+
+    def dispatch(client: ws_base.WebSocketClientBase, command: dict):
+        for step in raw_steps:
+            command = step(client, command)
+            if command is None:
+                return
+        for message in builder(client, command):
+            for step in model_steps:
+                message = step(client, message)
+                if message is None:
+                    break
+            else:
+                deliver(client, message)
+    return dispatch
+
+
+class MiddlewareHandler(handlers.HandlerInterface):
+    """
+    在消息处理器前执行中间件步骤的消息处理器
+
+    处理消息模型的步骤要求消息处理器是BaseHandler，这时由管道构造消息模型，经过所有步骤后再调用_on_xxx方法。
+    消息处理器没有重写对应的_on_xxx方法时不构造消息模型，处理消息模型的步骤也不会执行
+
+    :param handler: 最终的消息处理器
+    :param steps: 按顺序执行的步骤
+    """
+
+    def __init__(self, handler: handlers.HandlerInterface, steps: Iterable[StepInterface] = ()):
+        self._handler = handler
+        self._steps: List[StepInterface] = []
+        self._cmd_to_dispatch: Dict[str, _Dispatch] = {}
+        """cmd -> 编译好的分发函数"""
+        self._default_dispatch: _Dispatch = handler.handle
+        """不在_cmd_to_dispatch里的cmd的分发函数"""
+        for step in steps:
+            self._check_step(step)
+            self._steps.append(step)
+        self._compile()
+
+    @property
+    def handler(self) -> handlers.HandlerInterface:
+        return self._handler
+
+    @property
+    def steps(self) -> List[StepInterface]:
+        return list(self._steps)
+
+    def add_step(self, step: StepInterface, index: Optional[int] = None):
+        """
+        添加步骤
+
+        :param step: 步骤
+        :param index: 插入的位置，None表示加到最后
+        """
+        self._check_step(step)
+        if index is None:
+            self._steps.append(step)
+        else:
+            self._steps.insert(index, step)
+        self._compile()
+
+    def remove_step(self, step: StepInterface):
+        """
+        删除步骤，没有则忽略
+        """
+        try:
+            self._steps.remove(step)
+        except ValueError:
+            return
+        self._compile()
+
+    def _check_step(self, step: StepInterface):
+        if step.model_type is None:
+            return
+        if step.model_type not in _MODEL_METHOD_NAMES:
+            raise ValueError(f'no cmd produces model_type={step.model_type!r}')
+        if not isinstance(self._handler, handlers.BaseHandler):
+            raise TypeError(f'steps with model_type require a BaseHandler, got handler={self._handler!r}')
+
+    def _compile(self):
+        """
+        把所有步骤按cmd编译成分发函数
+        """
+        handler = self._handler
+        wildcard_raw_steps = tuple(
+            step.process for step in self._steps if step.model_type is None and step.cmds is None
+        )
+        cmds = set()
+        for step in self._steps:
+            if step.model_type is not None:
+                cmds.update(
+                    cmd for cmd, (model_type, _) in bus._CMD_MODEL_BUILDERS.items()  # noqa
+                    if model_type is step.model_type
+                )
+            elif step.cmds is not None:
+                cmds.update(step.cmds)
+        if self._can_call_callbacks():
+            # 所有已知cmd都直接调用回调，省去BaseHandler.handle里的分发
+            cmds.update(handler._CMD_CALLBACK_DICT)  # noqa
+
+        cmd_to_dispatch = {}
+        for cmd in cmds:
+            raw_steps = tuple(
+                step.process for step in self._steps
+                if step.model_type is None and (step.cmds is None or cmd in step.cmds)
+            )
+            model_type, builder = bus._CMD_MODEL_BUILDERS.get(cmd, (None, None))  # noqa
+            model_steps = tuple(
+                step.process for step in self._steps
+                if step.model_type is not None and step.model_type is model_type
+                and (step.cmds is None or cmd in step.cmds)
+            )
+            if model_steps:
+                method = handlers._get_valid_method(handler, _MODEL_METHOD_NAMES[model_type])  # noqa
+                if method is None:
+                    # 消息处理器不处理这个cmd，也就不用执行步骤了
+                    cmd_to_dispatch[cmd] = _compile_dispatch(raw_steps, None, (), _noop)
+                    continue
+                cmd_to_dispatch[cmd] = _compile_dispatch(raw_steps, builder, model_steps, method)
+            else:
+                cmd_to_dispatch[cmd] = _compile_dispatch(raw_steps, None, (), self._get_raw_deliver(cmd))
+
+        self._cmd_to_dispatch = cmd_to_dispatch
+        if wildcard_raw_steps:
+            self._default_dispatch = _compile_dispatch(wildcard_raw_steps, None, (), handler.handle)
+        else:
+            self._default_dispatch = handler.handle
+
+    def _can_call_callbacks(self) -> bool:
+        """
+        消息处理器是没有重写handle的BaseHandler，可以直接调用cmd的回调
+        """
+        handler = self._handler
+        return isinstance(handler, handlers.BaseHandler) and type(handler).handle is handlers.BaseHandler.handle
+
+    def _get_raw_deliver(self, cmd: str) -> _Dispatch:
+        """
+        返回把业务消息交给消息处理器的函数
+        """
+        handler = self._handler
+        if not self._can_call_callbacks() or cmd not in handler._CMD_CALLBACK_DICT:  # noqa
+            return handler.handle
+
+        callback = handler._CMD_CALLBACK_DICT[cmd]  # noqa
+        if callback is None:
+            return _noop
+        return functools.partial(callback, handler)
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        cmd = command.get('cmd', '')
+        pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
+        if pos != -1:
+            cmd = cmd[:pos]
+        self._cmd_to_dispatch.get(cmd, self._default_dispatch)(client, command)
+
+    def on_client_stopped(self, client: ws_base.WebSocketClientBase, exception: Optional[Exception]):
+        self._handler.on_client_stopped(client, exception)
+
+
+def _noop(client: ws_base.WebSocketClientBase, item: Any):
+    pass
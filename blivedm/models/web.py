@@ -4,7 +4,8 @@ import dataclasses
 import json
 from typing import *
 
-from . import pb
+if TYPE_CHECKING:
+    from . import pb as pb_module
 
 __all__ = (
     'HeartbeatMessage',
@@ -15,6 +16,19 @@ __all__ = (
     'SuperChatDeleteMessage',
 )
 
+_pb: Optional['pb_module'] = None
+
+
+def _get_pb() -> 'pb_module':
+    """
+    pure_protobuf导入很慢，第一次解析protobuf编码的消息时才导入
+    """
+    global _pb
+    if _pb is None:
+        from . import pb
+        _pb = pb
+    return _pb
+
 
 @dataclasses.dataclass
 class HeartbeatMessage:
@@ -355,7 +369,7 @@ class GiftMessage:
 
     @classmethod
     def batch_from_command_v2(cls, data: dict) -> List['GiftMessage']:
-        proto = pb.SendGiftBroadcast.loads(base64.b64decode(data['pb']))
+        proto = _get_pb().SendGiftBroadcast.loads(base64.b64decode(data['pb']))
         medal_info = proto.medal_info
         blind_gift = proto.blind_gift
 
@@ -608,7 +622,7 @@ class InteractWordV2Message:
 
     @classmethod
     def from_command(cls, data: dict):
-        proto = pb.InteractWordV2.loads(base64.b64decode(data['pb']))
+        proto = _get_pb().InteractWordV2.loads(base64.b64decode(data['pb']))
         return cls(
             uid=proto.uid,
             username=proto.uname,
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import dataclasses
+import logging
+import time
+import weakref
+from typing import *
+
+from . import hooks
+from .clients import ws_base
+
+__all__ = (
+    'SlowCall',
+    'OffenderStats',
+    'StallMonitor',
+)
+
+logger = logging.getLogger('blivedm')
+
+
+@dataclasses.dataclass
+class SlowCall:
+    """
+    一次超过预算的消息处理
+    """
+
+    room_id: Optional[int]
+    """房间ID"""
+    cmd: str
+    """业务消息的cmd"""
+    duration: float
+    """耗时（秒）"""
+    time: float
+    """发生的时间戳（秒）"""
+
+
+@dataclasses.dataclass
+class OffenderStats:
+    """
+    一个房间的一种cmd超过预算的统计
+    """
+
+    room_id: Optional[int]
+    """房间ID"""
+    cmd: str
+    """业务消息的cmd"""
+    count: int = 0
+    """超过预算的次数"""
+    total_duration: float = 0.0
+    """超过预算的总耗时（秒）"""
+    max_duration: float = 0.0
+    """最大耗时（秒）"""
+    last_time: float = 0.0
+    """最近一次超过预算的时间戳（秒）"""
+
+
+class StallMonitor(hooks.StageHookInterface):
+    """
+    事件循环阻塞检测器
+
+    作为阶段钩子给每次调用消息处理器计时，超过预算的记下房间ID和cmd；另外定时采样事件循环的延迟。
+    消息处理器和网络协程运行在同一个协程，阻塞太久会导致超过接收超时时间而断线重连
+
+    用法::
+
+        monitor = StallMonitor()
+        monitor.attach(client)
+        monitor.start()
+        ...
+        print(monitor.format_report())
+
+    :param handler_budget: 处理一条消息的耗时预算（秒），超过则记录
+    :param lag_budget: 事件循环延迟的预算（秒），超过则记录
+    :param lag_sample_interval: 采样事件循环延迟的间隔（秒）
+    :param receive_timeout_warn_ratio: 一次阻塞超过 ws_base.RECEIVE_TIMEOUT_MARGIN * receive_timeout_warn_ratio 时打警告，
+        因为这时心跳包的回复可能赶不上接收超时时间，None表示不警告
+    :param max_offenders: 最多保存多少个(房间ID, cmd)的统计，超过时淘汰最大耗时最小的
+    :param max_recent_calls: 最多保存多少条最近超过预算的消息处理
+    """
+
+    def __init__(
+        self,
+        *,
+        handler_budget: float = 0.05,
+        lag_budget: float = 0.1,
+        lag_sample_interval: float = 0.5,
+        receive_timeout_warn_ratio: Optional[float] = 0.5,
+        max_offenders: int = 100,
+        max_recent_calls: int = 100,
+    ):
+        self._handler_budget = handler_budget
+        self._lag_budget = lag_budget
+        self._lag_sample_interval = lag_sample_interval
+        self._warn_threshold = (
+            ws_base.RECEIVE_TIMEOUT_MARGIN * receive_timeout_warn_ratio
+            if receive_timeout_warn_ratio is not None else None
+        )
+        self._max_offenders = max_offenders
+
+        self._clients: 'weakref.WeakSet[ws_base.WebSocketClientBase]' = weakref.WeakSet()
+        """挂了本钩子的客户端"""
+        self._offenders: Dict[Tuple[Optional[int], str], OffenderStats] = {}
+        """(房间ID, cmd) -> 超过预算的统计"""
+        self._recent_calls: Deque[SlowCall] = collections.deque(maxlen=max_recent_calls)
+        """最近超过预算的消息处理"""
+        self._window_worst_call: Optional[SlowCall] = None
+        """本次采样间隔内最慢的一次消息处理，用来找出事件循环延迟是谁造成的"""
+
+        self._lag_sample_count = 0
+        """采样事件循环延迟的次数"""
+        self._lag_over_budget_count = 0
+        """事件循环延迟超过预算的次数"""
+        self._max_lag = 0.0
+        """最大事件循环延迟（秒）"""
+        self._lag_future: Optional[asyncio.Future] = None
+        """采样事件循环延迟的协程的future"""
+
+    @property
+    def is_running(self) -> bool:
+        """
+        正在采样事件循环延迟
+        """
+        return self._lag_future is not None
+
+    @property
+    def max_lag(self) -> float:
+        """
+        采样到的最大事件循环延迟（秒）
+        """
+        return self._max_lag
+
+    def attach(self, client: ws_base.WebSocketClientBase):
+        """
+        开始给客户端的消息处理器计时
+        """
+        client.add_stage_hook(self)
+        self._clients.add(client)
+
+    def detach(self, client: ws_base.WebSocketClientBase):
+        """
+        停止给客户端的消息处理器计时
+        """
+        client.remove_stage_hook(self)
+        self._clients.discard(client)
+
+    def start(self):
+        """
+        开始采样事件循环延迟
+        """
+        if self.is_running:
+            logger.warning('stall monitor is running, cannot start() again')
+            return
+        self._lag_future = asyncio.create_task(self._sample_lag_coroutine())
+
+    def stop(self):
+        """
+        停止采样事件循环延迟，已经挂到客户端的钩子不受影响
+        """
+        if not self.is_running:
+            logger.warning('stall monitor is stopped, cannot stop() again')
+            return
+        self._lag_future.cancel()
+        self._lag_future = None
+
+    def on_stage_begin(self, client: ws_base.WebSocketClientBase, stage: hooks.Stage, info: Any) -> Any:
+        if stage != hooks.Stage.DISPATCH:
+            return None
+        return time.perf_counter()
+
+    def on_stage_end(
+        self,
+        client: ws_base.WebSocketClientBase,
+        stage: hooks.Stage,
+        info: Any,
+        context: Any,
+        exception: Optional[BaseException],
+    ):
+        if stage != hooks.Stage.DISPATCH:
+            return
+        duration = time.perf_counter() - context
+        if duration < self._handler_budget:
+            return
+
+        cmd = info.get('cmd', '')
+        pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
+        if pos != -1:
+            cmd = cmd[:pos]
+        self._record_slow_call(SlowCall(room_id=client.room_id, cmd=cmd, duration=duration, time=time.time()))
+
+    def _record_slow_call(self, call: SlowCall):
+        self._recent_calls.append(call)
+        if self._window_worst_call is None or call.duration > self._window_worst_call.duration:
+            self._window_worst_call = call
+
+        key = (call.room_id, call.cmd)
+        stats = self._offenders.get(key, None)
+        if stats is None:
+            if len(self._offenders) >= self._max_offenders:
+                # 淘汰最大耗时最小的
+                min_key = min(self._offenders, key=lambda k: self._offenders[k].max_duration)
+                if self._offenders[min_key].max_duration > call.duration:
+                    self._warn_if_receive_timeout_at_risk('handler', call.duration, call)
+                    return
+                del self._offenders[min_key]
+            stats = self._offenders[key] = OffenderStats(room_id=call.room_id, cmd=call.cmd)
+        stats.count += 1
+        stats.total_duration += call.duration
+        if call.duration > stats.max_duration:
+            stats.max_duration = call.duration
+        stats.last_time = call.time
+
+        self._warn_if_receive_timeout_at_risk('handler', call.duration, call)
+
+    async def _sample_lag_coroutine(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._window_worst_call = None
+            start_time = loop.time()
+            await asyncio.sleep(self._lag_sample_interval)
+            lag = max(loop.time() - start_time - self._lag_sample_interval, 0.0)
+
+            self._lag_sample_count += 1
+            if lag > self._max_lag:
+                self._max_lag = lag
+            if lag >= self._lag_budget:
+                self._lag_over_budget_count += 1
+                call = self._window_worst_call
+                if call is not None:
+                    logger.info('event loop lag=%.3fs, worst handler call: room=%s cmd=%s duration=%.3fs',
+                                lag, call.room_id, call.cmd, call.duration)
+                else:
+                    logger.info('event loop lag=%.3fs, not caused by attached handlers', lag)
+                # 消息处理器造成的阻塞在记录时已经警告过了
+                if call is None or call.duration < lag / 2:
+                    self._warn_if_receive_timeout_at_risk('event loop', lag, call)
+
+    def _warn_if_receive_timeout_at_risk(self, source: str, duration: float, call: Optional[SlowCall]):
+        if self._warn_threshold is None or duration < self._warn_threshold:
+            return
+        room_ids = [client.room_id for client in self._clients]
+        if call is not None:
+            logger.warning(
+                '%s blocked for %.3fs (room=%s cmd=%s), receive timeout of rooms=%s is at risk, '
+                'it is heartbeat_interval + %ss',
+                source, duration, call.room_id, call.cmd, room_ids, ws_base.RECEIVE_TIMEOUT_MARGIN
+            )
+        else:
+            logger.warning(
+                '%s blocked for %.3fs, receive timeout of rooms=%s is at risk, it is heartbeat_interval + %ss',
+                source, duration, room_ids, ws_base.RECEIVE_TIMEOUT_MARGIN
+            )
+
+    def get_worst_offenders(self, n=10) -> List[OffenderStats]:
+        """
+        返回最大耗时最长的n个(房间ID, cmd)
+        """
+        return sorted(self._offenders.values(), key=lambda stats: stats.max_duration, reverse=True)[:n]
+
+    def get_recent_slow_calls(self) -> List[SlowCall]:
+        """
+        返回最近超过预算的消息处理，从旧到新
+        """
+        return list(self._recent_calls)
+
+    def reset(self):
+        """
+        清空统计
+        """
+        self._offenders.clear()
+        self._recent_calls.clear()
+        self._window_worst_call = None
+        self._lag_sample_count = 0
+        self._lag_over_budget_count = 0
+        self._max_lag = 0.0
+
+    def snapshot(self) -> dict:
+        """
+        返回统计数据的副本
+        """
+        return {
+            'lag_sample_count': self._lag_sample_count,
+            'lag_over_budget_count': self._lag_over_budget_count,
+            'max_lag': self._max_lag,
+            'worst_offenders': [dataclasses.asdict(stats) for stats in self.get_worst_offenders(len(self._offenders))],
+            'recent_slow_calls': [dataclasses.asdict(call) for call in self._recent_calls],
+        }
+
+    def format_report(self, n=10) -> str:
+        """
+        返回人类可读的报告
+
+        :param n: 列出最慢的n个(房间ID, cmd)
+        """
+        lines = [
+            f'event loop lag: max={self._max_lag:.3f}s, '
+            f'{self._lag_over_budget_count}/{self._lag_sample_count} samples over {self._lag_budget:.3f}s',
+            f'handler calls over {self._handler_budget:.3f}s:',
+        ]
+        for stats in self.get_worst_offenders(n):
+            lines.append(
+                f'  room={stats.room_id} cmd={stats.cmd} count={stats.count} '
+                f'max={stats.max_duration:.3f}s avg={stats.total_duration / stats.count:.3f}s'
+            )
+        return '\n'.join(lines)
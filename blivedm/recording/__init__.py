@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from typing import TYPE_CHECKING
+
+from .. import utils
+
+if TYPE_CHECKING:
+    from .segment import *
+    from .recorder import *
+    from .reader import *
+    from .replay import *
+
+# 只读录制的进程不用加载aiohttp，ReplayClient在第一次访问时才导入
+_LAZY_ATTRS = {
+    'SEGMENT_MAGIC': 'segment',
+    'RECORD_HEADER_STRUCT': 'segment',
+    'INDEX_ENTRY_STRUCT': 'segment',
+    'SEGMENT_SUFFIX': 'segment',
+    'INDEX_SUFFIX': 'segment',
+    'RecordHeader': 'segment',
+    'IndexEntry': 'segment',
+    'make_segment_path': 'segment',
+    'get_index_path': 'segment',
+    'list_segments': 'segment',
+    'FsyncPolicy': 'recorder',
+    'FrameRecorder': 'recorder',
+    'Record': 'reader',
+    'SegmentReader': 'reader',
+    'RecordingReader': 'reader',
+    'ReplayClient': 'replay',
+}
+
+__all__ = tuple(_LAZY_ATTRS)
+
+__getattr__, __dir__ = utils.make_lazy_module_attrs(__name__, globals(), _LAZY_ATTRS, (
+    'reader',
+    'recorder',
+    'replay',
+    'segment',
+    'transcode',
+))
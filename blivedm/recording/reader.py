@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import bisect
+import logging
+import mmap
+import zlib
+from typing import *
+
+from . import segment
+
+__all__ = (
+    'Record',
+    'SegmentReader',
+    'RecordingReader',
+)
+
+logger = logging.getLogger('blivedm')
+
+
+class Record(NamedTuple):
+    """
+    一条录制的WebSocket消息
+    """
+
+    time_ns: int
+    """接收时间戳（纳秒）"""
+    room_id: int
+    """房间ID，录制时房间ID未知则为0"""
+    data: bytes
+    """原始的WebSocket消息"""
+
+    @property
+    def time(self) -> float:
+        """
+        接收时间戳（秒）
+        """
+        return self.time_ns / 1e9
+
+
+class SegmentReader:
+    """
+    用mmap读取一个分段，不会把整个文件读进内存
+
+    :param path: 分段文件路径
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        if self._mmap[:len(segment.SEGMENT_MAGIC)] != segment.SEGMENT_MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a segment file')
+
+        self._index_times: Optional[List[int]] = None
+        """索引项的时间戳（纳秒），第一次定位时才读索引"""
+        self._index_offsets: Optional[List[int]] = None
+        """索引项的偏移"""
+
+    @property
+    def path(self) -> str:
+        """
+        分段文件路径
+        """
+        return self._path
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def find_offset(self, time_ns: int) -> int:
+        """
+        用索引找到一个偏移，从这里开始往后读就不会漏掉时间戳 >= time_ns 的记录
+
+        :param time_ns: 时间戳（纳秒）
+        """
+        if self._index_times is None:
+            self._load_index()
+        pos = bisect.bisect_right(self._index_times, time_ns) - 1
+        if pos < 0:
+            return len(segment.SEGMENT_MAGIC)
+        return self._index_offsets[pos]
+
+    def _load_index(self):
+        self._index_times = []
+        self._index_offsets = []
+        try:
+            with open(segment.get_index_path(self._path), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            logger.warning('index of segment %s not found, will read from the beginning', self._path)
+            return
+
+        # 最后一项可能不完整
+        entry_size = segment.INDEX_ENTRY_STRUCT.size
+        end = len(data) - len(data) % entry_size
+        file_size = len(self._mmap)
+        for time_ns, offset in segment.INDEX_ENTRY_STRUCT.iter_unpack(data[:end]):
+            if offset >= file_size:
+                # 进程崩溃时索引可能比分段先落盘
+                break
+            self._index_times.append(time_ns)
+            self._index_offsets.append(offset)
+
+    def iter_records(
+        self,
+        start_time_ns: Optional[int] = None,
+        end_time_ns: Optional[int] = None,
+        room_ids: Optional[Container[int]] = None,
+    ) -> Iterator[Record]:
+        """
+        按顺序读取记录，遇到不完整或者损坏的记录时停止
+
+        :param start_time_ns: 只读取时间戳 >= start_time_ns 的记录，None表示从头
+        :param end_time_ns: 只读取时间戳 < end_time_ns 的记录，None表示到尾
+        :param room_ids: 只读取这些房间的记录，None表示全部
+        """
+        data = self._mmap
+        file_size = len(data)
+        header_struct = segment.RECORD_HEADER_STRUCT
+        header_size = header_struct.size
+        offset = self.find_offset(start_time_ns) if start_time_ns is not None else len(segment.SEGMENT_MAGIC)
+        while offset < file_size:
+            if offset + header_size > file_size:
+                logger.warning('segment %s has a truncated record header at offset=%d', self._path, offset)
+                return
+            data_len, crc32, time_ns, room_id = header_struct.unpack_from(data, offset)
+            data_offset = offset + header_size
+            offset = data_offset + data_len
+            if offset > file_size:
+                logger.warning('segment %s has a truncated record at offset=%d', self._path, data_offset - header_size)
+                return
+
+            if end_time_ns is not None and time_ns >= end_time_ns:
+                return
+            if start_time_ns is not None and time_ns < start_time_ns:
+                continue
+            if room_ids is not None and room_id not in room_ids:
+                continue
+
+            record_data = data[data_offset:offset]
+            if zlib.crc32(record_data) != crc32:
+                logger.warning('segment %s has a corrupted record at offset=%d', self._path, data_offset - header_size)
+                return
+            yield Record(time_ns, room_id, record_data)
+
+
+class RecordingReader:
+    """
+    读取一个录制目录里的所有分段
+
+    :param directory: 录制目录
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+
+    @property
+    def directory(self) -> str:
+        """
+        录制目录
+        """
+        return self._directory
+
+    def iter_records(
+        self,
+        start_time_ns: Optional[int] = None,
+        end_time_ns: Optional[int] = None,
+        room_ids: Optional[Container[int]] = None,
+    ) -> Iterator[Record]:
+        """
+        按时间顺序读取所有分段的记录，参数见SegmentReader.iter_records
+        """
+        segments = segment.list_segments(self._directory)
+        if start_time_ns is not None:
+            # 从第一条记录不晚于start_time_ns的最后一个分段开始
+            first_times = [first_time_ns for first_time_ns, _ in segments]
+            pos = max(bisect.bisect_right(first_times, start_time_ns) - 1, 0)
+            segments = segments[pos:]
+
+        for first_time_ns, path in segments:
+            if end_time_ns is not None and first_time_ns >= end_time_ns:
+                return
+            try:
+                reader = SegmentReader(path)
+            except (OSError, ValueError) as e:
+                # 录制进程刚创建分段就崩溃时分段是空的，mmap空文件也是ValueError
+                logger.warning('skipped segment %s: %r', path, e)
+                continue
+            with reader:
+                yield from reader.iter_records(start_time_ns, end_time_ns, room_ids)
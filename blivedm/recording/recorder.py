@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import enum
+import logging
+import os
+import threading
+import time
+import zlib
+from typing import *
+
+from . import segment
+
+__all__ = (
+    'FsyncPolicy',
+    'FrameRecorder',
+)
+
+logger = logging.getLogger('blivedm')
+
+
+class FsyncPolicy(enum.IntEnum):
+    """
+    什么时候调用fsync，越频繁进程或系统崩溃时丢的数据越少，但是磁盘压力越大
+    """
+
+    NEVER = 0
+    """交给操作系统"""
+    ON_ROTATE = 1
+    """切换分段和停止时"""
+    INTERVAL = 2
+    """每隔fsync_interval秒"""
+    ALWAYS = 3
+    """每次批量写入后"""
+
+
+def _write_all(file: BinaryIO, data: bytes):
+    """
+    文件没有缓冲，一次write就是一次os.write，可能只写入一部分（磁盘满、被信号打断等），所以循环写到全部写入
+    """
+    view = memoryview(data)
+    while view:
+        written = file.write(view)
+        if not written:
+            raise OSError(f'short write, {len(view)} bytes left')
+        view = view[written:]
+
+
+class FrameRecorder:
+    """
+    把收到的原始WebSocket消息追加写到分段的录制文件，格式见segment模块
+
+    事件循环里只把消息放进缓冲区，在后台线程批量写入，所以磁盘延迟不会阻塞接收消息。缓冲区满时丢弃新消息并计数，
+    不会阻塞事件循环
+
+    用法::
+
+        recorder = FrameRecorder('records')
+        recorder.start()
+        client.set_recorder(recorder)
+        ...
+        recorder.stop()
+        await recorder.join()
+
+    注意冗余模式下每个连接收到的消息都会录制，MultiplexClient录制的房间ID是主房间的
+
+    :param directory: 录制目录，不存在则创建
+    :param segment_max_bytes: 分段文件超过这个大小时切换到新的分段
+    :param segment_max_duration: 分段第一条记录之后超过这个时间（秒）时切换到新的分段
+    :param index_interval: 每隔这个时间（秒）写一条索引，越小按时间定位越精确，索引文件越大
+    :param batch_max_bytes: 缓冲区超过这个大小时立即唤醒后台线程写入
+    :param flush_interval: 后台线程最多等待这个时间（秒）就写入一次
+    :param fsync_policy: 什么时候调用fsync
+    :param fsync_interval: fsync_policy是INTERVAL时，调用fsync的间隔（秒）
+    :param max_pending_bytes: 缓冲区最大大小，超过时丢弃新消息
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        segment_max_bytes: int = 256 * 1024 * 1024,
+        segment_max_duration: float = 60 * 60,
+        index_interval: float = 1,
+        batch_max_bytes: int = 1024 * 1024,
+        flush_interval: float = 0.5,
+        fsync_policy: FsyncPolicy = FsyncPolicy.INTERVAL,
+        fsync_interval: float = 5,
+        max_pending_bytes: int = 64 * 1024 * 1024,
+    ):
+        self._directory = directory
+        self._segment_max_bytes = segment_max_bytes
+        self._segment_max_duration_ns = int(segment_max_duration * 1e9)
+        self._index_interval_ns = int(index_interval * 1e9)
+        self._batch_max_bytes = batch_max_bytes
+        self._flush_interval = flush_interval
+        self._fsync_policy = fsync_policy
+        self._fsync_interval = fsync_interval
+        self._max_pending_bytes = max_pending_bytes
+
+        # 事件循环和后台线程共用的字段，用_cond的锁保护
+        self._cond = threading.Condition(threading.Lock())
+        self._pending: List[Tuple[int, int, bytes]] = []
+        """还没写入的记录，(接收时间戳（纳秒）, 房间ID, 数据)"""
+        self._pending_bytes = 0
+        """还没写入的数据大小"""
+        self._is_stopping = False
+        """调用了stop，不再接收新消息，后台线程写完缓冲区后退出"""
+        self._dropped_count = 0
+        """缓冲区满时丢弃的消息数"""
+
+        # 只有后台线程使用的字段
+        self._segment_file: Optional[BinaryIO] = None
+        """当前分段文件"""
+        self._index_file: Optional[BinaryIO] = None
+        """当前分段的索引文件"""
+        self._segment_path: Optional[str] = None
+        """当前分段文件的路径"""
+        self._segment_first_time_ns = 0
+        """当前分段第一条记录的时间戳（纳秒）"""
+        self._segment_size = 0
+        """当前分段文件的大小"""
+        self._next_index_time_ns = 0
+        """下一条索引的最早时间戳（纳秒）"""
+        self._is_dirty = False
+        """上次fsync之后有没有写入"""
+        self._last_fsync_time = 0.0
+        """上次fsync的时间（time.monotonic()）"""
+
+        self._written_count = 0
+        """写入的消息数"""
+        self._written_bytes = 0
+        """写入的数据大小，不包括记录头"""
+        self._batch_count = 0
+        """批量写入的次数"""
+        self._segment_count = 0
+        """创建的分段数"""
+        self._fsync_count = 0
+        """调用fsync的次数"""
+        self._write_error_count = 0
+        """写入失败的次数，失败时这一批消息会丢失"""
+
+        self._thread: Optional[threading.Thread] = None
+        """后台写入线程"""
+
+    @property
+    def directory(self) -> str:
+        """
+        录制目录
+        """
+        return self._directory
+
+    @property
+    def is_running(self) -> bool:
+        """
+        后台线程正在运行，注意调用stop后还没写完缓冲区也算正在运行
+        """
+        return self._thread is not None
+
+    def start(self):
+        """
+        启动后台写入线程
+        """
+        if self.is_running:
+            logger.warning('frame recorder is running, cannot start() again')
+            return
+
+        os.makedirs(self._directory, exist_ok=True)
+        with self._cond:
+            self._is_stopping = False
+        self._thread = threading.Thread(target=self._writer_thread_main, name='blivedm-recorder', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        停止接收新消息，后台线程写完缓冲区后退出。不会阻塞，用join等待写完
+        """
+        if not self.is_running:
+            logger.warning('frame recorder is stopped, cannot stop() again')
+            return
+
+        with self._cond:
+            self._is_stopping = True
+            self._cond.notify()
+
+    async def join(self):
+        """
+        等待后台线程写完缓冲区并退出
+        """
+        if not self.is_running:
+            logger.warning('frame recorder is stopped, cannot join()')
+            return
+
+        await asyncio.get_running_loop().run_in_executor(None, self.join_sync)
+
+    def join_sync(self):
+        """
+        join的同步版本，会阻塞当前线程
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        thread.join()
+        self._thread = None
+
+    def record(self, room_id: Optional[int], data: bytes):
+        """
+        录制一条WebSocket消息，只是放进缓冲区，在收消息的路径上调用
+
+        :param room_id: 房间ID
+        :param data: 原始的WebSocket消息
+        """
+        time_ns = time.time_ns()
+        with self._cond:
+            if self._is_stopping or self._thread is None:
+                return
+            if self._pending_bytes >= self._max_pending_bytes:
+                self._dropped_count += 1
+                return
+            self._pending.append((time_ns, room_id or 0, data))
+            self._pending_bytes += len(data)
+            if self._pending_bytes >= self._batch_max_bytes:
+                self._cond.notify()
+
+    def get_stats(self) -> dict:
+        """
+        返回写入的统计数据
+        """
+        with self._cond:
+            pending_count = len(self._pending)
+            pending_bytes = self._pending_bytes
+            dropped_count = self._dropped_count
+        return {
+            'pending_count': pending_count,
+            'pending_bytes': pending_bytes,
+            'dropped_count': dropped_count,
+            'written_count': self._written_count,
+            'written_bytes': self._written_bytes,
+            'batch_count': self._batch_count,
+            'segment_count': self._segment_count,
+            'fsync_count': self._fsync_count,
+            'write_error_count': self._write_error_count,
+        }
+
+    def _writer_thread_main(self):
+        try:
+            while True:
+                with self._cond:
+                    if self._pending_bytes < self._batch_max_bytes and not self._is_stopping:
+                        self._cond.wait(self._flush_interval)
+                    batch = self._pending
+                    self._pending = []
+                    self._pending_bytes = 0
+                    # 调用stop后record不会再放进缓冲区，这一批就是最后一批
+                    is_stopping = self._is_stopping
+
+                if batch:
+                    try:
+                        self._write_batch(batch)
+                    except OSError:
+                        self._write_error_count += 1
+                        logger.exception('frame recorder failed to write %d records to %s:',
+                                         len(batch), self._segment_path)
+                        self._close_segment()
+                if (
+                    self._fsync_policy == FsyncPolicy.INTERVAL
+                    and self._is_dirty
+                    and time.monotonic() - self._last_fsync_time >= self._fsync_interval
+                ):
+                    try:
+                        self._fsync()
+                    except OSError:
+                        self._write_error_count += 1
+                        logger.exception('frame recorder failed to fsync %s:', self._segment_path)
+                        self._close_segment()
+
+                if is_stopping:
+                    break
+        except Exception:  # noqa
+            logger.exception('frame recorder thread error:')
+        finally:
+            self._close_segment()
+
+    def _write_batch(self, batch: List[Tuple[int, int, bytes]]):
+        """
+        把一批记录写到分段文件，每个分段只调用一次write
+        """
+        segment_parts = []
+        index_parts = []
+        size = self._segment_size
+        for time_ns, room_id, data in batch:
+            if self._segment_file is None or self._should_rotate(time_ns, size, len(data)):
+                self._flush_parts(segment_parts, index_parts)
+                self._open_segment(time_ns)
+                size = self._segment_size
+
+            if time_ns >= self._next_index_time_ns:
+                index_parts.append(segment.INDEX_ENTRY_STRUCT.pack(time_ns, size))
+                self._next_index_time_ns = time_ns + self._index_interval_ns
+            segment_parts.append(segment.RECORD_HEADER_STRUCT.pack(len(data), zlib.crc32(data), time_ns, room_id))
+            segment_parts.append(data)
+            size += segment.RECORD_HEADER_STRUCT.size + len(data)
+            self._written_bytes += len(data)
+
+        self._flush_parts(segment_parts, index_parts)
+        self._written_count += len(batch)
+        self._batch_count += 1
+        if self._fsync_policy == FsyncPolicy.ALWAYS:
+            self._fsync()
+
+    def _should_rotate(self, time_ns: int, size: int, data_len: int) -> bool:
+        # 至少写一条记录，避免单条记录超过分段大小时无限切换
+        if size <= len(segment.SEGMENT_MAGIC):
+            return False
+        return (
+            size + segment.RECORD_HEADER_STRUCT.size + data_len > self._segment_max_bytes
+            or time_ns - self._segment_first_time_ns >= self._segment_max_duration_ns
+        )
+
+    def _flush_parts(self, segment_parts: List[bytes], index_parts: List[bytes]):
+        """
+        写入并清空待写的数据，先写分段再写索引，这样索引不会指向还没写入的记录
+        """
+        if segment_parts:
+            data = b''.join(segment_parts)
+            _write_all(self._segment_file, data)
+            self._segment_size += len(data)
+            segment_parts.clear()
+            self._is_dirty = True
+        if index_parts:
+            _write_all(self._index_file, b''.join(index_parts))
+            index_parts.clear()
+
+    def _open_segment(self, first_time_ns: int):
+        self._close_segment()
+
+        while True:
+            path = segment.make_segment_path(self._directory, first_time_ns)
+            try:
+                # 不追加到已有的分段，时间戳相同时往后挪1纳秒
+                segment_file = open(path, 'xb', buffering=0)
+                break
+            except FileExistsError:
+                first_time_ns += 1
+        index_file = None
+        try:
+            index_file = open(segment.get_index_path(path), 'wb', buffering=0)
+            _write_all(segment_file, segment.SEGMENT_MAGIC)
+        except BaseException:
+            # 打开失败会重试，不能泄漏文件描述符
+            if index_file is not None:
+                index_file.close()
+            segment_file.close()
+            raise
+
+        self._segment_file = segment_file
+        self._index_file = index_file
+        self._segment_path = path
+        self._segment_first_time_ns = first_time_ns
+        self._segment_size = len(segment.SEGMENT_MAGIC)
+        self._next_index_time_ns = first_time_ns
+        self._segment_count += 1
+        self._is_dirty = True
+        logger.info('frame recorder opened segment %s', path)
+
+    def _close_segment(self):
+        if self._segment_file is None:
+            return
+
+        try:
+            if self._fsync_policy != FsyncPolicy.NEVER and self._is_dirty:
+                self._fsync()
+        except OSError:
+            logger.exception('frame recorder failed to fsync %s:', self._segment_path)
+        finally:
+            self._segment_file.close()
+            self._index_file.close()
+            self._segment_file = None
+            self._index_file = None
+            self._is_dirty = False
+
+    def _fsync(self):
+        os.fsync(self._segment_file.fileno())
+        os.fsync(self._index_file.fileno())
+        self._is_dirty = False
+        self._last_fsync_time = time.monotonic()
+        self._fsync_count += 1
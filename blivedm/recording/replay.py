@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from typing import *
+
+import aiohttp
+
+from . import reader
+from ..clients import ws_base
+
+__all__ = (
+    'ReplayClient',
+)
+
+logger = logging.getLogger('blivedm')
+
+FAST_YIELD_INTERVAL = 100
+"""尽快回放时，每回放这么多条消息让出一次事件循环，避免其他协程饿死"""
+
+
+class ReplayClient(ws_base.WebSocketClientBase):
+    """
+    回放录制的原始WebSocket消息，不需要网络。消息走和真实客户端一样的解包、解压、分发路径，
+    所以消息处理器、统计、阶段钩子都和在线时一样工作
+
+    回放到哪条消息，room_id就是那条消息录制时的房间ID
+
+    :param directory: 录制目录
+    :param room_ids: 只回放这些房间，None表示全部
+    :param start_time: 从这个时间戳（秒）开始回放，None表示从头
+    :param end_time: 回放到这个时间戳（秒）之前，None表示到尾
+    :param speed: 回放速度的倍数，1表示按录制时的时间间隔实时回放，None表示尽快回放
+    :param session: 同WebSocketClientBase，回放时用不到
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        room_ids: Optional[Iterable[int]] = None,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        speed: Optional[float] = None,
+        session: Optional[aiohttp.ClientSession] = None,
+    ):
+        super().__init__(session)
+        self._reader = reader.RecordingReader(directory)
+        self._room_ids: Optional[FrozenSet[int]] = frozenset(room_ids) if room_ids is not None else None
+        self._end_time_ns: Optional[int] = int(end_time * 1e9) if end_time is not None else None
+        self._speed = speed
+
+        self._seek_time_ns: Optional[int] = int(start_time * 1e9) if start_time is not None else None
+        """下次从这个时间戳（纳秒）开始读，None表示不用重新定位"""
+        self._need_seek = True
+        """需要重新开始读记录，调用seek后为True"""
+        self._need_reset_clock = True
+        """需要重新对齐录制时间和现实时间，重新定位和修改速度后为True"""
+        self._replayed_count = 0
+        """回放的消息数"""
+        self._current_time_ns: Optional[int] = None
+        """最后回放的消息的录制时间戳（纳秒）"""
+
+    @property
+    def speed(self) -> Optional[float]:
+        """
+        回放速度的倍数，None表示尽快回放
+        """
+        return self._speed
+
+    def set_speed(self, speed: Optional[float]):
+        """
+        修改回放速度，回放中也可以修改
+
+        :param speed: 回放速度的倍数，1表示实时回放，None表示尽快回放
+        """
+        self._speed = speed
+        self._need_reset_clock = True
+
+    @property
+    def replayed_count(self) -> int:
+        """
+        回放的消息数
+        """
+        return self._replayed_count
+
+    @property
+    def current_time(self) -> Optional[float]:
+        """
+        最后回放的消息的录制时间戳（秒），还没开始回放时为None
+        """
+        return self._current_time_ns / 1e9 if self._current_time_ns is not None else None
+
+    def seek(self, time: float):
+        """
+        跳到某个时间戳，回放中也可以调用，会从时间戳 >= time 的第一条消息继续回放
+
+        :param time: 时间戳（秒）
+        """
+        self._seek_time_ns = int(time * 1e9)
+        self._need_seek = True
+
+    async def init_room(self) -> bool:
+        return True
+
+    async def _network_coroutine(self):
+        """
+        回放协程，回放完所有消息后停止
+        """
+        loop = asyncio.get_running_loop()
+        records: Optional[Iterator[reader.Record]] = None
+        base_record_time_ns = 0
+        base_loop_time = 0.0
+        count_since_yield = 0
+        try:
+            while True:
+                if self._need_seek:
+                    self._need_seek = False
+                    self._need_reset_clock = True
+                    if records is not None:
+                        records.close()
+                    records = self._reader.iter_records(self._seek_time_ns, self._end_time_ns, self._room_ids)
+
+                record = next(records, None)
+                if record is None:
+                    logger.info('replay finished, replayed_count=%d', self._replayed_count)
+                    return
+
+                speed = self._speed
+                if speed is None:
+                    count_since_yield += 1
+                    if count_since_yield >= FAST_YIELD_INTERVAL:
+                        count_since_yield = 0
+                        await asyncio.sleep(0)
+                else:
+                    if self._need_reset_clock:
+                        self._need_reset_clock = False
+                        base_record_time_ns = record.time_ns
+                        base_loop_time = loop.time()
+                    delay = base_loop_time + (record.time_ns - base_record_time_ns) / 1e9 / speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    if self._need_seek:
+                        # 等待时调用了seek，丢掉这条
+                        continue
+
+                await self._replay_record(record)
+        finally:
+            if records is not None:
+                records.close()
+
+    async def _replay_record(self, record: reader.Record):
+        self._room_id = record.room_id
+        self._current_time_ns = record.time_ns
+        self._replayed_count += 1
+        try:
+            await self._on_ws_data(record.data)
+        except ws_base.AuthError:
+            # 录制时认证失败了，回放时忽略
+            logger.warning('room=%d replayed an auth error at time=%.3f', record.room_id, record.time)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+录制文件的格式
+
+一个录制目录里有多个分段，每个分段是一对文件：
+
+- <第一条记录的时间戳（纳秒）>.seg：SEGMENT_MAGIC，然后是一条条记录。每条记录是RECORD_HEADER_STRUCT，
+  然后是原始的WebSocket消息，还没解压
+- <同名>.idx：稀疏的时间索引，每条是INDEX_ENTRY_STRUCT，记录某个时间戳的记录在.seg里的偏移
+
+分段只会追加写入，进程崩溃时最后一条记录可能不完整，读取时用长度和CRC检查
+"""
+import os
+import struct
+from typing import *
+
+__all__ = (
+    'SEGMENT_MAGIC',
+    'RECORD_HEADER_STRUCT',
+    'INDEX_ENTRY_STRUCT',
+    'SEGMENT_SUFFIX',
+    'INDEX_SUFFIX',
+    'RecordHeader',
+    'IndexEntry',
+    'make_segment_path',
+    'get_index_path',
+    'list_segments',
+)
+
+SEGMENT_MAGIC = b'BLDMSEG\x01'
+"""分段文件开头的魔数，最后一个字节是格式版本"""
+RECORD_HEADER_STRUCT = struct.Struct('<IIqQ')
+"""记录头：数据长度、数据的CRC32、接收时间戳（纳秒）、房间ID"""
+INDEX_ENTRY_STRUCT = struct.Struct('<qQ')
+"""索引项：接收时间戳（纳秒）、记录在分段文件里的偏移"""
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+
+class RecordHeader(NamedTuple):
+    data_len: int
+    crc32: int
+    time_ns: int
+    room_id: int
+
+
+class IndexEntry(NamedTuple):
+    time_ns: int
+    offset: int
+
+
+def make_segment_path(directory: str, first_time_ns: int) -> str:
+    """
+    返回分段文件的路径，文件名按字符串排序就是按时间排序
+
+    :param directory: 录制目录
+    :param first_time_ns: 分段第一条记录的时间戳（纳秒）
+    """
+    return os.path.join(directory, f'{first_time_ns:020d}{SEGMENT_SUFFIX}')
+
+
+def get_index_path(segment_path: str) -> str:
+    """
+    返回分段对应的索引文件路径
+    """
+    return segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+
+def list_segments(directory: str) -> List[Tuple[int, str]]:
+    """
+    返回录制目录里的所有分段，按时间排序
+
+    :return: [(第一条记录的时间戳（纳秒）, 分段文件路径)]
+    """
+    segments = []
+    for name in os.listdir(directory):
+        if not name.endswith(SEGMENT_SUFFIX):
+            continue
+        try:
+            first_time_ns = int(name[:-len(SEGMENT_SUFFIX)])
+        except ValueError:
+            continue
+        segments.append((first_time_ns, os.path.join(directory, name)))
+    segments.sort()
+    return segments
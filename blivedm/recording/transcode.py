@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+把录制的原始WebSocket消息批量转换成按cmd分开的表格文件，每个分段交给一个子进程处理::
+
+    python -m blivedm.recording.transcode records output
+    python -m blivedm.recording.transcode records output --format parquet --workers 8 --rooms 1 2
+
+输出目录结构是<输出目录>/<cmd>/<分段名>.<格式>，每行是一个消息模型，另外加上接收时间recv_time和房间ID recv_room_id
+两列（有些消息模型自己也有room_id字段）。嵌套的字段转成JSON字符串。parquet格式需要安装pyarrow
+"""
+import argparse
+import concurrent.futures
+import csv
+import dataclasses
+import functools
+import json
+import logging
+import operator
+import os
+import re
+import time
+from typing import *
+
+from . import reader, segment
+from .. import handlers
+from ..clients import protocol, ws_base
+
+__all__ = (
+    'OUTPUT_FORMATS',
+    'transcode_segment',
+    'transcode',
+)
+
+logger = logging.getLogger('blivedm')
+
+OUTPUT_FORMATS = ('csv', 'jsonl', 'parquet')
+
+PARQUET_ROW_GROUP_SIZE = 10000
+"""parquet每个row group的行数，也是写入前缓存的行数"""
+
+UNKNOWN_CMD_FIELDS = ('command',)
+"""没有消息模型的cmd，整条业务消息转成JSON放在这一列"""
+
+
+def _iter_commands(data: bytes) -> Iterator[dict]:
+    """
+    从一条WebSocket消息解出所有业务消息，服务器心跳包也转成业务消息，和客户端一样。认证响应等其他包忽略
+    """
+    # 录制的数据不用回复，所以每次用新的Protocol，不用管发送缓冲区
+    for event in protocol.Protocol().receive_message(data):
+        if isinstance(event, protocol.CommandEvent):
+            yield event.command
+        elif isinstance(event, protocol.HeartbeatReplyEvent):
+            yield protocol.make_heartbeat_command(event.popularity)
+
+
+class _RecordClient:
+    """
+    代替客户端传给消息处理器，消息处理器只用到了这些字段
+    """
+
+    def __init__(self):
+        self.room_id = 0
+
+
+class _CollectingHandler(handlers.BaseHandler):
+    """
+    用BaseHandler的分发逻辑和消息模型的from_command构造消息模型，交给on_row
+    """
+
+    def __init__(self, on_row: Callable[[str, Optional[type], tuple], None], include_unknown: bool):
+        self._on_row = on_row
+        self._include_unknown = include_unknown
+        self._cmd = ''
+        """正在处理的cmd"""
+        self._time = 0.0
+        """正在处理的消息的接收时间戳（秒）"""
+        self.command_count = 0
+        """处理的业务消息数"""
+        self.unknown_count = 0
+        """没有消息模型的业务消息数"""
+
+    def handle_record(self, client: _RecordClient, record: reader.Record):
+        client.room_id = record.room_id
+        self._time = record.time
+        for command in _iter_commands(record.data):
+            self.command_count += 1
+            self.handle(client, command)  # noqa
+
+    def handle(self, client: ws_base.WebSocketClientBase, command: dict):
+        cmd = command.get('cmd', '')
+        pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
+        if pos != -1:
+            cmd = cmd[:pos]
+
+        if cmd not in self._CMD_CALLBACK_DICT:
+            self.unknown_count += 1
+            if self._include_unknown:
+                self._on_row(cmd, None, (self._time, client.room_id, json.dumps(command, ensure_ascii=False)))
+            return
+
+        self._cmd = cmd
+        super().handle(client, command)
+
+    def _on_message(self, client: ws_base.WebSocketClientBase, message):
+        message_cls = type(message)
+        row = [self._time, client.room_id]
+        for value in operator.attrgetter(*_get_field_names(message_cls))(message):
+            if type(value) not in _SCALAR_TYPES:
+                value = _to_json_column(value)
+            row.append(value)
+        self._on_row(self._cmd, message_cls, tuple(row))
+
+
+def _make_collect_method():
+    def method(self: _CollectingHandler, client: ws_base.WebSocketClientBase, message):
+        self._on_message(client, message)  # noqa
+    return method
+
+
+# 所有_on_xxx都收集，这样新增的消息类型也会输出
+for _name in dir(handlers.BaseHandler):
+    if _name.startswith('_on_'):
+        setattr(_CollectingHandler, _name, _make_collect_method())
+del _name
+
+
+_SCALAR_TYPES = (type(None), str, int, float, bool)
+_UNSAFE_NAME_CHARS = re.compile(r'[^A-Za-z0-9_]')
+
+
+@functools.lru_cache(None)
+def _get_field_names(message_cls: type) -> Tuple[str, ...]:
+    return tuple(field.name for field in dataclasses.fields(message_cls))
+
+
+def _to_json_column(value) -> str:
+    if dataclasses.is_dataclass(value):
+        value = dataclasses.asdict(value)
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+#
+# 输出
+#
+
+def _get_output_name(cmd: str) -> str:
+    """
+    把cmd转成输出的目录名。没有消息模型的cmd是服务器发来的任意字符串，可能包含/、..、:等，不能直接拼到路径里
+    """
+    pos = cmd.find(':')  # 2019-5-29 B站弹幕升级新增了参数
+    if pos != -1:
+        cmd = cmd[:pos]
+    return _UNSAFE_NAME_CHARS.sub('_', cmd) or '_'
+
+
+class _OutputWriter:
+    def write_row(self, row: tuple):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class _CsvWriter(_OutputWriter):
+    def __init__(self, path: str, fieldnames: List[str]):
+        # 带BOM，这样Excel能正确识别UTF-8
+        self._file = open(path, 'w', encoding='utf-8-sig', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(fieldnames)
+
+    def write_row(self, row: tuple):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+
+class _JsonlWriter(_OutputWriter):
+    def __init__(self, path: str, fieldnames: List[str]):
+        self._file = open(path, 'w', encoding='utf-8')
+        self._fieldnames = fieldnames
+
+    def write_row(self, row: tuple):
+        self._file.write(json.dumps(dict(zip(self._fieldnames, row)), ensure_ascii=False))
+        self._file.write('\n')
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter(_OutputWriter):
+    def __init__(self, path: str, message_cls: Optional[type]):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._schema = _make_parquet_schema(pyarrow, message_cls)
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self._rows: List[tuple] = []
+
+    def write_row(self, row: tuple):
+        self._rows.append(row)
+        if len(self._rows) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        pyarrow = self._pyarrow
+        columns = []
+        for column, field in zip(zip(*self._rows), self._schema):
+            if field.type == pyarrow.string():
+                # 模型字段的类型注解不一定准确，字符串列统一转成字符串
+                column = [value if value is None or type(value) is str else str(value) for value in column]
+            columns.append(pyarrow.array(column, type=field.type))
+        self._writer.write_table(pyarrow.Table.from_arrays(columns, schema=self._schema))
+        self._rows = []
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self._writer.close()
+
+
+def _make_parquet_schema(pyarrow, message_cls: Optional[type]):
+    """
+    根据消息模型的字段类型生成schema，不从数据推断，这样每个文件的schema都一样
+    """
+    columns = [('recv_time', pyarrow.float64()), ('recv_room_id', pyarrow.int64())]
+    if message_cls is None:
+        columns += [(name, pyarrow.string()) for name in UNKNOWN_CMD_FIELDS]
+        return pyarrow.schema(columns)
+
+    type_map = {
+        int: pyarrow.int64(),
+        float: pyarrow.float64(),
+        bool: pyarrow.bool_(),
+        str: pyarrow.string(),
+    }
+    type_hints = get_type_hints(message_cls)
+    for field in dataclasses.fields(message_cls):
+        # 嵌套的字段已经转成JSON字符串
+        columns.append((field.name, type_map.get(type_hints.get(field.name), pyarrow.string())))
+    return pyarrow.schema(columns)
+
+
+def _get_fieldnames(message_cls: Optional[type]) -> List[str]:
+    fields = UNKNOWN_CMD_FIELDS if message_cls is None else _get_field_names(message_cls)
+    return ['recv_time', 'recv_room_id', *fields]
+
+
+def _open_writer(output_format: str, path: str, message_cls: Optional[type]) -> _OutputWriter:
+    if output_format == 'csv':
+        return _CsvWriter(path, _get_fieldnames(message_cls))
+    if output_format == 'jsonl':
+        return _JsonlWriter(path, _get_fieldnames(message_cls))
+    if output_format == 'parquet':
+        return _ParquetWriter(path, message_cls)
+    raise ValueError(f'unknown output format: {output_format}')
+
+
+def _check_output_format(output_format: str):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'unknown output format: {output_format}')
+    if output_format == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa
+        except ImportError:
+            raise ValueError('parquet output requires pyarrow, install it with `pip install pyarrow`') from None
+
+
+#
+# 转换
+#
+
+def transcode_segment(
+    segment_path: str,
+    output_dir: str,
+    output_format: str = 'csv',
+    room_ids: Optional[Container[int]] = None,
+    include_unknown=False,
+) -> dict:
+    """
+    转换一个分段，在子进程调用
+
+    :param segment_path: 分段文件路径
+    :param output_dir: 输出目录
+    :param output_format: 输出格式，见OUTPUT_FORMATS
+    :param room_ids: 只转换这些房间，None表示全部
+    :param include_unknown: 没有消息模型的cmd也输出，整条业务消息转成JSON放在一列
+    :return: 统计数据
+    """
+    start_time = time.perf_counter()
+    segment_name = os.path.basename(segment_path)[:-len(segment.SEGMENT_SUFFIX)]
+    writers: Dict[str, _OutputWriter] = {}
+    row_counts: Dict[str, int] = {}
+
+    def on_row(cmd: str, message_cls: Optional[type], row: tuple):
+        name = _get_output_name(cmd)
+        writer = writers.get(name, None)
+        if writer is None:
+            cmd_dir = os.path.join(output_dir, name)
+            os.makedirs(cmd_dir, exist_ok=True)
+            path = os.path.join(cmd_dir, f'{segment_name}.{output_format}')
+            writer = writers[name] = _open_writer(output_format, path, message_cls)
+            row_counts[name] = 0
+        writer.write_row(row)
+        row_counts[name] += 1
+
+    client = _RecordClient()
+    handler = _CollectingHandler(on_row, include_unknown)
+    record_count = 0
+    byte_count = 0
+    error_count = 0
+    is_skipped = False
+    try:
+        try:
+            segment_reader = reader.SegmentReader(segment_path)
+        except (OSError, ValueError) as e:
+            # 空的或者不是分段的文件，跳过，不影响其他分段
+            logger.warning('skipped segment %s: %r', segment_path, e)
+            is_skipped = True
+        else:
+            with segment_reader:
+                for record in segment_reader.iter_records(room_ids=room_ids):
+                    record_count += 1
+                    byte_count += len(record.data)
+                    try:
+                        handler.handle_record(client, record)
+                    except Exception:  # noqa
+                        error_count += 1
+                        if error_count <= 10:
+                            logger.exception('room=%d failed to transcode record at time=%.3f in %s:',
+                                             record.room_id, record.time, segment_path)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return {
+        'segment_path': segment_path,
+        'is_skipped': is_skipped,
+        'record_count': record_count,
+        'byte_count': byte_count,
+        'command_count': handler.command_count,
+        'unknown_count': handler.unknown_count,
+        'error_count': error_count,
+        'row_counts': row_counts,
+        'duration': time.perf_counter() - start_time,
+    }
+
+
+def transcode(
+    directory: str,
+    output_dir: str,
+    output_format: str = 'csv',
+    workers: Optional[int] = None,
+    room_ids: Optional[Iterable[int]] = None,
+    include_unknown=False,
+    on_segment_done: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    """
+    用进程池转换录制目录里的所有分段，每个分段一个任务
+
+    :param directory: 录制目录
+    :param output_dir: 输出目录
+    :param output_format: 输出格式，见OUTPUT_FORMATS
+    :param workers: 进程数，默认是CPU核数
+    :param room_ids: 只转换这些房间，None表示全部
+    :param include_unknown: 没有消息模型的cmd也输出
+    :param on_segment_done: 每转换完一个分段时调用，参数是transcode_segment的返回值
+    :return: 统计数据
+    """
+    _check_output_format(output_format)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    room_ids = frozenset(room_ids) if room_ids is not None else None
+
+    # 大的分段先开始，减少最后只剩一个进程在跑的时间
+    segment_paths = [path for _, path in segment.list_segments(directory)]
+    segment_paths.sort(key=os.path.getsize, reverse=True)
+
+    start_time = time.perf_counter()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(transcode_segment, path, output_dir, output_format, room_ids, include_unknown)
+            for path in segment_paths
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if on_segment_done is not None:
+                on_segment_done(result)
+    duration = time.perf_counter() - start_time
+
+    row_counts: Dict[str, int] = {}
+    for result in results:
+        for cmd, count in result['row_counts'].items():
+            row_counts[cmd] = row_counts.get(cmd, 0) + count
+    worker_duration = sum(result['duration'] for result in results)
+    command_count = sum(result['command_count'] for result in results)
+    byte_count = sum(result['byte_count'] for result in results)
+    return {
+        'segment_count': len(results),
+        'skipped_segment_count': sum(1 for result in results if result['is_skipped']),
+        'record_count': sum(result['record_count'] for result in results),
+        'byte_count': byte_count,
+        'command_count': command_count,
+        'unknown_count': sum(result['unknown_count'] for result in results),
+        'error_count': sum(result['error_count'] for result in results),
+        'row_counts': row_counts,
+        'workers': workers,
+        'duration': duration,
+        'commands_per_second': command_count / duration if duration > 0 else 0.0,
+        'bytes_per_second': byte_count / duration if duration > 0 else 0.0,
+        # 所有进程的处理时间之和 / 总时间，接近进程数说明并行效率高
+        'parallelism': worker_duration / duration if duration > 0 else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='录制目录')
+    parser.add_argument('output_dir', help='输出目录')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv')
+    parser.add_argument('--workers', type=int, default=None, help='进程数，默认是CPU核数')
+    parser.add_argument('--rooms', type=int, nargs='+', default=None, help='只转换这些房间')
+    parser.add_argument('--include-unknown', action='store_true', help='没有消息模型的cmd也输出')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+    def on_segment_done(result: dict):
+        print(f'{os.path.basename(result["segment_path"])}: {result["record_count"]} frames, '
+              f'{result["command_count"]} messages in {result["duration"]:.2f}s')
+
+    try:
+        report = transcode(
+            args.directory, args.output_dir, args.format, args.workers, args.rooms, args.include_unknown,
+            on_segment_done
+        )
+    except ValueError as e:
+        parser.error(str(e))
+        return
+
+    print(f'\n{report["segment_count"]} segments ({report["skipped_segment_count"]} skipped), '
+          f'{report["record_count"]} frames, '
+          f'{report["byte_count"] / 1024 / 1024:.1f} MiB, {report["command_count"]} messages '
+          f'({report["unknown_count"]} without model, {report["error_count"]} errors)')
+    print(f'{report["duration"]:.2f}s with {report["workers"]} workers: '
+          f'{report["commands_per_second"]:.0f} msg/s, {report["bytes_per_second"] / 1024 / 1024:.2f} MiB/s, '
+          f'parallelism {report["parallelism"]:.2f}')
+    for cmd, count in sorted(report['row_counts'].items(), key=lambda item: item[1], reverse=True):
+        print(f'  {cmd:<40} {count}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from typing import TYPE_CHECKING
+
+from .. import utils
+
+if TYPE_CHECKING:
+    from .sqlite import *
+    from .raw import *
+
+_LAZY_ATTRS = {
+    'DEFAULT_TABLES': 'sqlite',
+    'SqliteSink': 'sqlite',
+    'RAW_PACKET_HEADER_STRUCT': 'raw',
+    'RawPacket': 'raw',
+    'encode_raw_packet': 'raw',
+    'decode_raw_packets': 'raw',
+    'RawSinkInterface': 'raw',
+    'BatchingForwarder': 'raw',
+    'TcpForwarder': 'raw',
+    'UnixSocketForwarder': 'raw',
+    'FileForwarder': 'raw',
+}
+
+__all__ = tuple(_LAZY_ATTRS)
+
+__getattr__, __dir__ = utils.make_lazy_module_attrs(__name__, globals(), _LAZY_ATTRS, (
+    'raw',
+    'sqlite',
+))
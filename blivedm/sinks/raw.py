@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+直通模式：客户端不反序列化业务消息，把原始JSON数据转发出去，在下游解析
+
+转发的格式是一个个包，每个包是RAW_PACKET_HEADER_STRUCT，然后是业务消息的原始JSON数据
+"""
+import asyncio
+import functools
+import logging
+import struct
+from typing import *
+
+__all__ = (
+    'RAW_PACKET_HEADER_STRUCT',
+    'RawPacket',
+    'encode_raw_packet',
+    'decode_raw_packets',
+    'RawSinkInterface',
+    'BatchingForwarder',
+    'TcpForwarder',
+    'UnixSocketForwarder',
+    'FileForwarder',
+)
+
+logger = logging.getLogger('blivedm')
+
+RAW_PACKET_HEADER_STRUCT = struct.Struct('<IIqQ')
+"""包头：数据长度、操作码Operation、接收时间戳（纳秒）、房间ID"""
+
+
+class RawPacket(NamedTuple):
+    operation: int
+    """操作码，业务消息是SEND_MSG_REPLY，blivedm自造的_HEARTBEAT消息是HEARTBEAT_REPLY"""
+    time_ns: int
+    """接收时间戳（纳秒）"""
+    room_id: int
+    """房间ID，未知则为0"""
+    body: bytes
+    """业务消息的原始JSON数据"""
+
+
+def encode_raw_packet(room_id: Optional[int], operation: int, recv_time: float, body: bytes) -> bytes:
+    """
+    编码一个包，参数同RawSinkInterface.on_raw_packet
+    """
+    return RAW_PACKET_HEADER_STRUCT.pack(len(body), operation, int(recv_time * 1e9), room_id or 0) + body
+
+
+def decode_raw_packets(data: Union[bytes, bytearray, memoryview]) -> Tuple[List[RawPacket], int]:
+    """
+    从数据里解出所有完整的包，给下游用
+
+    :param data: 收到的数据，可以以不完整的包结尾
+    :return: (所有完整的包, 用掉的数据长度)，剩下的数据要和后面收到的数据拼起来再解
+    """
+    packets = []
+    offset = 0
+    header_size = RAW_PACKET_HEADER_STRUCT.size
+    data_len = len(data)
+    while offset + header_size <= data_len:
+        body_len, operation, time_ns, room_id = RAW_PACKET_HEADER_STRUCT.unpack_from(data, offset)
+        end = offset + header_size + body_len
+        if end > data_len:
+            break
+        packets.append(RawPacket(operation, time_ns, room_id, bytes(data[offset + header_size:end])))
+        offset = end
+    return packets, offset
+
+
+class RawSinkInterface:
+    """
+    直通模式下原始业务消息的接收者，见WebSocketClientBase.set_raw_sink
+
+    注意on_raw_packet在收消息的路径上调用，每个业务消息调用一次，不能阻塞
+    """
+
+    def on_raw_packet(self, room_id: Optional[int], operation: int, recv_time: float, body: bytes):
+        """
+        收到一个业务消息
+
+        :param room_id: 房间ID
+        :param operation: 操作码，见RawPacket.operation
+        :param recv_time: 接收时间戳（秒）
+        :param body: 业务消息的原始JSON数据
+        """
+        raise NotImplementedError
+
+
+class BatchingForwarder(RawSinkInterface):
+    """
+    把包攒成一批再写出去的转发器基类，在事件循环里运行。子类实现_open、_write、_close
+
+    写出失败时保留这一批，等待reconnect_interval后重新打开再写，期间新的包继续攒在缓冲区，
+    缓冲区满时丢弃新的包并计数，不会阻塞收消息
+
+    :param batch_max_bytes: 缓冲区超过这个大小时立即写出
+    :param flush_interval: 最多等待这个时间（秒）就写出一次
+    :param max_pending_bytes: 缓冲区最大大小，不包括正在写出的一批
+    :param reconnect_interval: 写出失败后等待这个时间（秒）再重新打开
+    """
+
+    def __init__(
+        self,
+        *,
+        batch_max_bytes: int = 256 * 1024,
+        flush_interval: float = 0.05,
+        max_pending_bytes: int = 64 * 1024 * 1024,
+        reconnect_interval: float = 1,
+    ):
+        self._batch_max_bytes = batch_max_bytes
+        self._flush_interval = flush_interval
+        self._max_pending_bytes = max_pending_bytes
+        self._reconnect_interval = reconnect_interval
+
+        self._buffer = bytearray()
+        """还没写出的包"""
+        self._buffer_packet_count = 0
+        """缓冲区里的包数"""
+        self._flush_event = asyncio.Event()
+        """缓冲区超过batch_max_bytes或者调用stop时设置"""
+        self._is_open = False
+        """_open成功了，还没失败或者关闭"""
+        self._is_stopping = False
+        """调用了stop，不再接收新的包，写完缓冲区后退出"""
+        self._writer_future: Optional[asyncio.Future] = None
+        """写出协程的future"""
+
+        self._dropped_count = 0
+        """缓冲区满时丢弃的包数"""
+        self._sent_count = 0
+        """写出的包数"""
+        self._sent_bytes = 0
+        """写出的数据大小，包括包头"""
+        self._batch_count = 0
+        """写出的批数"""
+        self._write_error_count = 0
+        """写出失败的次数"""
+
+    @property
+    def is_running(self) -> bool:
+        """
+        写出协程正在运行，注意调用stop后还没写完缓冲区也算正在运行
+        """
+        return self._writer_future is not None
+
+    def start(self):
+        """
+        启动写出协程
+        """
+        if self.is_running:
+            logger.warning('%s is running, cannot start() again', type(self).__name__)
+            return
+
+        self._is_stopping = False
+        self._writer_future = asyncio.create_task(self._writer_coroutine())
+
+    def stop(self):
+        """
+        停止接收新的包，写完缓冲区后退出。如果一直写出失败，用stop_now放弃缓冲区
+        """
+        if not self.is_running:
+            logger.warning('%s is stopped, cannot stop() again', type(self).__name__)
+            return
+
+        self._is_stopping = True
+        self._flush_event.set()
+
+    def stop_now(self):
+        """
+        立即停止，放弃缓冲区
+        """
+        if not self.is_running:
+            logger.warning('%s is stopped, cannot stop_now()', type(self).__name__)
+            return
+
+        self._is_stopping = True
+        self._writer_future.cancel()
+
+    async def join(self):
+        """
+        等待写出协程退出
+        """
+        if not self.is_running:
+            logger.warning('%s is stopped, cannot join()', type(self).__name__)
+            return
+
+        await asyncio.shield(self._writer_future)
+
+    def get_stats(self) -> dict:
+        """
+        返回转发的统计数据
+        """
+        return {
+            'is_open': self._is_open,
+            'pending_bytes': len(self._buffer),
+            'pending_count': self._buffer_packet_count,
+            'dropped_count': self._dropped_count,
+            'sent_count': self._sent_count,
+            'sent_bytes': self._sent_bytes,
+            'batch_count': self._batch_count,
+            'write_error_count': self._write_error_count,
+        }
+
+    def on_raw_packet(self, room_id: Optional[int], operation: int, recv_time: float, body: bytes):
+        buffer = self._buffer
+        if self._is_stopping or len(buffer) >= self._max_pending_bytes:
+            self._dropped_count += 1
+            return
+        buffer += RAW_PACKET_HEADER_STRUCT.pack(len(body), operation, int(recv_time * 1e9), room_id or 0)
+        buffer += body
+        self._buffer_packet_count += 1
+        if len(buffer) >= self._batch_max_bytes:
+            self._flush_event.set()
+
+    async def _writer_coroutine(self):
+        try:
+            while True:
+                if not self._is_stopping and len(self._buffer) < self._batch_max_bytes:
+                    try:
+                        await asyncio.wait_for(self._flush_event.wait(), self._flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                self._flush_event.clear()
+
+                if self._buffer:
+                    batch = bytes(self._buffer)
+                    packet_count = self._buffer_packet_count
+                    self._buffer.clear()
+                    self._buffer_packet_count = 0
+                    await self._write_batch_until_success(batch)
+                    self._sent_count += packet_count
+                    self._sent_bytes += len(batch)
+                    self._batch_count += 1
+
+                if self._is_stopping and not self._buffer:
+                    break
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self._close_quietly()
+            self._writer_future = None
+
+    async def _write_batch_until_success(self, batch: bytes):
+        while True:
+            try:
+                if not self._is_open:
+                    await self._open()
+                    self._is_open = True
+                await self._write(batch)
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                self._write_error_count += 1
+                logger.warning('%s failed to write %d bytes, retry in %ss: %r', type(self).__name__, len(batch),
+                               self._reconnect_interval, e)
+                await self._close_quietly()
+                await asyncio.sleep(self._reconnect_interval)
+
+    async def _close_quietly(self):
+        if not self._is_open:
+            return
+        self._is_open = False
+        try:
+            await self._close()
+        except Exception:  # noqa
+            logger.exception('%s failed to close:', type(self).__name__)
+
+    async def _open(self):
+        """
+        打开连接或者文件
+        """
+        raise NotImplementedError
+
+    async def _write(self, data: bytes):
+        """
+        写出一批数据，失败时抛出OSError
+        """
+        raise NotImplementedError
+
+    async def _close(self):
+        """
+        关闭连接或者文件
+        """
+        raise NotImplementedError
+
+
+class _StreamForwarder(BatchingForwarder):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def _open_connection(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        raise NotImplementedError
+
+    async def _open(self):
+        _, self._writer = await self._open_connection()
+
+    async def _write(self, data: bytes):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def _close(self):
+        writer = self._writer
+        self._writer = None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+class TcpForwarder(_StreamForwarder):
+    """
+    通过TCP转发原始业务消息
+
+    :param host: 下游的地址
+    :param port: 下游的端口
+    :param connect_timeout: 连接超时时间（秒）
+    :param kwargs: 见BatchingForwarder
+    """
+
+    def __init__(self, host: str, port: int, *, connect_timeout: float = 10, **kwargs):
+        super().__init__(**kwargs)
+        self._host = host
+        self._port = port
+        self._connect_timeout = connect_timeout
+
+    async def _open_connection(self):
+        return await asyncio.wait_for(asyncio.open_connection(self._host, self._port), self._connect_timeout)
+
+
+class UnixSocketForwarder(_StreamForwarder):
+    """
+    通过Unix域套接字转发原始业务消息
+
+    :param path: 套接字路径
+    :param kwargs: 见BatchingForwarder
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self._path = path
+
+    async def _open_connection(self):
+        return await asyncio.open_unix_connection(self._path)
+
+
+class FileForwarder(BatchingForwarder):
+    """
+    把原始业务消息追加写到文件，在线程池里写，不阻塞事件循环
+
+    :param path: 文件路径
+    :param kwargs: 见BatchingForwarder
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self._path = path
+        self._file: Optional[BinaryIO] = None
+        self._partial_batch: Optional[bytes] = None
+        """上次写出失败时只写了一部分的那一批"""
+        self._partial_offset = 0
+        """_partial_batch已经写入文件的大小，重试时从这里继续写，避免文件里有重复的包"""
+
+    async def _open(self):
+        # 不用缓冲，这样每次write返回时就知道写入了多少
+        self._file = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(open, self._path, 'ab', buffering=0)
+        )
+
+    async def _write(self, data: bytes):
+        file = self._file
+        offset = self._partial_offset if self._partial_batch is data else 0
+
+        def write():
+            nonlocal offset
+            view = memoryview(data)
+            while offset < len(data):
+                written = file.write(view[offset:])
+                if not written:
+                    raise OSError(f'short write, {len(data) - offset} bytes left')
+                offset += written
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write)
+        except BaseException:
+            self._partial_batch = data
+            self._partial_offset = offset
+            raise
+        self._partial_batch = None
+        self._partial_offset = 0
+
+    async def _close(self):
+        file = self._file
+        self._file = None
+        if file is not None:
+            await asyncio.get_running_loop().run_in_executor(None, file.close)
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import dataclasses
+import functools
+import json
+import logging
+import operator
+import sqlite3
+import threading
+import time
+from typing import *
+
+from .. import handlers, metrics
+from ..clients import ws_base
+from ..models import web as web_models, open_live as open_models
+
+__all__ = (
+    'DEFAULT_TABLES',
+    'SqliteSink',
+)
+
+logger = logging.getLogger('blivedm')
+
+DEFAULT_TABLES: Dict[str, Tuple[str, type]] = {
+    '_on_danmaku': ('danmaku', web_models.DanmakuMessage),
+    '_on_gift': ('gift', web_models.GiftMessage),
+    '_on_buy_guard': ('guard_buy', web_models.GuardBuyMessage),
+    '_on_user_toast_v2': ('user_toast_v2', web_models.UserToastV2Message),
+    '_on_super_chat': ('super_chat', web_models.SuperChatMessage),
+    '_on_open_live_danmaku': ('open_live_danmaku', open_models.DanmakuMessage),
+    '_on_open_live_gift': ('open_live_gift', open_models.GiftMessage),
+    '_on_open_live_buy_guard': ('open_live_guard_buy', open_models.GuardBuyMessage),
+    '_on_open_live_super_chat': ('open_live_super_chat', open_models.SuperChatMessage),
+}
+"""消息处理器的方法名 -> (表名, 消息模型的类)"""
+
+_SCALAR_TYPES = (type(None), str, int, float, bool)
+
+_SQLITE_TYPES = {
+    int: 'INTEGER',
+    bool: 'INTEGER',
+    float: 'REAL',
+    str: 'TEXT',
+}
+"""模型字段的类型 -> SQLite列的类型，其他类型转成JSON字符串存成TEXT"""
+
+
+@functools.lru_cache(None)
+def _get_field_names(message_cls: type) -> Tuple[str, ...]:
+    return tuple(field.name for field in dataclasses.fields(message_cls))
+
+
+@functools.lru_cache(None)
+def _get_field_values(message_cls: type) -> Callable[[Any], tuple]:
+    """
+    返回一次取出消息模型所有字段值的函数
+    """
+    field_names = _get_field_names(message_cls)
+    getter = operator.attrgetter(*field_names)
+    if len(field_names) == 1:
+        return lambda message: (getter(message),)
+    return getter
+
+
+def _to_json_column(value) -> str:
+    if dataclasses.is_dataclass(value):
+        value = dataclasses.asdict(value)
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _make_sink_method(method_name: str):
+    def method(self: 'SqliteSink', client: ws_base.WebSocketClientBase, message):
+        self.add_row(method_name, client, message)
+    return method
+
+
+class SqliteSink(handlers.BaseHandler):
+    """
+    把弹幕、礼物、上舰、醒目留言等消息存到SQLite的消息处理器
+
+    消息处理器里只把行放进内存缓冲区，在后台线程用executemany批量写入，一批写在一个事务里（group commit），
+    数据库开启WAL模式。所以写数据库不会阻塞网络协程，缓冲区满时丢弃新的行并计数
+
+    每种消息一张表，列是消息模型的字段，另外加上接收时间recv_time和房间ID recv_room_id两列。嵌套的字段转成JSON字符串
+
+    用法::
+
+        sink = SqliteSink('danmaku.db')
+        sink.start()
+        client.set_handler(sink)
+        ...
+        sink.stop()
+        await sink.join()
+
+    要存DEFAULT_TABLES以外的消息，继承并重写对应的_on_xxx方法，在里面调用add_row，再把它加到tables参数
+
+    :param path: 数据库文件路径
+    :param tables: 消息处理器的方法名 -> (表名, 消息模型的类)，默认是DEFAULT_TABLES。不在表里的消息不会写入
+    :param batch_size: 缓冲区超过这么多行时立即唤醒后台线程写入
+    :param flush_interval: 后台线程最多等待这个时间（秒）就写入一次
+    :param max_backlog: 缓冲区最多这么多行，超过时丢弃新的行
+    :param synchronous: SQLite的synchronous设置，WAL模式下NORMAL已经不会损坏数据库，只是系统崩溃时可能丢失最后的事务
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        tables: Optional[Dict[str, Tuple[str, type]]] = None,
+        batch_size: int = 1000,
+        flush_interval: float = 1,
+        max_backlog: int = 100000,
+        synchronous: str = 'NORMAL',
+    ):
+        self._path = path
+        self._tables = dict(tables) if tables is not None else dict(DEFAULT_TABLES)
+        for method_name in self._tables:
+            if getattr(type(self), method_name) is getattr(handlers.BaseHandler, method_name):
+                raise ValueError(f'{method_name} is not overridden, override it and call add_row()')
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_backlog = max_backlog
+        self._synchronous = synchronous
+
+        self._insert_sqls: Dict[str, str] = {
+            method_name: self._make_insert_sql(table_name, message_cls)
+            for method_name, (table_name, message_cls) in self._tables.items()
+        }
+        """消息处理器的方法名 -> INSERT语句"""
+
+        # 事件循环和后台线程共用的字段，用_cond的锁保护
+        self._cond = threading.Condition(threading.Lock())
+        self._pending: Dict[str, List[tuple]] = {}
+        """消息处理器的方法名 -> 还没写入的行"""
+        self._backlog = 0
+        """还没写入的行数"""
+        self._oldest_pending_time = 0.0
+        """缓冲区里最早的行放进来的时间（time.monotonic()）"""
+        self._is_stopping = False
+        """调用了stop，不再接收新的行，后台线程写完缓冲区后退出"""
+        self._dropped_count = 0
+        """缓冲区满时丢弃的行数"""
+
+        # 只有后台线程修改的字段
+        self._written_count = 0
+        """写入的行数"""
+        self._write_error_count = 0
+        """写入失败的次数，失败时这一批行会丢失"""
+        self._flush_time = metrics.TimeSummary()
+        """每次写入的耗时，从开始事务到提交"""
+        self._flush_latency = metrics.TimeSummary()
+        """每批里最早的行从放进缓冲区到提交的时间"""
+
+        self._thread: Optional[threading.Thread] = None
+        """后台写入线程"""
+
+    @staticmethod
+    def _make_insert_sql(table_name: str, message_cls: type) -> str:
+        columns = ['"recv_time"', '"recv_room_id"', *(f'"{name}"' for name in _get_field_names(message_cls))]
+        return f'INSERT INTO "{table_name}" ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+
+    @staticmethod
+    def _make_create_table_sql(table_name: str, message_cls: type) -> str:
+        type_hints = get_type_hints(message_cls)
+        # 不加自增主键，有些消息模型有id字段，要用的话可以用rowid
+        columns = ['recv_time REAL NOT NULL', 'recv_room_id INTEGER NOT NULL']
+        for field_name in _get_field_names(message_cls):
+            columns.append(f'"{field_name}" {_SQLITE_TYPES.get(type_hints.get(field_name), "TEXT")}')
+        return f'CREATE TABLE IF NOT EXISTS "{table_name}" ({", ".join(columns)})'
+
+    @property
+    def path(self) -> str:
+        """
+        数据库文件路径
+        """
+        return self._path
+
+    @property
+    def is_running(self) -> bool:
+        """
+        后台线程正在运行，注意调用stop后还没写完缓冲区也算正在运行
+        """
+        return self._thread is not None
+
+    def start(self):
+        """
+        启动后台写入线程，会在后台线程建表
+        """
+        if self.is_running:
+            logger.warning('sqlite sink is running, cannot start() again')
+            return
+
+        with self._cond:
+            self._is_stopping = False
+        self._thread = threading.Thread(target=self._writer_thread_main, name='blivedm-sqlite-sink', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        停止接收新的行，后台线程写完缓冲区后退出。不会阻塞，用join等待写完
+        """
+        if not self.is_running:
+            logger.warning('sqlite sink is stopped, cannot stop() again')
+            return
+
+        with self._cond:
+            self._is_stopping = True
+            self._cond.notify()
+
+    async def join(self):
+        """
+        等待后台线程写完缓冲区并退出
+        """
+        if not self.is_running:
+            logger.warning('sqlite sink is stopped, cannot join()')
+            return
+
+        await asyncio.get_running_loop().run_in_executor(None, self.join_sync)
+
+    def join_sync(self):
+        """
+        join的同步版本，会阻塞当前线程
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        thread.join()
+        self._thread = None
+
+    def get_stats(self) -> dict:
+        """
+        返回写入的统计数据
+        """
+        with self._cond:
+            backlog = self._backlog
+            backlog_age = time.monotonic() - self._oldest_pending_time if backlog != 0 else 0.0
+            dropped_count = self._dropped_count
+        return {
+            'backlog': backlog,
+            'backlog_age': backlog_age,
+            'dropped_count': dropped_count,
+            'written_count': self._written_count,
+            'write_error_count': self._write_error_count,
+            'flush_time': self._flush_time.snapshot(),
+            'flush_latency': self._flush_latency.snapshot(),
+        }
+
+    def add_row(self, method_name: str, client: ws_base.WebSocketClientBase, message):
+        """
+        把消息模型转成行放进缓冲区，只在事件循环调用
+
+        :param method_name: 消息处理器的方法名，决定写到哪张表，不在tables里则忽略
+        :param client: 收到消息的客户端
+        :param message: 消息模型
+        """
+        if method_name not in self._insert_sqls:
+            return
+        row = [time.time(), client.room_id or 0]
+        for value in _get_field_values(type(message))(message):
+            if type(value) not in _SCALAR_TYPES:
+                value = _to_json_column(value)
+            row.append(value)
+
+        with self._cond:
+            if self._is_stopping or self._thread is None:
+                return
+            if self._backlog >= self._max_backlog:
+                self._dropped_count += 1
+                return
+            if self._backlog == 0:
+                self._oldest_pending_time = time.monotonic()
+            rows = self._pending.get(method_name, None)
+            if rows is None:
+                rows = self._pending[method_name] = []
+            rows.append(tuple(row))
+            self._backlog += 1
+            if self._backlog >= self._batch_size:
+                self._cond.notify()
+
+    def _writer_thread_main(self):
+        try:
+            conn = self._connect()
+        except Exception:  # noqa
+            logger.exception('sqlite sink failed to open %s:', self._path)
+            with self._cond:
+                self._is_stopping = True
+                self._pending = {}
+                self._backlog = 0
+            return
+
+        try:
+            while True:
+                with self._cond:
+                    if self._backlog < self._batch_size and not self._is_stopping:
+                        self._cond.wait(self._flush_interval)
+                    batch = self._pending
+                    backlog = self._backlog
+                    oldest_pending_time = self._oldest_pending_time
+                    self._pending = {}
+                    self._backlog = 0
+                    # 调用stop后不会再放进缓冲区，这一批就是最后一批
+                    is_stopping = self._is_stopping
+
+                if backlog != 0:
+                    self._write_batch(conn, batch, backlog, oldest_pending_time)
+                if is_stopping:
+                    break
+        except Exception:  # noqa
+            logger.exception('sqlite sink thread error:')
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # 自己管理事务
+        conn = sqlite3.connect(self._path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self._synchronous}')
+            for table_name, message_cls in self._tables.values():
+                conn.execute(self._make_create_table_sql(table_name, message_cls))
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "{table_name}_recv_time" ON "{table_name}" (recv_time)')
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: Dict[str, List[tuple]], backlog: int,
+                     oldest_pending_time: float):
+        start_time = time.monotonic()
+        try:
+            conn.execute('BEGIN')
+            try:
+                for method_name, rows in batch.items():
+                    conn.executemany(self._insert_sqls[method_name], rows)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            self._write_error_count += 1
+            logger.exception('sqlite sink failed to write %d rows to %s:', backlog, self._path)
+            return
+
+        end_time = time.monotonic()
+        self._written_count += backlog
+        self._flush_time.observe(end_time - start_time)
+        self._flush_latency.observe(end_time - oldest_pending_time)
+
+
+def _install_sink_methods():
+    for method_name in DEFAULT_TABLES:
+        setattr(SqliteSink, method_name, _make_sink_method(method_name))
+
+
+_install_sink_methods()
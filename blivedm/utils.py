@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import importlib
+from typing import *
+
 USER_AGENT = (
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/147.0.0.0 Safari/537.36'
 )
@@ -17,3 +20,37 @@ def make_linear_retry_policy(start_interval: float, interval_step: float, max_in
             max_interval
         )
     return get_interval
+
+
+def make_lazy_module_attrs(
+    module_name: str,
+    module_globals: dict,
+    attr_to_submodule: Dict[str, str],
+    submodules: Iterable[str] = (),
+) -> Tuple[Callable[[str], Any], Callable[[], List[str]]]:
+    """
+    给包创建PEP 562的__getattr__和__dir__，第一次访问属性时才导入对应的子模块，加快import包的速度
+
+    :param module_name: 包名，一般传__name__
+    :param module_globals: 包的globals()，导入后的属性会缓存到这里，之后访问不再经过__getattr__
+    :param attr_to_submodule: 属性名 -> 定义它的子模块名
+    :param submodules: 可以直接当属性访问的子模块名
+    :return: (__getattr__, __dir__)
+    """
+    submodules = frozenset(submodules)
+
+    def __getattr__(name: str):
+        submodule_name = attr_to_submodule.get(name, None)
+        if submodule_name is not None:
+            value = getattr(importlib.import_module(f'{module_name}.{submodule_name}'), name)
+        elif name in submodules:
+            value = importlib.import_module(f'{module_name}.{name}')
+        else:
+            raise AttributeError(f'module {module_name!r} has no attribute {name!r}')
+        module_globals[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(module_globals) | set(attr_to_submodule) | submodules)
+
+    return __getattr__, __dir__